@@ -1,2 +1,13 @@
-from . import utils
-from . import etapes
\ No newline at end of file
+import importlib
+
+# Les sous-paquets sont chargés à la demande : l'import de pandas, pymupdf,
+# matplotlib ou facturix n'est payé que par les étapes qui en ont besoin.
+_SOUS_MODULES = {'utils', 'etapes', 'orchestrateur', 'flux', 'repartition', 'revision', 'api'}
+_ATTRIBUTS = {'extract_metadata_and_update_df': 'utils.metadonnees', 'Atelier': 'api'}
+
+def __getattr__(nom: str):
+    if nom in _SOUS_MODULES:
+        return importlib.import_module(f'.{nom}', __name__)
+    if nom in _ATTRIBUTS:
+        return getattr(importlib.import_module(f'.{_ATTRIBUTS[nom]}', __name__), nom)
+    raise AttributeError(f"module {__name__!r} has no attribute {nom!r}")
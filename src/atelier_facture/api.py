@@ -0,0 +1,219 @@
+"""
+Interface Python de l'atelier, pour piloter le traitement depuis un service sans passer
+par la ligne de commande ni relire les tables entre les étapes.
+
+Un `Atelier` garde un pool de processus supervisé (voir `utils.supervision`) d'un appel à l'autre : les imports
+lourds et le démarrage des processus ne sont payés qu'une fois pour tous les travaux du
+processus. Chaque méthode prend et renvoie des DataFrames ; celles d'un appel précédent
+sont réutilisées par défaut, à défaut les tables de l'atelier. Les tables et marqueurs
+d'étapes sont écrits comme par la ligne de commande, qui peut donc reprendre un atelier
+traité par l'API (et inversement).
+
+    from atelier_facture import Atelier
+
+    with Atelier('~/ateliers/lot_12', workers=4) as atelier:
+        atelier.extraire('lot_12.zip')
+        atelier.consolider()
+        atelier.fusionner()
+        for lot in atelier.formater():
+            ...  # colonnes 'BT-1', 'pdf', 'membre' et 'groupement' des factures produites
+
+        # Travail suivant, même pool
+        suivant = atelier.pour('~/ateliers/lot_13')
+        for lot in suivant.traiter('lot_13.zip'):
+            ...
+
+Les modes sans intermédiaires et répartition restent propres à la ligne de commande.
+"""
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator
+
+from atelier_facture.orchestrateur import (ETAPES, TAILLE_LOT_LIVRAISON, Contexte, fusionner_groupes,
+                                           importer_consignes, lire_csv, ouvrir_livraison)
+from atelier_facture.utils import logger
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+    from rich.console import Console
+    from atelier_facture.utils.supervision import Superviseur
+
+class Atelier:
+    """
+    Répertoire atelier piloté depuis Python.
+
+    :param pool: Pool supervisé existant (voir `extraction.creer_pool`), partagé avec
+                 d'autres ateliers ; sinon, un pool de `workers` processus est créé à la
+                 première extraction et fermé par `fermer`. Les documents en échec sont
+                 mis dans le dossier `quarantaine` de l'atelier.
+    :param console: Console des étapes, silencieuse par défaut.
+    """
+    def __init__(self, racine: Path | str, workers: int | None=None, pool: 'Superviseur | None'=None,
+                 livraison: str | None=None, livraison_taille_max: int | None=None,
+                 verifier_empreintes: bool=False, console: 'Console | None'=None):
+        if console is None:
+            from rich.console import Console
+            console = Console(quiet=True)
+        self.ctx = Contexte(racine=Path(racine).expanduser(), workers=workers, pool=pool, livraison=livraison,
+                            livraison_taille_max=livraison_taille_max, verifier_empreintes=verifier_empreintes,
+                            console=console)
+        self._pool_propre = pool is None
+        self.ctx.creer_repertoires()
+        self.extrait: 'DataFrame | None' = None
+        self.consignes: 'DataFrame | None' = None
+        self.facturx: 'DataFrame | None' = None
+        self.consignes_consolidees: 'DataFrame | None' = None
+        self.facturx_consolidees: 'DataFrame | None' = None
+        self.enrichis: 'DataFrame | None' = None
+
+    # ======================= Pool ============================================
+    @property
+    def pool(self) -> 'Superviseur':
+        """Pool supervisé, créé à la première utilisation."""
+        if self.ctx.pool is None:
+            from atelier_facture.etapes import extraction
+            self.ctx.pool = extraction.creer_pool(self.ctx.workers)
+        return self.ctx.pool
+
+    def pour(self, racine: Path | str) -> 'Atelier':
+        """Un autre atelier partageant le pool de celui-ci (et ses options), qui reste seul à le fermer."""
+        return Atelier(racine, self.ctx.workers, self.pool, self.ctx.livraison, self.ctx.livraison_taille_max,
+                       self.ctx.verifier_empreintes, self.ctx.console)
+
+    def fermer(self):
+        """Arrête le pool s'il a été créé par cet atelier."""
+        if self._pool_propre and self.ctx.pool is not None:
+            self.ctx.pool.fermer()
+            self.ctx.pool = None
+
+    def __enter__(self) -> 'Atelier':
+        return self
+
+    def __exit__(self, *exc):
+        self.fermer()
+
+    # ======================= Étapes ==========================================
+    def _table(self, valeur: 'DataFrame | None', attribut: str, chemin: Path, index: bool=True) -> 'DataFrame':
+        """`valeur` si fournie, sinon la table du dernier appel, sinon celle écrite dans l'atelier."""
+        if valeur is not None:
+            return valeur
+        if getattr(self, attribut) is not None:
+            return getattr(self, attribut)
+        if not chemin.exists():
+            raise FileNotFoundError(f"{chemin} n'existe pas : l'étape qui le produit n'a pas été exécutée.")
+        return lire_csv(chemin, index=index)
+
+    def _terminer(self, nom: str):
+        next(e for e in ETAPES if e.nom == nom).terminer(self.ctx)
+        logger.info(f"Étape {nom} terminée.")
+
+    def extraire(self, entree: Path | str, consignes: Path | str | None=None,
+                 progression: Callable[[int, int], None] | None=None) -> 'DataFrame':
+        """
+        Découpe les PDFs d'un zip, ou de tous les zips d'un dossier, avec le pool de l'atelier.
+
+        :param consignes: Consignes fournies à part (CSV ou Excel), à la place de celles du zip.
+        :param progression: Fonction appelée avec le nombre de PDFs sources découpés et leur total.
+        :return: Les factures extraites ; consignes et données Factur-X sont dans `consignes` et `facturx`.
+        """
+        from atelier_facture.etapes import extraction
+        self.ctx.entree = Path(entree).expanduser()
+        self.ctx.consignes = Path(consignes).expanduser() if consignes is not None else None
+        extrait, consignes_zip = extraction.process_zip(self.ctx.entree, self.ctx.extrait_dir, progress_callback=progression,
+                                                        workers=self.ctx.workers, pdf_dir=self.ctx.extrait_pdf_dir,
+                                                        pool=self.pool, quarantaine=self.ctx.quarantaine(),
+                                                        textes=self.ctx.cache_textes())
+        extrait.to_csv(self.ctx.extrait_dir / 'extrait.csv')
+        importer_consignes(self.ctx)
+        self.extrait = extrait
+        self.consignes = consignes_zip if consignes is None else lire_csv(self.ctx.extrait_dir / 'consignes.csv')
+        self.facturx = lire_csv(self.ctx.extrait_dir / 'facturx.csv')
+        self.consignes_consolidees = self.facturx_consolidees = self.enrichis = None
+        self._terminer('extraction')
+        return extrait
+
+    def consolider(self, extrait: 'DataFrame | None'=None, consignes: 'DataFrame | None'=None,
+                   facturx: 'DataFrame | None'=None) -> tuple['DataFrame', 'DataFrame']:
+        """
+        :return: Les consignes et les données Factur-X consolidées.
+        """
+        from atelier_facture.etapes import consolidation
+        extrait = self._table(extrait, 'extrait', self.ctx.extrait_dir / 'extrait.csv')
+        consignes = self._table(consignes, 'consignes', self.ctx.extrait_dir / 'consignes.csv', index=False)
+        facturx = self._table(facturx, 'facturx', self.ctx.extrait_dir / 'facturx.csv', index=False)
+
+        consolidees = consolidation.consolidation_consignes(extrait, consignes.copy(),
+                                                            manquants=self.ctx.racine / 'missing.csv')
+        consolidees.to_csv(self.ctx.racine / 'consignes_consolidees.csv')
+        facturx = consolidation.consolidation_facturx(consolidees, facturx.copy())
+        facturx.to_csv(self.ctx.racine / 'facturx_consolidees.csv')
+        self.consignes_consolidees, self.facturx_consolidees, self.enrichis = consolidees, facturx, None
+        self._terminer('consolidation')
+        return consolidees, facturx
+
+    def fusionner(self, consignes_consolidees: 'DataFrame | None'=None) -> 'DataFrame':
+        """
+        :return: Les consignes consolidées complétées des PDFs enrichis (colonne 'pdf').
+        """
+        consolidees = self._table(consignes_consolidees, 'consignes_consolidees',
+                                  self.ctx.racine / 'consignes_consolidees.csv')
+        enrichis = fusionner_groupes(self.ctx, consolidees)
+        enrichis['pdf'] = enrichis['pdf'].map(lambda p: str(p) if isinstance(p, Path) else p)
+        enrichis.to_csv(self.ctx.racine / 'enrichis.csv')
+        self.enrichis = enrichis
+        self._terminer('fusion')
+        return enrichis
+
+    def formater(self, enrichis: 'DataFrame | None'=None, facturx_consolidees: 'DataFrame | None'=None,
+                 taille_lot: int=TAILLE_LOT_LIVRAISON) -> Iterator['DataFrame']:
+        """
+        Génère les factures Factur-X par lots, livrés (option `livraison`) au fil de leur production.
+
+        :return: Itérateur sur chaque lot dès que ses PDFs sont produits (colonnes 'BT-1', 'pdf',
+                 'membre' et 'groupement'). L'étape n'est marquée terminée qu'une fois tous les lots produits.
+        """
+        from atelier_facture.etapes import formatage
+        enrichis = self._table(enrichis, 'enrichis', self.ctx.racine / 'enrichis.csv')
+        facturx = self._table(facturx_consolidees, 'facturx_consolidees', self.ctx.racine / 'facturx_consolidees.csv')
+        invalides = []
+        with ouvrir_livraison(self.ctx) as empaqueteur:
+            for lot, invalides_lot in formatage.generer_par_lots(formatage.fusionner_facturx(enrichis, facturx),
+                                                                 self.ctx.facturx_dir, taille_lot):
+                invalides += invalides_lot
+                if empaqueteur is not None:
+                    empaqueteur.ajouter_lot(lot, self.ctx.facturx_dir)
+                yield lot
+        if invalides:
+            logger.warning(f"{len(invalides)} XMLs Factur-X invalides.")
+        self._terminer('formatage')
+
+    def verifier(self) -> dict:
+        """
+        Vérifie les sorties de l'atelier et écrit `verification.json` (voir `etapes.verification`).
+
+        :return: Le rapport de vérification.
+        """
+        from atelier_facture.etapes import verification
+        rapport = verification.verifier(
+            self._table(None, 'extrait', self.ctx.extrait_dir / 'extrait.csv'),
+            self._table(None, 'enrichis', self.ctx.racine / 'enrichis.csv'),
+            self._table(None, 'facturx_consolidees', self.ctx.racine / 'facturx_consolidees.csv'),
+            self.ctx.facturx_dir, extrait_dir=self.ctx.extrait_pdf_dir, enrichi_dir=self.ctx.enrichi_dir,
+            empreintes=self.ctx.verifier_empreintes, workers=self.ctx.workers,
+        )
+        verification.ecrire_rapport(rapport, self.ctx.racine / 'verification.json')
+        self._terminer('verification')
+        return rapport
+
+    def traiter(self, entree: Path | str, consignes: Path | str | None=None,
+                taille_lot: int=TAILLE_LOT_LIVRAISON) -> Iterator['DataFrame']:
+        """
+        Toutes les étapes à la suite, sans relecture des tables ; la vérification est faite
+        une fois le dernier lot produit.
+
+        :return: Itérateur sur les lots de factures Factur-X, voir `formater`.
+        """
+        self.extraire(entree, consignes)
+        self.consolider()
+        self.fusionner()
+        yield from self.formater(taille_lot=taille_lot)
+        self.verifier()
@@ -1,67 +1,157 @@
 #!/usr/bin/env python3
 import argparse
-import pandas as pd
 from pathlib import Path
-from rich.console import Console
-from rich.panel import Panel
 
 from atelier_facture import utils
+from atelier_facture.utils.profilage import profileur
+from atelier_facture.utils.espace_travail import espace_travail
+from atelier_facture.utils import ecriture, depot, supervision
+from atelier_facture.orchestrateur import Contexte, NOMS_ETAPES, selectionner_etapes, executer_etapes
 
-from atelier_facture.etapes import extraction, consolidation, fusion, formatage
 def main():
     parser = argparse.ArgumentParser(description="Traitement des factures")
     parser.add_argument("atelier_path", type=str, help="Chemin du répertoire atelier")
     parser.add_argument("-i", "--input", type=str, help="Chemin vers le fichier zip d'entrée, ou le dossier de zips d'entrée.")
-    parser.add_argument("-f", "--force", action="store_true", help="Supprime tous les fichiers intermédiaires (pas les fichiers bruts extraits)")
+    parser.add_argument("--consignes", type=str, default=None,
+                        help="Consignes fournies à part (CSV ou Excel), à la place de celles du zip")
+    parser.add_argument("-f", "--force", action="store_true", help="Invalide les étapes sélectionnées et supprime leurs fichiers intermédiaires (pas les fichiers bruts extraits)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Nombre de processus pour l'extraction (défaut : nombre de cœurs)")
+    parser.add_argument("--livraison", choices=['membre', 'groupement', 'unique'], default=None,
+                        help="Empaquète les factures Factur-X dans des zips de livraison, un par membre, par groupement ou un seul")
+    parser.add_argument("--livraison-taille-max", type=int, default=None, metavar="MO",
+                        help="Taille maximale d'un zip de livraison (Mo), découpé en parties au-delà")
+    parser.add_argument("--sans-intermediaires", action="store_true",
+                        help="Ne conserve pas les PDFs extraits et enrichis : ils sont placés en mémoire (tmpfs) et supprimés en fin de traitement")
+    parser.add_argument("--garder", choices=['extrait', 'enrichi'], nargs='+', default=[],
+                        help="Avec --sans-intermediaires, conserve quand même ces PDFs intermédiaires (débogage)")
+    parser.add_argument("--seuil-memoire", type=int, default=2048, metavar="MO",
+                        help="Avec --sans-intermediaires, taille estimée des intermédiaires au-delà de laquelle ils sont placés sur disque (Mo)")
+    parser.add_argument("--ecriture-asynchrone", action="store_true",
+                        help="Écrit les PDFs en arrière-plan pendant le traitement des suivants (utile sur un stockage réseau lent)")
+    parser.add_argument("--depot", nargs='?', const='', default=None, metavar="DOSSIER",
+                        help="Stocke les PDFs extraits et enrichis une fois par contenu dans un dépôt partageable entre ateliers (défaut : <atelier>/objets), exposés par des liens")
+    parser.add_argument("--depot-lien", choices=depot.LIENS, default=None,
+                        help="Avec --depot, impose la méthode de lien (défaut : reflink, sinon lien physique, sinon copie)")
+    parser.add_argument("--delai-document", type=float, default=None, metavar="S",
+                        help="Durée maximale du découpage d'un PDF source ou de la fusion d'un groupement (s) ; au-delà, le document est mis en quarantaine")
+    parser.add_argument("--memoire-document", type=int, default=None, metavar="MO",
+                        help="Mémoire maximale d'un processus par document (Mo, Linux) ; au-delà, le document est mis en quarantaine")
+    parser.add_argument("--log-file", type=str, default="app.log", help="Fichier de log (défaut : app.log)")
+    parser.add_argument("--logs-production", action="store_true",
+                        help="Logs sans rendu Rich, au format texte structuré, écrits par un thread dédié ; les messages par fichier sont agrégés en compteurs")
     parser.add_argument('-v', '--verbose', action='count', default=0, help="Plus de logs (e.g., -v or -vv)")
+    parser.add_argument("--from-stage", choices=NOMS_ETAPES, help="Reprend le traitement à partir de cette étape")
+    parser.add_argument("--until", choices=NOMS_ETAPES, help="Arrête le traitement après cette étape")
+    parser.add_argument("--only", choices=NOMS_ETAPES, nargs='+', help="N'exécute que les étapes listées")
+    parser.add_argument("--flux", action="store_true",
+                        help="Exécute les étapes en flux : chaque groupement est fusionné puis converti en Factur-X dès que ses factures sont extraites (nécessite -i)")
+    parser.add_argument("--revision", type=str, default=None, metavar="CONSIGNES",
+                        help="Applique une nouvelle version des consignes (CSV ou Excel) à un atelier déjà traité, en ne refaisant que les groupements et factures concernés")
+    parser.add_argument("--reextraction", action="store_true",
+                        help="Refait l'extraction à partir du cache des textes des pages (après une modification des motifs), en ne redécoupant que les factures modifiées, puis les étapes suivantes")
+    parser.add_argument("--shard", type=str, default=None, metavar="I/N",
+                        help="Ne traite que la part I sur N du lot (machines partageant l'atelier), dans <atelier>/shards/I_N ; voir atelier_facture_fusion_shards")
+    parser.add_argument("--shard-attente", type=float, default=3600, metavar="S",
+                        help="Avec --shard, délai maximal d'attente de l'extraction des autres shards (secondes)")
+    parser.add_argument("--verifier-empreintes", action="store_true",
+                        help="À la vérification finale, relit les PDFs extraits et enrichis pour contrôler leur empreinte, pas seulement leur taille")
+    parser.add_argument("--profile", nargs='?', const='', default=None, metavar="RAPPORT",
+                        help="Mesure chaque étape et chaque fichier, rapport JSON écrit dans RAPPORT (défaut : <atelier>/profil.json)")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N", help="Nombre de fichiers les plus lents affichés avec --profile")
     args = parser.parse_args()
 
+    if args.only and (args.from_stage or args.until):
+        parser.error("--only ne peut pas être combiné avec --from-stage ou --until.")
+    if args.flux and (args.only or args.from_stage or args.until or not args.input):
+        parser.error("--flux exécute toutes les étapes : il nécessite -i et exclut --only, --from-stage et --until.")
+    if args.revision and (args.flux or args.input or args.consignes or args.only or args.from_stage or args.until or args.shard or args.sans_intermediaires):
+        parser.error("--revision s'applique à un atelier déjà traité : il exclut -i, --consignes, --flux, --shard, --sans-intermediaires et la sélection d'étapes.")
+    if args.reextraction and (args.revision or args.flux or args.only or args.from_stage or args.until or args.shard):
+        parser.error("--reextraction refait l'extraction puis les étapes suivantes : il exclut --revision, --flux, --shard et la sélection d'étapes.")
+    shard = None
+    if args.shard is not None:
+        from atelier_facture.repartition import lire_shard
+        try:
+            shard = lire_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.flux or args.sans_intermediaires:
+            parser.error("--shard partage les PDFs extraits entre shards : il exclut --flux et --sans-intermediaires.")
+
+    # Les dépendances lourdes ne sont importées qu'une fois les arguments validés
+    from rich.console import Console
+    from rich.panel import Panel
+
     # Configuration des loggs based on verbosity
-    utils.setup_logger(args.verbose, log_file="app.log")
+    utils.setup_logger(args.verbose, log_file=args.log_file, production=args.logs_production)
     console = Console()
 
-    p = Path(args.atelier_path).expanduser()
-    ip = p / 'extrait'
-    ep = p / 'enrichi'
-    fp = p / 'facturx'
-
+    racine = Path(args.atelier_path).expanduser()
+    if args.depot is not None:
+        # Dépôt à la racine de l'atelier, partagé par ses shards
+        depot.configurer(Path(args.depot).expanduser() if args.depot else racine / 'objets', args.depot_lien)
+    if shard is not None:
+        from atelier_facture.repartition import racine_shard
+        racine = racine_shard(racine, shard)
+    ctx = Contexte(
+        racine=racine,
+        entree=Path(args.input).expanduser() if args.input else None,
+        consignes=Path(args.consignes).expanduser() if args.consignes else None,
+        workers=args.workers,
+        livraison=args.livraison,
+        livraison_taille_max=args.livraison_taille_max * 1024 * 1024 if args.livraison_taille_max else None,
+        shard=shard,
+        shard_attente=args.shard_attente,
+        verifier_empreintes=args.verifier_empreintes,
+        console=console,
+    )
     # Création des repertoires de travail
-    for dir_path in [ip, ep, fp]:
-        dir_path.mkdir(parents=True, exist_ok=True)
+    ctx.creer_repertoires()
 
     # =======================Étape 0: Définition du répertoire de travail==============
     console.print(Panel.fit("Étape 0: Définition du répertoire de travail", style="bold magenta"))
-    utils.pedagogie.afficher_arborescence_travail(console, p, ip, ep, fp)
+    utils.pedagogie.afficher_arborescence_travail(console, ctx.racine, ctx.extrait_dir, ctx.enrichi_dir, ctx.facturx_dir)
 
-    # =======================Étape 1: Extraction des données===========================
-    if args.input:
-        console.print(Panel.fit("Étape 1: Extraction des données", style="bold magenta"))
-        input_path = Path(args.input).expanduser()
-        extrait, consignes = extraction.process_zip(input_path, ip)
-        extrait.to_csv(ip / 'extrait.csv')
-    else:
-        # Dans le cas ou aucun zip n'est fourni, on charge les fichiers csv issus d'une précédente extraction
-        extrait = pd.read_csv(ip / 'extrait.csv', sep=',', encoding='utf-8', dtype=str)
-        consignes = pd.read_csv(ip / 'consignes.csv', sep=',', encoding='utf-8', dtype=str)
-    facturx = pd.read_csv(ip / 'facturx.csv', sep=',', encoding='utf-8', dtype=str)
-    # =======================Étape 2: Consolidation====================================
-    console.print(Panel.fit("Étape 2: Consolidation", style="bold magenta"))
-    consignes = consolidation.consolidation_consignes(extrait, consignes)
-    consignes.to_csv(p / 'consignes_consolidees.csv')
+    # =======================Étapes 1 à 5==============================================
+    if args.ecriture_asynchrone:
+        ecriture.configurer(True)
+    supervision.configurer(args.delai_document,
+                           args.memoire_document * 2**20 if args.memoire_document is not None else None)
+    if args.profile is not None:
+        profileur.activer()
+    etapes = selectionner_etapes(args.from_stage, args.until, args.only)
+    if shard is not None:
+        # Un shard ne voit pas les PDFs extraits par les autres : la vérification se fait sur l'atelier réuni
+        etapes = [e for e in etapes if e.nom != 'verification']
+    def executer():
+        if args.revision:
+            from atelier_facture.revision import reviser
+            reviser(ctx, Path(args.revision).expanduser())
+            executer_etapes(ctx, selectionner_etapes(only=['verification']))
+        elif args.reextraction:
+            from atelier_facture.reextraction import reextraire
+            reextraire(ctx)
+            executer_etapes(ctx, selectionner_etapes(from_stage='consolidation'), force=True)
+        elif args.flux:
+            from atelier_facture.flux import executer_flux
+            executer_flux(ctx)
+            executer_etapes(ctx, selectionner_etapes(only=['verification']))
+        else:
+            executer_etapes(ctx, etapes, force=args.force)
 
-    facturx = consolidation.consolidation_facturx(consignes, facturx)
-    facturx.to_csv(p / 'facturx_consolidees.csv')
-    # etat_avancement(console, df, ip, ep, fp)
+    if args.sans_intermediaires:
+        with espace_travail(ctx.entree, args.seuil_memoire * 1024 * 1024, ctx.racine / '.travail') as espace:
+            ctx.espace = espace
+            ctx.garder = args.garder
+            executer()
+    else:
+        executer()
 
-    # =======================Étape 3: Création des pdfs enrichis=======================
-    console.print(Panel.fit("Étape 3: Création des pdfs enrichis", style="bold magenta"))
-    enrichis = fusion.fusion_groupes(consignes, ep)
-    print(enrichis)
-    print(enrichis.columns)
-    #etat_avancement(console, df, ip, ep, fp)
-    # =======================Étape 4: Création des factures Factur-X===================
-    console.print(Panel.fit("Étape 4: Création des factures Factur-X", style="bold magenta"))
-    bt_df = formatage.vers_facturx(enrichis, facturx, fp)
+    if args.profile is not None:
+        rapport = Path(args.profile).expanduser() if args.profile else ctx.racine / 'profil.json'
+        profileur.ecrire_rapport(rapport, args.profile_top)
+        utils.pedagogie.afficher_profil(console, profileur, args.profile_top)
+        console.print(f"Rapport de profilage écrit dans {rapport}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,198 @@
+"""
+Génération d'un corpus synthétique de factures au format des zips fournisseurs.
+
+Le zip produit contient :
+- des zips imbriqués de PDFs multi-factures, chaque facture portant les marqueurs
+  `N° de facture`, `Référence PDL` et `Regroupement de facturation` reconnus par l'extraction ;
+- le `consignes.csv` et le `facturx.csv` correspondants.
+
+    python -m atelier_facture.bench.corpus ~/bench/corpus_1k.zip -n 1000
+"""
+import argparse
+import csv
+import io
+import random
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+
+import pymupdf
+
+COLONNES_CONSIGNES = ['id', 'pdl', 'groupement', 'membre', 'Nom du site', 'Puissance (kVA)', 'Volume (kWh)']
+COLONNES_FACTURX = ['id', 'groupement', 'BT-2', 'BT-3', 'BT-5', 'BT-23', 'BT-27', 'BT-30', 'BT-44', 'BT-47',
+                    'BT-109', 'BT-110', 'BT-112', 'BT-115']
+
+@dataclass
+class Facture:
+    id: str
+    date: str  # JJ/MM/AAAA, tel qu'imprimé sur la facture
+    membre: str
+    pdl: str | None = None
+    groupement: str | None = None
+    pages: int = 1
+
+    @property
+    def est_groupement(self) -> bool:
+        return self.pdl is None
+
+def _lignes_facture(facture: Facture) -> list[str]:
+    lignes = [
+        f"N° de facture : {facture.id}",
+        f"VOTRE FACTURE DU {facture.date}",
+        f"Nom et Prénom ou Raison Sociale : {facture.membre}",
+        "Votre espace client  : https://client.enargia.eus",
+        "Votre identifiant : 0000000",
+    ]
+    if facture.est_groupement:
+        # Les factures de groupement portent une référence à 9 chiffres, ignorée à l'extraction
+        lignes.append(f"Référence PDL : {facture.id[-9:]}")
+        lignes.append(f"Regroupement de facturation : ({facture.groupement})")
+    else:
+        lignes.append(f"Référence PDL : {facture.pdl}")
+    return lignes
+
+def ecrire_facture(doc: pymupdf.Document, facture: Facture):
+    """Ajoute les pages d'une facture à `doc`."""
+    page = doc.new_page()
+    y = 72
+    for ligne in _lignes_facture(facture):
+        page.insert_text((50, y), ligne, fontsize=10)
+        y += 14
+    for i in range(1, facture.pages):
+        suite = doc.new_page()
+        suite.insert_text((50, 72), f"Détail de la consommation, page {i + 1}", fontsize=10)
+
+def planifier_factures(nb_factures: int, taille_groupement: tuple[int, int]=(2, 20),
+                       part_mono: float=0.1, part_isolees: float=0.1,
+                       pages_par_facture: tuple[int, int]=(1, 3), graine: int=0) -> list[Facture]:
+    """
+    Tire une répartition réaliste de `nb_factures` factures : groupements multi-PDL
+    (une facture de groupement et ses factures unitaires), groupements mono-PDL
+    et factures unitaires isolées.
+    """
+    rng = random.Random(graine)
+    factures: list[Facture] = []
+    # Des graines différentes donnent des ids et des groupements disjoints (corpus multi-zips)
+    compteur = graine * 10**8
+
+    def nouvelle(**kwargs) -> Facture:
+        nonlocal compteur
+        compteur += 1
+        date = f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024"
+        return Facture(id=f"{10**13 + compteur:014d}", date=date, pages=rng.randint(*pages_par_facture), **kwargs)
+
+    num_groupement = graine * 10**6
+    while len(factures) < nb_factures:
+        membre = f"MEMBRE {rng.randint(1, max(1, nb_factures // 50)):04d}"
+        tirage = rng.random()
+        num_groupement += 1
+        groupement = f"GROUPEMENT {num_groupement:07d}"
+        if tirage < part_isolees:
+            f = nouvelle(membre=membre)
+            f.pdl = f"{2 * 10**13 + compteur:014d}"
+            factures.append(f)
+        elif tirage < part_isolees + part_mono:
+            f = nouvelle(membre=membre, groupement=groupement)
+            f.pdl = f"{2 * 10**13 + compteur:014d}"
+            factures.append(f)
+        else:
+            taille = min(rng.randint(*taille_groupement), nb_factures - len(factures) - 1)
+            if taille < 2:
+                continue
+            factures.append(nouvelle(membre=membre, groupement=groupement))
+            for _ in range(taille):
+                f = nouvelle(membre=membre, groupement=groupement)
+                f.pdl = f"{2 * 10**13 + compteur:014d}"
+                factures.append(f)
+    return factures[:nb_factures]
+
+def lignes_consignes(factures: list[Facture], rng: random.Random) -> list[dict[str, str]]:
+    lignes = []
+    for i, f in enumerate(factures):
+        site = {'Nom du site': f"Site {i}", 'Puissance (kVA)': str(rng.choice([6, 9, 12, 36, 120])),
+                'Volume (kWh)': f"{rng.uniform(100, 100000):.2f}"}
+        if f.est_groupement:
+            # L'id de la facture de groupement n'est pas connu du client
+            lignes.append({'id': '', 'pdl': '', 'groupement': f.groupement, 'membre': f.membre, **site})
+        else:
+            lignes.append({'id': f.id, 'pdl': f.pdl, 'groupement': f.groupement or '', 'membre': f.membre, **site})
+    return lignes
+
+def lignes_facturx(factures: list[Facture], rng: random.Random) -> list[dict[str, str]]:
+    taille = {}
+    for f in factures:
+        if f.groupement:
+            taille[f.groupement] = taille.get(f.groupement, 0) + 1
+
+    lignes = []
+    for f in factures:
+        if f.groupement and not f.est_groupement and taille[f.groupement] > 1:
+            continue  # facture unitaire livrée dans la facture de groupement enrichie
+        ht = rng.uniform(10, 10000)
+        tva = ht * 0.2
+        jour, mois, annee = f.date.split('/')
+        lignes.append({
+            # Les groupements (multi et mono) sont reliés par leur nom, les isolées par leur id
+            'id': '' if f.groupement else f.id,
+            'groupement': f.groupement or '',
+            'BT-2': f"{annee}{mois}{jour}", 'BT-3': '380', 'BT-5': 'EUR', 'BT-23': 'A1',
+            'BT-27': 'FOURNISSEUR', 'BT-30': '123456789', 'BT-44': f.membre, 'BT-47': '987654321',
+            'BT-109': f"{ht:.2f}", 'BT-110': f"{tva:.2f}", 'BT-112': f"{ht + tva:.2f}", 'BT-115': f"{ht + tva:.2f}",
+        })
+    return lignes
+
+def _csv(lignes: list[dict[str, str]], colonnes: list[str]) -> str:
+    tampon = io.StringIO()
+    writer = csv.DictWriter(tampon, fieldnames=colonnes)
+    writer.writeheader()
+    writer.writerows(lignes)
+    return tampon.getvalue()
+
+def generer_corpus(sortie: Path, nb_factures: int, factures_par_pdf: int=100, pdfs_par_zip: int=10,
+                   graine: int=0, **kwargs) -> Path:
+    """
+    Écrit dans `sortie` un zip de `nb_factures` factures synthétiques.
+
+    :param factures_par_pdf: Nombre de factures concaténées dans chaque PDF fournisseur.
+    :param pdfs_par_zip: Nombre de PDFs par zip imbriqué.
+    :param kwargs: Paramètres de répartition transmis à `planifier_factures`.
+    :return: Le chemin du zip écrit.
+    """
+    rng = random.Random(graine)
+    factures = planifier_factures(nb_factures, graine=graine, **kwargs)
+    # Les factures d'un même PDF fournisseur sont mélangées, comme dans les envois réels
+    ordre = factures[:]
+    rng.shuffle(ordre)
+
+    sortie.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(sortie, 'w', compression=zipfile.ZIP_STORED) as zip_final:
+        lots = [ordre[i:i + factures_par_pdf] for i in range(0, len(ordre), factures_par_pdf)]
+        for num_zip in range(0, len(lots), pdfs_par_zip):
+            imbrique = io.BytesIO()
+            with zipfile.ZipFile(imbrique, 'w', compression=zipfile.ZIP_STORED) as zip_imbrique:
+                for num_pdf, lot in enumerate(lots[num_zip:num_zip + pdfs_par_zip], num_zip):
+                    with pymupdf.open() as doc:
+                        for facture in lot:
+                            ecrire_facture(doc, facture)
+                        zip_imbrique.writestr(f"factures_{num_pdf:05d}.pdf", doc.tobytes(garbage=1, deflate=True))
+            zip_final.writestr(f"lot_{num_zip // pdfs_par_zip:04d}.zip", imbrique.getvalue())
+
+        zip_final.writestr('consignes.csv', _csv(lignes_consignes(factures, rng), COLONNES_CONSIGNES))
+        zip_final.writestr('facturx.csv', _csv(lignes_facturx(factures, rng), COLONNES_FACTURX))
+    return sortie
+
+def main():
+    parser = argparse.ArgumentParser(description="Génère un zip de factures synthétiques")
+    parser.add_argument("sortie", type=Path, help="Chemin du zip à écrire")
+    parser.add_argument("-n", "--nb-factures", type=int, default=1000, help="Nombre de factures")
+    parser.add_argument("--factures-par-pdf", type=int, default=100)
+    parser.add_argument("--pdfs-par-zip", type=int, default=10)
+    parser.add_argument("--graine", type=int, default=0, help="Graine du générateur aléatoire")
+    args = parser.parse_args()
+
+    chemin = generer_corpus(args.sortie.expanduser(), args.nb_factures, args.factures_par_pdf,
+                            args.pdfs_par_zip, args.graine)
+    print(f"Corpus de {args.nb_factures} factures écrit dans {chemin}")
+
+if __name__ == "__main__":
+    main()
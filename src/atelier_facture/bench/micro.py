@@ -0,0 +1,224 @@
+"""
+Micro-benchmarks des primitives critiques (pdf_utils, extraction, consolidation),
+comparés à des références enregistrées dans `baselines.json`.
+
+    python -m atelier_facture.bench.micro                 # compare aux références
+    python -m atelier_facture.bench.micro --mettre-a-jour # réécrit les références
+
+Les durées sont normalisées par une boucle de calibration en pur Python, pour que
+les références restent comparables d'une machine à l'autre. Le code de sortie vaut 1
+si une primitive est plus lente que sa référence au-delà de la tolérance.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+BASELINES = Path(__file__).parent / 'baselines.json'
+
+@dataclass
+class MicroBenchmark:
+    nom: str
+    preparer: Callable[[Path], Callable[[], object]]
+    nombre: int = 10
+
+MICRO_BENCHMARKS: dict[str, MicroBenchmark] = {}
+
+def micro(nom: str, nombre: int=10):
+    """
+    Enregistre un micro-benchmark. La fonction décorée reçoit un dossier temporaire,
+    prépare ses données (non chronométré) et renvoie la fonction à chronométrer.
+    """
+    def decorator(preparer):
+        MICRO_BENCHMARKS[nom] = MicroBenchmark(nom, preparer, nombre)
+        return preparer
+    return decorator
+
+def chronometrer(fonction: Callable[[], object], nombre: int, repetitions: int) -> float:
+    """Durée minimale d'un appel (s) sur `repetitions` séries de `nombre` appels."""
+    durees = []
+    for _ in range(repetitions):
+        debut = time.perf_counter()
+        for _ in range(nombre):
+            fonction()
+        durees.append((time.perf_counter() - debut) / nombre)
+    return min(durees)
+
+def calibration() -> float:
+    """Durée d'une boucle de référence en pur Python, utilisée pour normaliser les mesures."""
+    def boucle():
+        total = 0
+        for i in range(100_000):
+            total += i * i % 7
+        return total
+    return chronometrer(boucle, 5, 5)
+
+# ======================= Données synthétiques ===============================
+def _pdf_factures(chemin: Path, nb_factures: int, pages_par_facture: tuple[int, int]=(2, 2)) -> Path:
+    import pymupdf
+    from atelier_facture.bench.corpus import planifier_factures, ecrire_facture
+
+    with pymupdf.open() as doc:
+        for facture in planifier_factures(nb_factures, pages_par_facture=pages_par_facture):
+            ecrire_facture(doc, facture)
+        doc.save(chemin)
+    return chemin
+
+def _tables_consolidation(nb_factures: int):
+    """Tables `extrait` et `consignes` cohérentes, comme en sortie d'extraction."""
+    import pandas as pd
+    from atelier_facture.bench.corpus import planifier_factures, lignes_consignes
+
+    factures = planifier_factures(nb_factures)
+    consignes = pd.DataFrame(lignes_consignes(factures, random.Random(0)), dtype=str)
+    extrait = pd.DataFrame([{
+        'id': f.id,
+        'date': '/'.join(reversed(f.date.split('/'))).replace('/', ''),
+        'pdl': f.pdl,
+        'groupement': f.groupement if f.est_groupement else None,
+        'membre': f.membre,
+        'fichier_extrait': f'extrait/{f.id}.pdf',
+    } for f in factures], dtype=str)
+    return extrait, consignes
+
+# ======================= Micro-benchmarks ===================================
+@micro('partial_pdf_copy', nombre=20)
+def _partial_pdf_copy(dossier: Path):
+    import pymupdf
+    from atelier_facture.utils import pdf_utils
+
+    doc = pymupdf.open(_pdf_factures(dossier / 'source.pdf', 100))
+    sortie = dossier / 'copie.pdf'
+    return lambda: pdf_utils.partial_pdf_copy(doc, 50, 53, sortie, metadata={'title': 'Facture'})
+
+@micro('apply_pdf_transformations', nombre=10)
+def _apply_pdf_transformations(dossier: Path):
+    from atelier_facture.utils import pdf_utils
+
+    source = _pdf_factures(dossier / 'facture.pdf', 1)
+    sortie = dossier / 'transformee.pdf'
+    transformations = [
+        (pdf_utils.remplacer_texte_doc, "Votre espace client  : https://client.enargia.eus", "Votre espace client : https://suiviconso.enargia.eus"),
+        (pdf_utils.caviarder_texte_doc, "Votre identifiant :", 290, 45),
+        (pdf_utils.ajouter_ligne_regroupement_doc, "GROUPEMENT AU NOM PARTICULIÈREMENT LONG POUR FORCER UN RETOUR À LA LIGNE"),
+    ]
+    return lambda: pdf_utils.apply_pdf_transformations(source, sortie, transformations)
+
+@micro('concat_pdfs', nombre=5)
+def _concat_pdfs(dossier: Path):
+    from atelier_facture.utils import pdf_utils
+
+    sources = [_pdf_factures(dossier / f'facture_{i}.pdf', 1) for i in range(50)]
+    sortie = dossier / 'concat.pdf'
+    return lambda: pdf_utils.concat_pdfs(sources, sortie, metadata={'title': 'Facture'})
+
+@micro('compress_pdf_inplace', nombre=5)
+def _compress_pdf_inplace(dossier: Path):
+    from atelier_facture.utils import pdf_utils
+
+    source = _pdf_factures(dossier / 'source.pdf', 50)
+    cible = dossier / 'compresse.pdf'
+    def compresser():
+        shutil.copyfile(source, cible)
+        pdf_utils.compress_pdf_inplace(cible)
+    return compresser
+
+@micro('obtenir_lignes_regroupement', nombre=200)
+def _obtenir_lignes_regroupement(dossier: Path):
+    from atelier_facture.utils import pdf_utils
+
+    texte = 'Regroupement de facturation : (' + ' '.join(f'MOT{i}' for i in range(60)) + ')'
+    def decouper():
+        # Découpage à froid : sans vider le cache, seul le premier appel serait mesuré
+        pdf_utils._decouper_lignes.cache_clear()
+        return pdf_utils.obtenir_lignes_regroupement(texte, 'hebo', 11, max_largeur=290)
+    return decouper
+
+@micro('extract_and_format_data', nombre=5)
+def _extract_and_format_data(dossier: Path):
+    import pymupdf
+    from atelier_facture.etapes.extraction import extract_and_format_data
+
+    with pymupdf.open(_pdf_factures(dossier / 'source.pdf', 100)) as doc:
+        textes = [page.get_text() for page in doc]
+    return lambda: [extract_and_format_data(t) for t in textes]
+
+@micro('consolidation_consignes', nombre=3)
+def _consolidation_consignes(dossier: Path):
+    from atelier_facture.etapes.consolidation import consolidation_consignes
+
+    extrait, consignes = _tables_consolidation(20_000)
+    return lambda: consolidation_consignes(extrait, consignes.copy(), manquants=None)
+
+# ======================= Exécution ==========================================
+def executer(noms: list[str], repetitions: int) -> dict[str, float]:
+    """
+    :return: Durée normalisée (durée / calibration) de chaque micro-benchmark.
+    """
+    from atelier_facture.utils import setup_logger
+    setup_logger(0)
+
+    reference = calibration()
+    resultats = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        dossier_courant = Path.cwd()
+        try:
+            os.chdir(tmp)
+            for nom in noms:
+                bench = MICRO_BENCHMARKS[nom]
+                dossier = Path(tmp) / nom
+                dossier.mkdir()
+                fonction = bench.preparer(dossier)
+                resultats[nom] = chronometrer(fonction, bench.nombre, repetitions) / reference
+        finally:
+            os.chdir(dossier_courant)
+    return resultats
+
+def comparer(resultats: dict[str, float], references: dict[str, float], tolerance: float) -> list[str]:
+    """
+    :return: Les noms des primitives plus lentes que leur référence au-delà de la tolérance.
+    """
+    return [nom for nom, valeur in resultats.items()
+            if nom in references and valeur > references[nom] * (1 + tolerance)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks des primitives avec références de non-régression")
+    parser.add_argument("noms", nargs='*', help=f"Micro-benchmarks à exécuter (défaut : tous). Disponibles : {', '.join(MICRO_BENCHMARKS)}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Ralentissement toléré par rapport à la référence (0.25 = 25 %%)")
+    parser.add_argument("--repetitions", type=int, default=5, help="Nombre de séries, la plus rapide est retenue")
+    parser.add_argument("--mettre-a-jour", action="store_true", help=f"Enregistre les mesures comme nouvelles références dans {BASELINES.name}")
+    args = parser.parse_args()
+
+    inconnus = [n for n in args.noms if n not in MICRO_BENCHMARKS]
+    if inconnus:
+        parser.error(f"Micro-benchmarks inconnus : {', '.join(inconnus)}")
+    noms = args.noms or list(MICRO_BENCHMARKS)
+
+    references = json.loads(BASELINES.read_text(encoding='utf-8')) if BASELINES.exists() else {}
+    resultats = executer(noms, args.repetitions)
+
+    for nom, valeur in resultats.items():
+        ref = references.get(nom)
+        ecart = f"{(valeur / ref - 1) * 100:+.1f} %" if ref else "pas de référence"
+        print(f"{nom:<30} {valeur:10.3f} ({ecart})")
+
+    if args.mettre_a_jour:
+        references.update(resultats)
+        BASELINES.write_text(json.dumps(dict(sorted(references.items())), indent=2) + '\n', encoding='utf-8')
+        print(f"Références mises à jour dans {BASELINES}")
+        return
+
+    regressions = comparer(resultats, references, args.tolerance)
+    if regressions:
+        print(f"Régressions au-delà de {args.tolerance:.0%} : {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
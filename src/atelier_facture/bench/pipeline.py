@@ -0,0 +1,97 @@
+"""
+Benchmark de bout en bout : exécute toutes les étapes sur des corpus synthétiques
+de tailles croissantes et mesure le débit (factures par seconde) de chaque étape.
+
+    python -m atelier_facture.bench.pipeline ~/bench --tailles 1000 10000 100000
+
+Les corpus sont générés une seule fois dans `<dossier>/corpus/` puis réutilisés.
+"""
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+from atelier_facture.utils.profilage import profileur
+
+TAILLES_DEFAUT = [1_000, 10_000, 100_000]
+
+def corpus(dossier: Path, nb_factures: int, graine: int=0) -> Path:
+    """Renvoie le zip de `nb_factures` factures, généré au besoin."""
+    from atelier_facture.bench.corpus import generer_corpus
+
+    chemin = dossier / 'corpus' / f'corpus_{nb_factures}_{graine}.zip'
+    if not chemin.exists():
+        generer_corpus(chemin, nb_factures, graine=graine)
+    return chemin
+
+def executer_benchmark(dossier: Path, nb_factures: int, etapes: list[str]|None=None, graine: int=0) -> dict:
+    """
+    Exécute les étapes sur un atelier neuf et renvoie les mesures de chaque étape.
+
+    :param etapes: Étapes à mesurer (toutes par défaut). L'atelier étant neuf, toutes les
+        étapes qui les précèdent dans le graphe sont aussi exécutées, mais pas mesurées.
+    """
+    from rich.console import Console
+    from atelier_facture.orchestrateur import Contexte, selectionner_etapes, executer_etapes
+
+    zip_path = corpus(dossier, nb_factures, graine)
+    atelier = dossier / 'ateliers' / f'atelier_{nb_factures}'
+    if atelier.exists():
+        shutil.rmtree(atelier)
+
+    ctx = Contexte(racine=atelier, entree=zip_path, console=Console(quiet=True))
+    profileur.reinitialiser()
+    profileur.activer()
+    if etapes:
+        # Chaque étape lit les sorties de toutes celles qui la précèdent
+        derniere = selectionner_etapes(only=etapes)[-1].nom
+        executer_etapes(ctx, selectionner_etapes(until=derniere))
+    else:
+        executer_etapes(ctx, selectionner_etapes())
+
+    mesures = {}
+    for m in profileur.etapes:
+        if etapes and m.nom not in etapes:
+            continue
+        mesures[m.nom] = {
+            'duree': m.duree,
+            'cpu': m.cpu,
+            'pic_rss': m.pic_rss,
+            'pages': m.pages,
+            'factures_par_seconde': nb_factures / m.duree if m.duree > 0 else None,
+        }
+    return {'factures': nb_factures, 'taille_zip': zip_path.stat().st_size, 'etapes': mesures}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de bout en bout sur corpus synthétiques")
+    parser.add_argument("dossier", type=Path, help="Dossier de travail (corpus, ateliers, résultats)")
+    parser.add_argument("--tailles", type=int, nargs='+', default=TAILLES_DEFAUT, help="Nombres de factures à tester")
+    parser.add_argument("--etapes", nargs='+', help="Restreint les mesures à ces étapes (toutes par défaut) ; les étapes amont sont exécutées")
+    parser.add_argument("--graine", type=int, default=0)
+    args = parser.parse_args()
+
+    from rich.console import Console
+    from rich.table import Table
+
+    dossier = args.dossier.expanduser()
+    resultats = [executer_benchmark(dossier, n, args.etapes, args.graine) for n in args.tailles]
+
+    sortie = dossier / 'resultats_pipeline.json'
+    with open(sortie, 'w', encoding='utf-8') as f:
+        json.dump(resultats, f, indent=2, ensure_ascii=False)
+
+    table = Table(title="Débit par étape (factures/s)")
+    table.add_column("Factures")
+    noms = list(resultats[0]['etapes'].keys())
+    for nom in noms:
+        table.add_column(nom)
+    for r in resultats:
+        table.add_row(str(r['factures']), *[
+            f"{r['etapes'][nom]['factures_par_seconde']:.1f} ({r['etapes'][nom]['duree']:.1f} s)" for nom in noms
+        ])
+    console = Console()
+    console.print(table)
+    console.print(f"Résultats écrits dans {sortie}")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
-from . import extraction
-from . import consolidation
-from . import fusion
-from . import formatage
\ No newline at end of file
+import importlib
+
+# Chargement à la demande des étapes, voir atelier_facture/__init__.py
+_SOUS_MODULES = {'extraction', 'consolidation', 'fusion', 'formatage', 'verification'}
+
+def __getattr__(nom: str):
+    if nom in _SOUS_MODULES:
+        return importlib.import_module(f'.{nom}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {nom!r}")
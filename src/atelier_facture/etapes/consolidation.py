@@ -1,6 +1,10 @@
+from pathlib import Path
 from pandas import DataFrame
 from atelier_facture.utils import logger
 
+# Ids non trouvés détaillés dans les logs, tous dans le fichier des manquants
+IDS_SIGNALES = 5
+
 def detection_type(df: DataFrame) -> DataFrame:
     """
     Détecte et attribue le type d'entrée pour chaque ligne du DataFrame.
@@ -24,10 +28,15 @@ def detection_type(df: DataFrame) -> DataFrame:
     )
     return df
 
-def consolidation_consignes(extrait: DataFrame, consignes: DataFrame) -> DataFrame:
-    consignes['id'] = consignes['id'].astype(str).apply(
-        lambda x: str(int(float(x))).zfill(14) if x and x.replace('.', '', 1).isdigit() and x.endswith('.0') else x
-    )
+def normaliser_id(x: str) -> str:
+    """Rétablit sur 14 chiffres un id lu comme flottant par un tableur ('10000000000001.0')."""
+    return str(int(float(x))).zfill(14) if x and x.replace('.', '', 1).isdigit() and x.endswith('.0') else x
+
+def consolidation_consignes(extrait: DataFrame, consignes: DataFrame, manquants: Path | None=Path('missing.csv')) -> DataFrame:
+    """
+    :param manquants: Fichier CSV où écrire les consignes dont l'id n'a pas été extrait, None pour ne pas l'écrire.
+    """
+    consignes['id'] = consignes['id'].astype(str).apply(normaliser_id)
     consignes = detection_type(consignes)
     # Filtrer les lignes de 'consignes' où 'type' est égal à 'groupement'
     consignes_groupement = consignes[consignes['type'] == 'groupement']
@@ -55,12 +64,18 @@ def consolidation_consignes(extrait: DataFrame, consignes: DataFrame) -> DataFra
     # Filtrer les lignes correspondantes dans consignes
     non_matching_rows = consignes[consignes['id'].isin(non_matching_ids)]
 
-    # Log un warning par ID non matché, incluant le groupement
-    for _, row in non_matching_rows.iterrows():
+    # Un résumé par type et les premiers ids non trouvés : le détail complet est dans `manquants`
+    if not non_matching_rows.empty:
+        par_type = non_matching_rows['type'].value_counts()
         logger.warning(
-            f"ID non trouvé dans extrait : {row['id']} | Groupement : {row['groupement']} | Type : {row.get('type', 'N/A')}"
+            f"{len(non_matching_rows)} ID non trouvés dans extrait ("
+            + ', '.join(f"{nombre} {type_}" for type_, nombre in par_type.items())
+            + (f"), détail dans {manquants}" if manquants is not None else ")")
         )
-    non_matching_rows.to_csv('missing.csv')
+        for row in non_matching_rows.head(IDS_SIGNALES).itertuples():
+            logger.warning(f"ID non trouvé dans extrait : {row.id} | Groupement : {row.groupement} | Type : {row.type}")
+    if manquants is not None:
+        non_matching_rows.to_csv(manquants)
     # Fusion des données extraites dans les consignes sur clé "id"
     consolide = consignes.merge(extrait[['id', 'date', 'fichier_extrait']], on='id', how='left', suffixes=('', '_extrait'))
 
@@ -71,8 +86,7 @@ def consolidation_facturx(consignes_consolidees: DataFrame, facturx: DataFrame)
 
     # Consolidation des groupement multi
     consignes_groupement = consignes_consolidees[consignes_consolidees['type'] == 'groupement']
-    print(consignes_groupement.columns)
-    print(facturx.columns)
+    logger.debug(f"Colonnes consignes : {list(consignes_groupement.columns)}, facturx : {list(facturx.columns)}")
     facturx = facturx.merge(consignes_groupement[['groupement', 'id']], on='groupement', how='left', suffixes=('', '_consignes'))
     if 'id_consignes' in facturx.columns:
         facturx['id'] = facturx['id'].combine_first(facturx['id_consignes'])
@@ -80,15 +94,11 @@ def consolidation_facturx(consignes_consolidees: DataFrame, facturx: DataFrame)
 
     # Consolidation des groupement mono
     consignes_mono = consignes_consolidees[consignes_consolidees['type'] == 'mono']
-    print(consignes_mono.columns)
-    print(facturx.columns)
     facturx = facturx.merge(consignes_mono[['groupement', 'id']], on='groupement', how='left', suffixes=('', '_consignes'))
     if 'id_consignes' in facturx.columns:
         facturx['id'] = facturx['id'].combine_first(facturx['id_consignes'])
         facturx.drop(columns=['id_consignes'], inplace=True)
 
     # facturx.drop(columns=['id_consignes', 'groupement'], inplace=True)
-    facturx['id'] = facturx['id'].astype(str).apply(
-        lambda x: str(int(float(x))).zfill(14) if x and x.replace('.', '', 1).isdigit() and x.endswith('.0') else x
-    )
+    facturx['id'] = facturx['id'].astype(str).apply(normaliser_id)
     return facturx
\ No newline at end of file
@@ -5,14 +5,22 @@ import tempfile
 import shutil
 import pymupdf
 
+from contextlib import nullcontext
+
 from pathlib import Path
 from typing import Callable
 import pandas as pd
-from pandas import DataFrame
+from pandas import DataFrame, Series
 
-from atelier_facture.utils import pdf_utils, file_naming, pedagogie
+from atelier_facture.utils import pdf_utils, file_naming, tableur
 
-from atelier_facture.utils import logger, setup_logger
+from atelier_facture.utils import logger, setup_logger, vider_compteurs
+from atelier_facture.utils import supervision
+from atelier_facture.utils.ecriture import ecriture_asynchrone
+from atelier_facture.utils.supervision import Quarantaine, Superviseur
+from atelier_facture.utils.textes import CacheTextes, empreinte_source
+from atelier_facture.utils.profilage import profileur, chronometrer
+from atelier_facture.repartition import dans_shard
 
 def extract_nested_pdfs(input_path: Path) -> Path:
     """
@@ -114,16 +122,70 @@ def extract_and_format_data(text: str, patterns: dict[str, str]|None=None) -> di
     formatted_data = format_extracted_data(extracted_data)
     return formatted_data
 
-def split_pdf_enhanced(pdf_path: str, output_folder: Path) -> dict[str, str]:
+def nommer_factures(factures: list[dict[str, str]], index: file_naming.IndexNoms) -> Series:
+    """
+    Compose en un appel les noms de fichier (sans extension) des factures extraites, réservés
+    dans `index` : deux factures de même nom sont désambiguïsées avant toute écriture.
+    """
+    factures = pd.DataFrame(factures)
+    format_types = factures['pdl'].notna().map({True: 'pdl', False: 'groupement'}) if 'pdl' in factures else 'groupement'
+    return index.attribuer(file_naming.compose_filenames(factures, format_types))
+
+def planifier_decoupage(textes: list[str], index: file_naming.IndexNoms | None=None) -> list[tuple[int, int, dict[str, str], str]]:
+    """
+    Plan de découpage d'un PDF à partir du texte de ses pages : une facture commence à
+    chaque page où les motifs de `extract_and_format_data` trouvent un numéro de facture.
+
+    :param index: Noms déjà attribués par l'extraction en cours, aux autres PDFs sources ;
+                  les noms ne sont désambiguïsés qu'au sein du PDF sinon.
+    :return: Pour chaque facture, sa première page, la page qui suit sa dernière, ses
+             données extraites et le nom de son fichier (sans extension).
+    """
+    # Trouver les pages qui contiennent le motif regex et extraire le numéro de facture
+    split_points: list[tuple[int, str]] = []  # Liste de tuples (page_number, identifier)
+    for i, texte in enumerate(textes):
+        extracted_data = extract_and_format_data(texte)
+        
+        if extracted_data and 'id' in extracted_data:
+            logger.debug('page#%s: %s', i, extracted_data)
+            split_points.append((i, extracted_data))
+
+    logger.info(f"{len(split_points)} factures trouvées.")
+    if not split_points:
+        return []
+    # Ajouter la fin du document comme dernier point de séparation
+    split_points.append((len(textes), None))
+
+    filenames = nommer_factures([data for _, data in split_points[:-1]], index or file_naming.IndexNoms())
+    return [(split_points[i][0], split_points[i + 1][0], split_points[i][1], filenames[i])
+            for i in range(len(split_points) - 1)]
+
+def ecrire_facture(doc: pymupdf.Document, start_page: int, end_page: int, data: dict[str, str], output_path: Path):
+    """Crée le PDF d'une facture avec les pages `start_page` à `end_page` (exclue) de `doc`."""
+    format_type = 'pdl' if 'pdl' in data else 'groupement'
+    transformations = [
+        (pdf_utils.remplacer_texte_doc, "Votre espace client  : https://client.enargia.eus", "Votre espace client : https://suiviconso.enargia.eus"),
+        (pdf_utils.caviarder_texte_doc, "Votre identifiant :", 290, 45),
+    ]
+    if format_type == 'groupement':
+        transformations.append((pdf_utils.ajouter_ligne_regroupement_doc, data['groupement']))
+    # Créer le PDF avec les pages séléctionnées, transformé avant son unique écriture
+    pdf_utils.partial_pdf_copy(doc, start_page, end_page, output_path, metadata={"title": f"Facture {data['id']}"},
+                               transformations=transformations)
+
+@chronometrer('split_pdf_enhanced')
+def split_pdf_enhanced(pdf_path: str, output_folder: Path, textes: CacheTextes | None=None,
+                       source: str | None=None, index: file_naming.IndexNoms | None=None) -> dict[str, str]:
     """
     Sépare un fichier PDF en plusieurs fichiers en utilisant un motif regex pour identifier les sections,
     et nomme chaque fichier avec le numéro de facture extrait. Les fichiers sont sauvegardés dans un dossier spécifié
     avec un nom composé à partir des informations de la dataframe.
 
     :param pdf_path: Chemin du fichier PDF à traiter.
-    :param regex_pattern: Motif regex pour extraire les identifiants (ex. numéros de facture).
     :param output_folder: Dossier où les fichiers PDF résultants seront sauvegardés (objet Path).
-    :param dataframe: DataFrame contenant les informations composant le nom du PDF.
+    :param textes: Cache où conserver le texte des pages, pour une réextraction (voir `utils.textes`).
+    :param source: Empreinte du PDF, calculée si besoin.
+    :param index: Noms déjà attribués aux factures des autres PDFs, voir `planifier_decoupage`.
     """
     logger.info(f"Découpage de {pdf_path.name} :")
     # Créer le dossier de destination s'il n'existe pas
@@ -131,89 +193,311 @@ def split_pdf_enhanced(pdf_path: str, output_folder: Path) -> dict[str, str]:
 
     res: list[dict[str, str]] = []
     # Charger le PDF source avec le context manager "with"
-    with pymupdf.open(pdf_path) as doc:
-        # Trouver les pages qui contiennent le motif regex et extraire le numéro de facture
-        split_points: list[tuple[int, str]] = []  # Liste de tuples (page_number, identifier)
-        for i, page in enumerate(doc):
-            extracted_data = extract_and_format_data(page.get_text())
-            
-            if extracted_data and 'id' in extracted_data:
-                logger.debug(f'page#{i}: {extracted_data}')
-                split_points.append((i, extracted_data))
-
-        logger.info(f"{len(split_points)} factures trouvées.")
-        # Ajouter la fin du document comme dernier point de séparation
-        split_points.append((len(doc), None))
-
-        # Créer des fichiers PDF distincts à partir des pages définies par les points de séparation
-        for i in range(len(split_points) - 1):
-            start_page, data = split_points[i]
-            end_page, _ = split_points[i + 1]
-
-            # Composer le nom de fichier
-            format_type = 'pdl' if 'pdl' in data else 'groupement'
-            filename = file_naming.compose_filename(data, format_type)
-            
+    # Les factures découpées sont écrites en arrière-plan pendant l'analyse des suivantes
+    with pymupdf.open(pdf_path) as doc, ecriture_asynchrone():
+        profileur.compter_pages(len(doc))
+        pages = [page.get_text() for page in doc]
+        if textes is not None:
+            source = source or empreinte_source(pdf_path)
+            textes.ecrire(source, pages)
+
+        # Créer des fichiers PDF distincts à partir des pages définies par le plan de découpage
+        for start_page, end_page, data, filename in planifier_decoupage(pages, index):
             # Définir le chemin de sauvegarde du fichier PDF
             output_path: Path = output_folder / f"{filename}.pdf"
-            
-            # Créer le PDF avec les pages séléctionnées
-            pdf_utils.partial_pdf_copy(doc, start_page, end_page, output_path, metadata={"title": f"Facture {data['id']}"})
-
-            transformations = [
-                (pdf_utils.remplacer_texte_doc, "Votre espace client  : https://client.enargia.eus", "Votre espace client : https://suiviconso.enargia.eus"),
-                (pdf_utils.caviarder_texte_doc, "Votre identifiant :", 290, 45),
-            ]
-            if format_type == 'groupement':
-                transformations.append((pdf_utils.ajouter_ligne_regroupement_doc, data['groupement']))
-            pdf_utils.apply_pdf_transformations(output_path, output_path, transformations)
+            ecrire_facture(doc, start_page, end_page, data, output_path)
 
             data['fichier_extrait'] = str(output_path)
             data['fichier_origine'] = str(pdf_path.name)
+            data['pages'] = end_page - start_page
+            data['page'] = start_page
+            if textes is not None:
+                data['source'] = source
             res.append(data)
-            logger.info(f"Le fichier {output_path.name} a été extrait.")
+            logger.info("Le fichier %s a été extrait.", output_path.name, extra={'compteur': 'factures_extraites'})
 
+    # Taille et empreinte relevées une fois toutes les écritures terminées, pour la vérification
+    for data in res:
+        data['octets'], data['sha256'] = pdf_utils.empreinte_fichier(Path(data['fichier_extrait']))
     return res
 
+def reecrire_factures(pdf_path: Path, factures: list[tuple[int, int, dict[str, str], Path]]) -> list[tuple[int, str]]:
+    """
+    Recrée seulement les factures données d'un PDF source (voir `reextraction`).
+
+    :param factures: Première page, page qui suit la dernière, données et chemin de chaque facture.
+    :return: La taille et l'empreinte de chaque facture recréée.
+    """
+    with pymupdf.open(pdf_path) as doc, ecriture_asynchrone():
+        for start_page, end_page, data, output_path in factures:
+            ecrire_facture(doc, start_page, end_page, data, output_path)
+            logger.info("Le fichier %s a été extrait.", output_path.name, extra={'compteur': 'factures_extraites'})
+    releves = [pdf_utils.empreinte_fichier(output_path) for *_, output_path in factures]
+    vider_compteurs()
+    return releves
+
 def extract_files_from_zip(zip_file_path, output_folder, to_extract=['consignes.csv', 'facturx.csv']):
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        noms = set(zip_ref.namelist())
         for file_name in to_extract:
-            try:
+            if file_name in noms:
                 zip_ref.extract(file_name, output_folder)
                 logger.info(f"Le fichier {file_name} a été extrait avec succès.")
-            except KeyError:
+                continue
+            # Table envoyée au format Excel : convertie en CSV à l'extraction
+            excel = next((f'{Path(file_name).stem}{ext}' for ext in tableur.EXTENSIONS_EXCEL
+                          if f'{Path(file_name).stem}{ext}' in noms), None)
+            if excel is None:
                 logger.warning(f"Le fichier {file_name} n'a pas été trouvé dans l'archive.")
+                continue
+            zip_ref.extract(excel, output_folder)
+            tableur.lire_excel(Path(output_folder) / excel, cache=False).to_csv(Path(output_folder) / file_name, index=False)
+            logger.info(f"Le fichier {excel} a été extrait et converti en {file_name}.")
 
-def process_zip(
-    input_path: Path,
+def creer_pool(workers: int | None = None) -> Superviseur:
+    """
+    Pool de processus d'extraction supervisé, réutilisable d'un appel à l'autre (voir `api.Atelier`).
+    Les processus reprennent les logs, le mode d'écriture, le dépôt et les budgets configurés à la création du pool.
+    """
+    return supervision.creer_superviseur(workers)
+
+def _split_worker(pdf_path: Path, output_folder: Path,
+                  textes: CacheTextes | None=None) -> tuple[list[dict[str, str]], str | None]:
+    """
+    Exécute `split_pdf_enhanced` dans un processus du pool et renvoie, avec les données
+    extraites, l'empreinte du PDF source si ses textes sont mis en cache.
+    """
+    source = empreinte_source(pdf_path) if textes is not None else None
+    res = split_pdf_enhanced(pdf_path, output_folder, textes, source)
+    vider_compteurs()
+    return res, source
+
+def extraire_pdfs(
+    pdf_files: list[tuple[str | None, Path]],
+    output_dir: Path,
+    workers: int | None = None,
+    progress_callback: Callable[[int, int], None] | None = None,
+    sur_resultat: Callable[[list[dict[str, str]]], None] | None = None,
+    pool: Superviseur | None = None,
+    quarantaine: Quarantaine | None = None,
+    textes: CacheTextes | None = None,
+) -> list[dict[str, str]]:
+    """
+    Découpe une liste de PDFs avec un pool de processus partagé et supervisé : un PDF
+    dont le découpage échoue, ou dépasse son budget de temps ou de mémoire (voir
+    `utils.supervision`), est écarté sans interrompre les autres.
+
+    :param pdf_files: Couples (lot, chemin du PDF) ; le lot, s'il est défini, est reporté dans chaque facture extraite.
+    :param workers: Nombre de processus, `os.cpu_count()` par défaut. Avec 1 et sans budget, le découpage est fait sur place.
+    :param sur_resultat: Fonction appelée avec les factures extraites de chaque PDF, dès qu'il est découpé.
+    :param pool: Pool existant (voir `creer_pool`), conservé après l'appel ; un pool de `workers` processus est créé sinon.
+    :param quarantaine: Quarantaine où déplacer les PDFs sources en échec, qui sont seulement signalés sinon.
+    :param textes: Cache où conserver le texte des pages de chaque PDF, avec l'index des PDFs découpés
+                   (voir `utils.textes`) ; chaque facture extraite a alors l'empreinte de son PDF source.
+    :return: Les données extraites de chaque facture, dans l'ordre de `pdf_files`.
+    """
+    total_files = len(pdf_files)
+    resultats: list[list[dict[str, str]]] = [[] for _ in pdf_files]
+    sources: list[str | None] = [None for _ in pdf_files]
+    # Un seul index des noms pour toute l'extraction : deux factures de même nom extraites
+    # de PDFs différents sont désambiguïsées, dans l'ordre d'arrivée des PDFs découpés
+    noms = file_naming.IndexNoms()
+    ordre: list[int] = []
+    # Les processus du pool écrivent les factures d'un PDF dans un dossier qui lui est propre ;
+    # elles sont renommées à leur arrivée avec les noms attribués par l'index
+    attente = output_dir / '.decoupage'
+
+    def _renommer(res: list[dict[str, str]]):
+        for data, nom in zip(res, nommer_factures(res, noms) if res else []):
+            chemin = output_dir / f'{nom}.pdf'
+            os.replace(data['fichier_extrait'], chemin)
+            data['fichier_extrait'] = str(chemin)
+
+    def _ajouter(index: int, res: list[dict[str, str]], lot: str | None):
+        if lot is not None:
+            for data in res:
+                data['lot'] = lot
+        resultats[index] = res
+        ordre.append(index)
+        if sur_resultat is not None:
+            sur_resultat(res)
+
+    def _ecarter(index: int, raison: str):
+        lot, pdf = pdf_files[index]
+        if quarantaine is None:
+            logger.error(f"Découpage de {pdf.name} abandonné : {raison}")
+            return
+        quarantaine.mettre(f"{lot}/{pdf.name}" if lot else pdf.name, raison, chemin=pdf,
+                           nom=f"{lot}-{pdf.name}" if lot else None)
+
+    # Un budget ne peut être appliqué qu'à un processus de travail
+    if pool is None and (workers == 1 or total_files <= 1) and not supervision.budget_actif():
+        for i, (lot, pdf) in enumerate(pdf_files):
+            try:
+                source = empreinte_source(pdf) if textes is not None else None
+                _ajouter(i, split_pdf_enhanced(pdf, output_dir, textes, source, noms), lot)
+                sources[i] = source
+            except Exception as e:
+                _ecarter(i, f"{type(e).__name__} : {e}")
+            if progress_callback:
+                progress_callback(i + 1, total_files)
+    elif total_files:
+        with nullcontext(pool) if pool is not None else creer_pool(workers) as pool:
+            taches = [(pdf, attente / str(i), textes) for i, (_, pdf) in enumerate(pdf_files)]
+            try:
+                for n, (i, ok, resultat) in enumerate(pool.executer(_split_worker, taches), 1):
+                    if ok:
+                        res, sources[i] = resultat
+                        _renommer(res)
+                        _ajouter(i, res, pdf_files[i][0])
+                    else:
+                        _ecarter(i, resultat)
+                    if progress_callback:
+                        progress_callback(n, total_files)
+            finally:
+                shutil.rmtree(attente, ignore_errors=True)
+    if textes is not None:
+        # Dans l'ordre d'attribution des noms, que la réextraction rejoue
+        textes.ecrire_index([{'source': sources[i], 'lot': pdf_files[i][0], 'fichier_origine': pdf_files[i][1].name}
+                             for i in ordre if sources[i] is not None])
+    factures = [data for res in resultats for data in res]
+    signaler_doublons(factures)
+    return factures
+
+def signaler_doublons(factures: list[dict[str, str]]):
+    """
+    Signale les factures de même nom extraites de PDFs sources différents : le dernier
+    écrit a remplacé les autres. L'index des noms de l'extraction l'évite, c'est un garde-fou.
+    """
+    origines: dict[str, list[str]] = {}
+    for data in factures:
+        origines.setdefault(data['fichier_extrait'], []).append(data['fichier_origine'])
+    for fichier, sources in origines.items():
+        if len(sources) > 1:
+            logger.warning(f"{Path(fichier).name} extrait de {len(sources)} PDFs sources ({', '.join(sources)}) : un seul est conservé.")
+
+def fusionner_tables(tables: dict[str, DataFrame]) -> DataFrame:
+    """
+    Concatène les tables (consignes ou facturx) de plusieurs lots en ajoutant une colonne `lot`.
+    Un groupement présent dans plusieurs lots est signalé, ses lignes seraient fusionnées.
+    """
+    fusion = pd.concat([t.assign(lot=lot) for lot, t in tables.items()], ignore_index=True)
+    if 'groupement' in fusion.columns:
+        lots_par_groupement = fusion.dropna(subset=['groupement']).groupby('groupement')['lot'].nunique()
+        for groupement in lots_par_groupement[lots_par_groupement > 1].index:
+            logger.warning(f"Le groupement {groupement} apparaît dans plusieurs lots.")
+    return fusion
+
+def nommer_lots(zip_paths: list[Path]) -> dict[str, Path]:
+    """
+    Nom de lot de chaque zip : son chemin relatif au dossier commun des zips, sans extension
+    (`sous_dossier/lot_12`). Deux zips de même nom dans des sous-dossiers différents
+    restent ainsi distincts.
+    """
+    if len(zip_paths) <= 1:
+        return {p.stem: p for p in zip_paths}
+    racine = Path(os.path.commonpath([p.resolve().parent for p in zip_paths]))
+    return {p.resolve().relative_to(racine).with_suffix('').as_posix(): p for p in zip_paths}
+
+def extraire_tables(zip_paths: list[Path], output_dir: Path, files_to_extract: list[str]):
+    """
+    Extrait les tables (consignes, facturx) des zips dans `output_dir`. Avec plusieurs zips,
+    les tables de chaque zip sont extraites dans `output_dir/lots/<lot>/` (voir `nommer_lots`)
+    puis fusionnées (voir `fusionner_tables`).
+    """
+    if len(zip_paths) == 1:
+        extract_files_from_zip(zip_paths[0], output_dir, files_to_extract)
+        return
+    lots = nommer_lots(zip_paths)
+    for lot, zip_path in lots.items():
+        extract_files_from_zip(zip_path, output_dir / 'lots' / lot, files_to_extract)
+    for file_name in files_to_extract:
+        tables = {lot: pd.read_csv(output_dir / 'lots' / lot / file_name, dtype=str)
+                  for lot in lots if (output_dir / 'lots' / lot / file_name).exists()}
+        if tables:
+            fusionner_tables(tables).to_csv(output_dir / file_name, index=False)
+
+def process_zips(
+    zip_paths: list[Path],
     output_dir: Path,
     files_to_extract: list[str]|None=None,
     progress_callback: Callable[[int, int], None] | None = None,
+    workers: int | None = None,
+    pdf_dir: Path | None = None,
+    shard: tuple[int, int] | None = None,
+    pool: Superviseur | None = None,
+    quarantaine: Quarantaine | None = None,
+    textes: CacheTextes | None = None,
 ) -> tuple[DataFrame, DataFrame]:
-    
+    """
+    Extrait plusieurs zips en parallèle avec un pool partagé et produit un seul jeu de sorties.
+
+    Avec plusieurs zips, les tables de chaque zip sont extraites dans `output_dir/lots/<lot>/`,
+    puis fusionnées dans `output_dir` avec une colonne `lot` (voir `nommer_lots`),
+    également ajoutée à chaque facture extraite.
+
+    :param pdf_dir: Dossier des PDFs extraits, `output_dir` par défaut.
+    :param shard: Shard `(i, n)` : seuls les PDFs sources attribués à ce shard sont découpés
+                  (voir `repartition`). Les tables sont toujours extraites en entier.
+    :param pool: Pool de processus existant, voir `extraire_pdfs`.
+    :param quarantaine: Quarantaine des PDFs sources en échec, voir `extraire_pdfs`.
+    :param textes: Cache des textes des pages, voir `extraire_pdfs`.
+    :return: Les dataframes des factures extraites et des consignes.
+    """
     if files_to_extract is None:
         files_to_extract = ['consignes.csv', 'facturx.csv']
+    if not zip_paths:
+        raise ValueError("Aucun zip à traiter")
 
-    temp_dir = extract_nested_pdfs(input_path)
-    read = []
+    multi = len(zip_paths) > 1
+    temp_dirs = {lot: extract_nested_pdfs(zip_path) for lot, zip_path in nommer_lots(zip_paths).items()}
     try:
-        pdf_files = list(temp_dir.glob('**/*.pdf'))
-        total_files = len(pdf_files)
-
-        for i, pdf in enumerate(pdf_files, 1):
-            read += split_pdf_enhanced(pdf, output_dir)
-            if progress_callback:
-                progress_callback(i, total_files)
-
-        extract_files_from_zip(input_path, output_dir, files_to_extract)
+        pdf_files = [(lot if multi else None, pdf)
+                     for lot, temp_dir in temp_dirs.items() for pdf in sorted(temp_dir.glob('**/*.pdf'))
+                     if dans_shard(f'{lot}/{pdf.relative_to(temp_dir).as_posix()}', shard)]
+        read = extraire_pdfs(pdf_files, pdf_dir or output_dir, workers, progress_callback, pool=pool,
+                             quarantaine=quarantaine, textes=textes)
+        extraire_tables(zip_paths, output_dir, files_to_extract)
 
         expected : Path = output_dir / files_to_extract[0]
         return pd.DataFrame(read), pd.read_csv(expected, dtype=str)
-    
+
     finally:
-        shutil.rmtree(temp_dir)  # Clean up temp directory
+        for temp_dir in temp_dirs.values():
+            shutil.rmtree(temp_dir)  # Clean up temp directory
+
+def process_zip(
+    input_path: Path,
+    output_dir: Path,
+    files_to_extract: list[str]|None=None,
+    progress_callback: Callable[[int, int], None] | None = None,
+    workers: int | None = None,
+    pdf_dir: Path | None = None,
+    shard: tuple[int, int] | None = None,
+    pool: Superviseur | None = None,
+    quarantaine: Quarantaine | None = None,
+    textes: CacheTextes | None = None,
+) -> tuple[DataFrame, DataFrame]:
+    """
+    Extrait un zip, ou tous les zips d'un dossier (voir `process_zips`).
+    """
+    zip_paths = lister_zips(input_path)
+    if not zip_paths:
+        raise ValueError(f"Aucun zip à traiter dans {input_path}")
+    return process_zips(zip_paths, output_dir, files_to_extract, progress_callback, workers, pdf_dir, shard, pool,
+                        quarantaine, textes)
+
+def lister_zips(input_path: Path) -> list[Path]:
+    """Le zip d'entrée, ou tous les zips d'un dossier d'entrée."""
+    if input_path.is_dir():
+        zip_paths = sorted(input_path.glob('**/*.zip'))
+        logger.info(f"{len(zip_paths)} zips trouvés dans {input_path}.")
+        return zip_paths
+    return [input_path]
 
 def main():
+    from atelier_facture.utils import pedagogie
+
     setup_logger(2)
     zip_path: Path  = Path("~/data/enargia/tests/test_avoir.zip").expanduser()
     output_folder: Path = Path("~/data/enargia/tests/extractioon_test").expanduser()
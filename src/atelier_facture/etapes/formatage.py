@@ -1,15 +1,67 @@
+import os
+import tempfile
 import pandas as pd
 from pandas import DataFrame
 from pathlib import Path
+from typing import Callable, Iterator
 
+import facturix
 from facturix import process_invoices
-def vers_facturx(consignes: DataFrame, facturx: DataFrame, output_dir: Path):
-    
+
+from atelier_facture.utils import logger
+from atelier_facture.utils.profilage import chronometrer
+
+# Durée de l'intégration du XML dans chaque PDF, appelée par facturix pour chaque facture
+facturix.generate_from_file = chronometrer('vers_facturx')(facturix.generate_from_file)
+
+def fusionner_facturx(consignes: DataFrame, facturx: DataFrame) -> DataFrame:
+    """Données Factur-X de chaque facture, avec son PDF (et son membre et groupement) pris dans `consignes`."""
     # Fusionner bt_df avec df en utilisant 'BT-1' et 'id' comme clés
-    merged_df = pd.merge(facturx, consignes[['id', 'pdf']], on='id', how='left')
+    colonnes = ['id', 'pdf'] + [c for c in ['membre', 'groupement'] if c in consignes.columns and c not in facturx.columns]
+    merged_df = pd.merge(facturx, consignes[colonnes].drop_duplicates('id'), on='id', how='left')
     merged_df = merged_df.rename(columns={'id': 'BT-1'})
     # Supprimer la colonne 'id', elle n'est pas nécessaire après la fusion
     #merged_df = merged_df.drop('id', axis=1)
-    print(merged_df)
-    errors = process_invoices(merged_df, output_dir, output_dir, conform_pdf=False)
-    return errors
\ No newline at end of file
+    return merged_df
+
+def vers_facturx(consignes: DataFrame, facturx: DataFrame, output_dir: Path,
+                 taille_lot: int|None=None, sur_lot: Callable[[DataFrame], None]|None=None):
+    """
+    Génère les factures Factur-X.
+
+    :param taille_lot: Si défini, les factures sont traitées par lots de cette taille.
+    :param sur_lot: Fonction appelée avec les lignes de chaque lot une fois ses PDFs produits
+                    (colonnes 'BT-1', 'pdf', 'membre' et 'groupement'), par exemple pour les livrer.
+    :return: Les XMLs invalides.
+    """
+    merged_df = fusionner_facturx(consignes, facturx)
+    if taille_lot is None:
+        logger.debug(f"{len(merged_df)} factures Factur-X à générer")
+        errors = process_invoices(merged_df, output_dir, output_dir, conform_pdf=False)
+        if sur_lot is not None:
+            sur_lot(merged_df)
+        return errors
+
+    errors = []
+    for lot, invalides in generer_par_lots(merged_df, output_dir, taille_lot):
+        errors += invalides
+        if sur_lot is not None:
+            sur_lot(lot)
+    return errors
+
+def generer_par_lots(merged_df: DataFrame, output_dir: Path, taille_lot: int) -> Iterator[tuple[DataFrame, list[Path]]]:
+    """
+    Génère les factures Factur-X de `merged_df` (voir `fusionner_facturx`) par lots de `taille_lot`.
+
+    :return: Itérateur sur chaque lot une fois ses PDFs produits, avec ses XMLs invalides.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for debut in range(0, len(merged_df), taille_lot):
+        lot = merged_df.iloc[debut:debut + taille_lot]
+        # facturix valide tous les XMLs de son dossier de travail : un dossier par lot
+        # évite de revalider les lots précédents
+        with tempfile.TemporaryDirectory(dir=output_dir) as work_dir:
+            invalides = process_invoices(lot, Path(work_dir), output_dir, conform_pdf=False)
+            for xml in Path(work_dir).glob('*.xml'):
+                os.replace(xml, output_dir / xml.name)
+        yield lot, [output_dir / Path(x).name for x in invalides]
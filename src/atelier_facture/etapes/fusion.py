@@ -3,9 +3,99 @@ import pandas as pd
 from pandas import DataFrame
 
 from atelier_facture.utils import file_naming, pdf_utils, export_table_as_pdf
-from atelier_facture.utils import logger
+from atelier_facture.utils import logger, vider_compteurs
+from atelier_facture.utils.ecriture import ecriture_asynchrone
+from atelier_facture.utils.supervision import Quarantaine, Superviseur
 
-def fusion_groupes(df: DataFrame, output_dir: Path):
+# Relevés des PDFs enrichis pour la vérification finale (voir `etapes.verification`)
+COLONNES_INDEX = ['pages', 'pages_tableau', 'octets', 'sha256']
+# Colonnes de suivi, absentes du tableau des PDLs
+COLONNES_META = ['fichier_extrait', 'pdf', 'type', 'date', 'lot'] + COLONNES_INDEX
+# Au-delà de ce nombre de PDLs, un groupement est assemblé par morceaux, en mémoire bornée
+SEUIL_GRAND_GROUPEMENT = 500
+
+def enrichir_groupement(group_meta: dict, pdl: DataFrame | None, enhanced_pdf: Path, table_name: Path,
+                        seuil_grand_groupement: int=SEUIL_GRAND_GROUPEMENT) -> dict:
+    """
+    Crée le PDF enrichi d'un groupement : facture mono PDL complétée de sa ligne de
+    regroupement, ou facture de groupement suivie du tableau et des factures de ses PDLs.
+
+    :param pdl: Lignes des PDLs du groupement, None pour un groupement mono.
+    :return: Les relevés du PDF enrichi (pages, et pages du tableau pour un groupement).
+    """
+    # Création du PDF enrichi pour le groupement Mono
+    if pdl is None:
+        transformations = [
+            (pdf_utils.ajouter_ligne_regroupement_doc, group_meta['groupement'])
+            # Add more transformations as needed
+        ]
+        return {'pages': pdf_utils.apply_pdf_transformations(group_meta['fichier_extrait'], enhanced_pdf, transformations)}
+
+    # Création du PDF enrichi pour le groupement
+    # Ajouter la facture de groupement 
+    to_concat = [group_meta['fichier_extrait']]
+
+    # On crée le pdf tableau
+    export_table_as_pdf(pdl.drop(columns=COLONNES_META, errors='ignore'), table_name)
+
+    # On ajoute le tableau crée  
+    to_concat += [table_name]
+    # Liste des PRM pour ce groupement (exclure les valeurs manquantes)
+    # Filtrer les NaN et afficher un avertissement pour chaque NaN
+    for index, row in pdl.iterrows():
+        fichier = row['fichier_extrait']
+        if pd.isna(fichier):
+            logger.warning(f"Pas de 'fichier_extrait' {row['id']} : fichier enrichi groupement {row['groupement']} créé sans.")
+        else:
+            to_concat.append(fichier)
+
+    # Fichier de groupement enrichi 
+    metadata = {'title': f"Facture {group_meta['id']}"}
+    if len(pdl) > seuil_grand_groupement:
+        logger.info(f"Groupement {group_meta['groupement']} : {len(pdl)} PDLs, assemblé par morceaux.")
+        pages = pdf_utils.concat_pdfs_par_morceaux(to_concat, enhanced_pdf, metadata=metadata)
+    else:
+        # Compressé à l'enregistrement : le PDF enrichi n'est écrit qu'une fois
+        pages = pdf_utils.concat_pdfs(to_concat, enhanced_pdf, metadata=metadata, compresser=True)
+    return {'pages': sum(pages), 'pages_tableau': pages[1]}
+
+def _enrichir_worker(*args) -> dict:
+    """`enrichir_groupement` dans un processus supervisé, avec la taille et l'empreinte du PDF enrichi."""
+    releve = enrichir_groupement(*args)
+    releve['octets'], releve['sha256'] = pdf_utils.empreinte_fichier(args[2])
+    vider_compteurs()
+    return releve
+
+def _composer_noms(metas: DataFrame, format_type: str) -> tuple[pd.Series, dict[str, str]]:
+    """
+    Noms de fichier des groupements de `metas` (indexé par groupement), composés en un appel ;
+    si une ligne est invalide, composés groupement par groupement pour écarter les seuls invalides.
+
+    :return: Les noms des groupements valides, et la raison de l'échec de chaque groupement invalide.
+    """
+    try:
+        return file_naming.compose_filenames(metas, format_type), {}
+    except ValueError:
+        pass
+    noms, echecs = {}, {}
+    for groupement in metas.index:
+        try:
+            noms[groupement] = file_naming.compose_filenames(metas.loc[[groupement]], format_type).iloc[0]
+        except ValueError as e:
+            echecs[groupement] = f"Nom de fichier : {e}"
+    return pd.Series(noms, index=metas.index, dtype=object), echecs
+
+def fusion_groupes(df: DataFrame, output_dir: Path, seuil_grand_groupement: int=SEUIL_GRAND_GROUPEMENT,
+                   superviseur: Superviseur | None=None, quarantaine: Quarantaine | None=None):
+    """
+    :param seuil_grand_groupement: Nombre de PDLs au-delà duquel le PDF d'un groupement est
+                                   assemblé et compressé par morceaux (voir `pdf_utils.concat_pdfs_par_morceaux`).
+    :param superviseur: Pool supervisé (voir `utils.supervision`) où créer les PDFs enrichis, en parallèle
+                        et avec un budget par groupement (pondéré par son nombre de PDLs) ; dans le
+                        processus courant sinon.
+    :param quarantaine: Quarantaine où signaler les groupements en échec, qui sont seulement journalisés sinon.
+                        Leurs factures restent sans PDF enrichi.
+    """
     df = df.copy()
     # Supprimer les lignes où 'id' est NaN ou une chaîne 'nan'/'NaN'
     df = df[~df['id'].astype(str).str.strip().isin([None, 'nan', 'NaN'])]
@@ -15,58 +105,72 @@ def fusion_groupes(df: DataFrame, output_dir: Path):
     if 'pdf' not in df.columns:
         df['pdf'] = ''
 
-    meta_columns = ['fichier_extrait', 'pdf', 'type', 'date']
     # Grouper par 'groupement'
     grouped = df.groupby('groupement')
-    
-    # Parcourir chaque groupement
+
+    # Noms des PDFs enrichis et des tableaux de tous les groupements, composés en un appel
+    # et désambiguïsés avant toute écriture ; un groupement aux données invalides est en échec
+    metas = df.dropna(subset=['groupement']).drop_duplicates('groupement').set_index('groupement', drop=False)
+    composes, echecs_noms = _composer_noms(metas, 'groupement')
+    tableaux, echecs_tableaux = _composer_noms(metas, 'table')
+    invalides = {**echecs_tableaux, **echecs_noms}
+    valides = ~metas.index.isin(list(invalides))
+    noms = file_naming.IndexNoms()
+    noms_enrichis = noms.attribuer(composes[valides])
+    noms_tableaux = noms.attribuer(tableaux[valides])
+
+    taches = []
+    groupements: dict[str, str] = {}
+    echecs: dict[str, str] = {}
     for group_name, group_data in grouped:
         group_meta = group_data.iloc[0].to_dict()
-        
-        enhanced_pdf = output_dir / f"{file_naming.compose_filename(group_meta, format_type='groupement')}.pdf"
-        # Création du PDF enrichi pour le groupement Mono
-        if group_meta['type'] == 'mono':
-            
-            transformations = [
-                (pdf_utils.ajouter_ligne_regroupement_doc, group_meta['groupement'])
-                # Add more transformations as needed
-            ]
-            pdf_utils.apply_pdf_transformations(group_meta['fichier_extrait'], enhanced_pdf, transformations)
-        
-        # Création du PDF enrichi pour le groupement
+        groupements[group_meta['id']] = group_name
+        if group_name in invalides:
+            echecs[group_meta['id']] = invalides[group_name]
+            continue
+        # Extraction des lignes pdl 
+        pdl = None if group_meta['type'] == 'mono' else group_data[group_data['type'] == 'pdl']
+        taches.append((group_meta, pdl, output_dir / f"{noms_enrichis[group_name]}.pdf",
+                       output_dir / f"{noms_tableaux[group_name]}.pdf", seuil_grand_groupement))
+
+    fichiers = {tache[0]['id']: tache[2] for tache in taches}
+    releves: dict[str, dict] = {}
+    if superviseur is None:
+        # Les PDFs enrichis sont écrits en arrière-plan pendant la création des suivants
+        with ecriture_asynchrone():
+            for tache in taches:
+                try:
+                    releves[tache[0]['id']] = enrichir_groupement(*tache)
+                except Exception as e:
+                    echecs[tache[0]['id']] = f"{type(e).__name__} : {e}"
+        # Taille et empreinte relevées une fois toutes les écritures terminées
+        for id_, releve in releves.items():
+            releve['octets'], releve['sha256'] = pdf_utils.empreinte_fichier(fichiers[id_])
+    else:
+        poids = [1 + (len(pdl) / 100 if pdl is not None else 0) for _, pdl, *_ in taches]
+        for i, ok, resultat in superviseur.executer(_enrichir_worker, taches, poids):
+            if ok:
+                releves[taches[i][0]['id']] = resultat
+            else:
+                echecs[taches[i][0]['id']] = resultat
+
+    for id_, raison in echecs.items():
+        if quarantaine is None:
+            logger.error(f"Fusion du groupement {groupements[id_]} abandonnée : {raison}")
         else:
-            # Ajouter la facture de groupement 
-            to_concat = [group_meta['fichier_extrait']]
-            
-            # Extraction des lignes pdl 
-            pdl = group_data[group_data['type'] == 'pdl']
-
-            # On crée le pdf tableau
-            table_name = output_dir / f"{file_naming.compose_filename(group_meta, format_type='table')}.pdf"
-            export_table_as_pdf(pdl.drop(columns=meta_columns), table_name)
-
-
-            # On ajoute le tableau crée  
-            to_concat += [table_name]
-            # Liste des PRM pour ce groupement (exclure les valeurs manquantes)
-            # Filtrer les NaN et afficher un avertissement pour chaque NaN
-            for index, row in pdl.iterrows():
-                fichier = row['fichier_extrait']
-                if pd.isna(fichier):
-                    logger.warning(f"Pas de 'fichier_extrait' {row['id']} : fichier enrichi groupement {row['groupement']} créé sans.")
-                else:
-                    to_concat.append(fichier)
-
-            # Fichier de groupement enrichi 
-            pdf_utils.concat_pdfs(to_concat, enhanced_pdf, metadata={'title': f"Facture {group_meta['id']}"})
-            # compressed_pdf = enhanced_pdf.with_name(f"{enhanced_pdf.stem}_compressed{enhanced_pdf.suffix}")
-            # compress_pdf(enhanced_pdf, compressed_pdf)
-            pdf_utils.compress_pdf_inplace(enhanced_pdf)
-        
-        # Mettre à jour la colonne 'fichier_enrichi' pour ce groupement
-        df.loc[df['id'] == group_meta['id'], 'pdf'] = enhanced_pdf
+            quarantaine.mettre(f"groupement {groupements[id_]}", raison)
+
+    # Mettre à jour la colonne 'pdf' pour les groupements créés
+    enrichis = df['id'].map({id_: fichiers[id_] for id_ in releves})
+    df['pdf'] = enrichis.where(enrichis.notna(), df['pdf'])
+    for colonne in COLONNES_INDEX:
+        df[colonne] = df['id'].map({id_: r.get(colonne) for id_, r in releves.items()})
+        if colonne != 'sha256':
+            df[colonne] = df[colonne].astype('Int64')
 
     # Copie des valeurs de 'fichier_extrait' dans 'fichier_enrichi' si non définies
     mask_non_defini = df['pdf'].isin([False, pd.NA, None, ''])
     df.loc[mask_non_defini, 'pdf'] = df.loc[mask_non_defini, 'fichier_extrait']
-    return df
\ No newline at end of file
+    # Factures des groupements en échec : sans PDF, comme une facture non extraite
+    df.loc[df['groupement'].isin([groupements[id_] for id_ in echecs]), 'pdf'] = None
+    return df
@@ -0,0 +1,125 @@
+"""
+Empaquetage des factures Factur-X finales dans des zips de livraison, au fil de leur production.
+"""
+import csv
+import re
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+from pandas import DataFrame
+
+from atelier_facture.utils import logger
+
+PARTITIONS = ['membre', 'groupement', 'unique']
+COLONNES_MANIFESTE = ['zip', 'fichier', 'id', 'membre', 'groupement', 'octets']
+
+def _texte(valeur) -> str:
+    """Valeur d'une cellule en chaîne, vide pour None et NaN."""
+    return '' if valeur is None or valeur != valeur else str(valeur).strip()
+
+def _nom_partition(valeur: str) -> str:
+    """Nom de zip sûr pour une valeur de partition (membre ou groupement)."""
+    return re.sub(r'[^\w.-]+', '_', valeur).strip('_') or 'sans_partition'
+
+class Empaqueteur:
+    """
+    Écrit les PDFs dans des zips de livraison, un par valeur de partition et découpés
+    au-delà d'une taille maximale, et tient le manifeste CSV dans la même passe.
+
+    Les PDFs sont déjà compressés : ils sont stockés sans recompression (ZIP_STORED),
+    l'empaquetage coûte donc une simple écriture séquentielle.
+
+    Les zips d'une livraison précédente dans `dossier` sont supprimés à l'ouverture :
+    une nouvelle exécution refait la livraison entière.
+
+    :param dossier: Dossier des zips de livraison et du manifeste.
+    :param partition: 'membre', 'groupement' ou 'unique' (un seul zip).
+    :param taille_max: Taille maximale d'un zip en octets ; au-delà, une nouvelle partie est ouverte.
+    :param max_ouverts: Nombre maximal de zips gardés ouverts simultanément.
+    """
+    def __init__(self, dossier: Path, partition: str='membre', taille_max: int|None=None, max_ouverts: int=32):
+        if partition not in PARTITIONS:
+            raise ValueError(f"Partition inconnue : {partition}. Utiliser {', '.join(PARTITIONS)}.")
+        self.dossier = dossier
+        self.partition = partition
+        self.taille_max = taille_max
+        self.max_ouverts = max_ouverts
+        # clé de partition -> [numéro de partie, taille de la partie en cours]
+        self.parties: dict[str, list[int]] = {}
+        self.ouverts: OrderedDict[Path, zipfile.ZipFile] = OrderedDict()
+
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        for ancien in self.dossier.glob('*.zip'):
+            ancien.unlink()
+        self._manifeste_fichier = open(self.dossier / 'manifeste.csv', 'w', newline='', encoding='utf-8')
+        self._manifeste = csv.DictWriter(self._manifeste_fichier, fieldnames=COLONNES_MANIFESTE)
+        self._manifeste.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fermer()
+
+    def _chemin_zip(self, cle: str, taille: int) -> Path:
+        partie = self.parties.setdefault(cle, [1, 0])
+        if self.taille_max is not None and partie[1] > 0 and partie[1] + taille > self.taille_max:
+            self._fermer_zip(self._nom_zip(cle, partie[0]))
+            partie[0] += 1
+            partie[1] = 0
+        partie[1] += taille
+        return self._nom_zip(cle, partie[0])
+
+    def _nom_zip(self, cle: str, numero: int) -> Path:
+        if self.taille_max is None:
+            return self.dossier / f'{cle}.zip'
+        return self.dossier / f'{cle}_{numero:03d}.zip'
+
+    def _zip(self, chemin: Path) -> zipfile.ZipFile:
+        if chemin in self.ouverts:
+            self.ouverts.move_to_end(chemin)
+            return self.ouverts[chemin]
+        if len(self.ouverts) >= self.max_ouverts:
+            _, ancien = self.ouverts.popitem(last=False)
+            ancien.close()
+        # Un zip existant a été écrit par cette livraison, refermé faute de place : il est rouvert en ajout
+        self.ouverts[chemin] = zipfile.ZipFile(chemin, 'a' if chemin.exists() else 'w')
+        return self.ouverts[chemin]
+
+    def _fermer_zip(self, chemin: Path):
+        if chemin in self.ouverts:
+            self.ouverts.pop(chemin).close()
+
+    def ajouter(self, pdf: Path, id: str='', membre: str='', groupement: str=''):
+        """Ajoute un PDF à son zip de livraison et l'inscrit au manifeste."""
+        taille = pdf.stat().st_size
+        valeur = {'membre': membre, 'groupement': groupement, 'unique': 'livraison'}[self.partition]
+        chemin_zip = self._chemin_zip(_nom_partition(valeur), taille)
+        self._zip(chemin_zip).write(pdf, arcname=pdf.name, compress_type=zipfile.ZIP_STORED)
+        self._manifeste.writerow({'zip': chemin_zip.name, 'fichier': pdf.name, 'id': id,
+                                  'membre': membre, 'groupement': groupement, 'octets': taille})
+
+    def ajouter_lot(self, lot: DataFrame, facturx_dir: Path):
+        """
+        Ajoute les factures d'un lot traité par `vers_facturx`.
+
+        :param lot: Lignes du lot, avec les colonnes 'BT-1', 'pdf' et si possible 'membre' et 'groupement'.
+        :param facturx_dir: Dossier des PDFs Factur-X produits.
+        """
+        for row in lot.to_dict('records'):
+            if not _texte(row.get('pdf')):
+                continue
+            pdf = facturx_dir / Path(row['pdf']).name
+            if not pdf.exists():
+                logger.warning(f"Facture Factur-X absente, non livrée : {pdf.name}")
+                continue
+            self.ajouter(pdf, id=_texte(row.get('BT-1')),
+                         membre=_texte(row.get('membre')), groupement=_texte(row.get('groupement')))
+        self._manifeste_fichier.flush()
+
+    def fermer(self):
+        for zip_file in self.ouverts.values():
+            zip_file.close()
+        self.ouverts.clear()
+        self._manifeste_fichier.close()
@@ -0,0 +1,198 @@
+"""
+Vérification finale d'un atelier, sans réouvrir les PDFs : elle s'appuie sur les
+relevés faits pendant le traitement (pages, taille et empreinte de chaque PDF extrait
+et enrichi, dans `extrait.csv` et `enrichis.csv`), sur la liste des fichiers produits
+et sur l'entête des XMLs Factur-X. Les lectures de fichiers sont faites en parallèle.
+
+Contrôles :
+- `facturx` : chaque facture attendue (`facturx_consolidees.csv`) a son PDF et son XML Factur-X ;
+- `pages` : un PDF de groupement enrichi a autant de pages que son tableau, sa facture de
+  groupement et les factures de ses PDLs réunis ;
+- `xml` : le numéro de facture (BT-1) du XML est celui du nom de fichier ;
+- `fichiers` : les PDFs extraits et enrichis ont la taille relevée à leur écriture, et
+  avec `empreintes=True` la même empreinte SHA-256 (relue, donc plus lent).
+
+Le rapport est un dictionnaire écrit en JSON : pour chaque contrôle, le nombre
+d'éléments vérifiés et la liste des anomalies.
+"""
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from xml.etree.ElementTree import ParseError, iterparse
+
+import pandas as pd
+from pandas import DataFrame
+
+from atelier_facture.utils import logger
+from atelier_facture.utils.depot import sha256_fichier
+from atelier_facture.utils.file_naming import interpret_filename
+
+_NS_RSM = '{urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100}'
+_NS_RAM = '{urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100}'
+# BT-1 : premier ID de l'entête du document, hors commentaires
+_ENTETE = re.compile(rb'<(?:\w+:)?ExchangedDocument>(.*?)</(?:\w+:)?ExchangedDocument>', re.S)
+_COMMENTAIRE = re.compile(rb'<!--.*?-->', re.S)
+_ID = re.compile(rb'<(?:\w+:)?ID(?:\s[^>]*)?>\s*([^<]*?)\s*</')
+# Anomalies détaillées par contrôle dans les logs, toutes dans le rapport
+ANOMALIES_AFFICHEES = 5
+# Fichiers lus par tâche du pool : une tâche par fichier coûterait plus que la lecture
+TAILLE_TACHE = 500
+
+def _nom(chemin) -> str | None:
+    """Nom de fichier d'un chemin de table, indépendant de l'emplacement de l'atelier."""
+    return os.path.basename(chemin) if isinstance(chemin, str) and chemin else None
+
+def _en_parallele(pool: ThreadPoolExecutor, controle, elements: list) -> list[dict]:
+    """Anomalies relevées par `controle` sur chaque élément, par tâches de `TAILLE_TACHE` éléments."""
+    def lot(debut: int) -> list[dict]:
+        return [a for e in elements[debut:debut + TAILLE_TACHE] if (a := controle(e)) is not None]
+    return [a for anomalies in pool.map(lot, range(0, len(elements), TAILLE_TACHE)) for a in anomalies]
+
+def _entier(valeur) -> int | None:
+    return None if pd.isna(valeur) else int(float(valeur))
+
+def _id_xml(chemin: str) -> str | None:
+    """
+    BT-1 d'un XML Factur-X, lu dans l'entête du document. Une recherche dans le texte
+    suffit pour les XMLs produits par facturix (dix fois plus rapide qu'une analyse XML) ;
+    l'analyse complète reste le recours pour un entête de forme inattendue.
+    """
+    with open(chemin, 'rb') as f:
+        entete = _ENTETE.search(f.read())
+    if entete is not None and (id_facture := _ID.search(_COMMENTAIRE.sub(b'', entete.group(1)))) is not None:
+        return id_facture.group(1).decode()
+    for _, element in iterparse(chemin):
+        if element.tag == f'{_NS_RSM}ExchangedDocument':
+            id_facture = element.find(f'{_NS_RAM}ID')
+            return id_facture.text.strip() if id_facture is not None and id_facture.text else None
+    return None
+
+def _sha256(chemin: str) -> str:
+    with open(chemin, 'rb') as f:
+        return sha256_fichier(f)
+
+def _controle(verifies: int, anomalies: list[dict], ignore: str | None=None) -> dict:
+    controle = {'verifies': verifies, 'anomalies': anomalies}
+    if ignore is not None:
+        controle['ignore'] = ignore
+    return controle
+
+def verifier_facturx(enrichis: DataFrame, facturx: DataFrame, produits: set[str]) -> dict:
+    pdfs = enrichis.dropna(subset=['pdf']).drop_duplicates('id').set_index('id')['pdf'].map(_nom)
+    attendues = pd.Series(facturx['id'].dropna().unique())
+    noms = attendues.map(pdfs)
+    anomalies = [{'id': i, 'probleme': "aucun PDF enrichi"} for i in attendues[noms.isna()]]
+    for id_facture, nom in zip(attendues[noms.notna()], noms.dropna()):
+        for fichier in (nom, f'{os.path.splitext(nom)[0]}.xml'):
+            if fichier not in produits:
+                anomalies.append({'id': id_facture, 'fichier': fichier, 'probleme': "Factur-X absent"})
+    return _controle(len(attendues), anomalies)
+
+def verifier_pages(extrait: DataFrame, enrichis: DataFrame) -> dict:
+    if 'pages' not in extrait.columns or 'pages_tableau' not in enrichis.columns:
+        return _controle(0, [], ignore="pages non relevées (atelier traité par une version antérieure)")
+    pages_extrait = dict(zip(extrait['fichier_extrait'].map(_nom), extrait['pages'].map(_entier)))
+    groupements = enrichis[enrichis['pages_tableau'].notna()]
+    membres = enrichis[enrichis['groupement'].isin(groupements['groupement']) & enrichis['type'].isin(['groupement', 'pdl'])]
+    anomalies = []
+    for ligne in membres[membres['fichier_extrait'].isna()].itertuples():
+        anomalies.append({'id': ligne.id, 'groupement': ligne.groupement, 'probleme': "facture sans PDF extrait"})
+    pages_membres = membres['fichier_extrait'].map(_nom).map(pages_extrait)
+    attendues = pages_membres.groupby(membres['groupement']).sum()
+    for ligne in groupements.itertuples():
+        attendu = _entier(ligne.pages_tableau) + int(attendues.get(ligne.groupement, 0))
+        if _entier(ligne.pages) != attendu:
+            anomalies.append({'id': ligne.id, 'groupement': ligne.groupement, 'fichier': _nom(ligne.pdf),
+                              'probleme': f"{_entier(ligne.pages)} pages au lieu de {attendu}"})
+    return _controle(len(groupements), anomalies)
+
+def verifier_xml(facturx_dir: Path, xmls: list[str], pool: ThreadPoolExecutor) -> dict:
+    def lire(nom: str) -> dict | None:
+        try:
+            attendu = interpret_filename(nom)['id']
+        except ValueError:
+            return {'fichier': nom, 'probleme': "nom de fichier non reconnu"}
+        try:
+            lu = _id_xml(os.path.join(facturx_dir, nom))
+        except ParseError as e:
+            return {'fichier': nom, 'probleme': f"XML illisible : {e}"}
+        if lu != attendu:
+            return {'fichier': nom, 'id': attendu, 'probleme': f"BT-1 du XML : {lu}"}
+        return None
+    return _controle(len(xmls), _en_parallele(pool, lire, xmls))
+
+def verifier_fichiers(releves: DataFrame, pool: ThreadPoolExecutor, empreintes: bool=False) -> dict:
+    """
+    :param releves: Colonnes 'fichier' (chemin), 'octets' et 'sha256', relevées à l'écriture.
+    """
+    def lire(releve: tuple) -> dict | None:
+        fichier, octets, sha256 = releve
+        try:
+            taille = os.stat(fichier).st_size
+        except FileNotFoundError:
+            return {'fichier': os.path.basename(fichier), 'probleme': "absent"}
+        if taille != _entier(octets):
+            return {'fichier': os.path.basename(fichier), 'probleme': f"{taille} octets au lieu de {_entier(octets)}"}
+        if empreintes and _sha256(fichier) != sha256:
+            return {'fichier': os.path.basename(fichier), 'probleme': "empreinte différente"}
+        return None
+    lignes = list(releves[['fichier', 'octets', 'sha256']].itertuples(index=False, name=None))
+    return _controle(len(lignes), _en_parallele(pool, lire, lignes))
+
+def _releves(table: DataFrame, colonne: str, dossier: Path) -> DataFrame:
+    """Relevés d'une table, les fichiers retrouvés par leur nom dans `dossier` (les chemins des tables sont relatifs)."""
+    releves = table[[colonne, 'octets', 'sha256']].dropna(subset=[colonne, 'octets'])
+    return DataFrame({'fichier': [os.path.join(dossier, _nom(c)) for c in releves[colonne]],
+                      'octets': releves['octets'].to_numpy(), 'sha256': releves['sha256'].to_numpy()})
+
+def verifier(extrait: DataFrame, enrichis: DataFrame, facturx: DataFrame, facturx_dir: Path,
+             extrait_dir: Path | None=None, enrichi_dir: Path | None=None,
+             empreintes: bool=False, workers: int | None=None) -> dict:
+    """
+    Vérifie les sorties d'un atelier (voir le module).
+
+    :param extrait_dir: Dossier des PDFs extraits, None s'ils n'ont pas été conservés : leur contrôle est ignoré.
+    :param enrichi_dir: Dossier des PDFs enrichis, idem.
+    :param empreintes: Recalcule l'empreinte des PDFs intermédiaires en plus de leur taille.
+    :param workers: Nombre de threads de lecture, 32 au plus par défaut.
+    :return: Le rapport de vérification.
+    """
+    produits = {e.name for e in os.scandir(facturx_dir)} if facturx_dir.is_dir() else set()
+    xmls = sorted(n for n in produits if n.endswith('.xml'))
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4)) as pool:
+        controles = {
+            'facturx': verifier_facturx(enrichis, facturx, produits),
+            'pages': verifier_pages(extrait, enrichis),
+            'xml': verifier_xml(facturx_dir, xmls, pool),
+        }
+        if extrait_dir is None or enrichi_dir is None:
+            controles['fichiers'] = _controle(0, [], ignore="PDFs intermédiaires non conservés")
+        elif 'octets' not in extrait.columns or 'octets' not in enrichis.columns:
+            controles['fichiers'] = _controle(0, [], ignore="tailles non relevées (atelier traité par une version antérieure)")
+        else:
+            releves = pd.concat([_releves(extrait, 'fichier_extrait', extrait_dir),
+                                 _releves(enrichis, 'pdf', enrichi_dir)], ignore_index=True)
+            controles['fichiers'] = verifier_fichiers(releves, pool, empreintes)
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'ok': not any(c['anomalies'] for c in controles.values()),
+        'anomalies': sum(len(c['anomalies']) for c in controles.values()),
+        'controles': controles,
+    }
+
+def ecrire_rapport(rapport: dict, chemin: Path):
+    """Écrit le rapport en JSON et en résume le contenu dans les logs."""
+    chemin.write_text(json.dumps(rapport, ensure_ascii=False, indent=2), encoding='utf-8')
+    for nom, controle in rapport['controles'].items():
+        if 'ignore' in controle:
+            logger.info(f"Vérification {nom} : ignorée, {controle['ignore']}.")
+            continue
+        anomalies = controle['anomalies']
+        logger.info(f"Vérification {nom} : {controle['verifies']} vérifiés, {len(anomalies)} anomalies.")
+        for anomalie in anomalies[:ANOMALIES_AFFICHEES]:
+            logger.error(f"Vérification {nom} : {anomalie}")
+    if not rapport['ok']:
+        logger.error(f"{rapport['anomalies']} anomalies, détail dans {chemin}")
@@ -0,0 +1,261 @@
+"""
+Exécution en flux : les étapes se chevauchent au lieu de s'attendre.
+
+Les consignes sont lues avant le découpage des PDFs, on sait donc quelles factures
+attend chaque groupement. Dès que toutes ses factures sont extraites, un groupement
+est consolidé et fusionné dans le processus principal, pendant que le pool continue
+l'extraction ; ses PDFs enrichis sont transmis à la génération Factur-X par lots de
+`taille_lot` factures.
+
+Les fichiers produits sont ceux de l'exécution par étapes, et les marqueurs des étapes
+de production sont écrits en fin de traitement : une reprise (`--from-stage`) fonctionne
+comme après une exécution par étapes. La vérification reste à faire, comme une étape.
+"""
+import shutil
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+from pandas import DataFrame
+
+from atelier_facture.etapes import consolidation, extraction, formatage, fusion
+from atelier_facture.orchestrateur import ETAPES, ETAPES_PRODUCTION, Contexte, importer_consignes, marquer_volatils, ouvrir_livraison
+from atelier_facture.utils import logger, supervision, vider_compteurs
+from atelier_facture.utils.profilage import profileur
+
+COLONNES_EXTRAIT = ['id', 'date', 'pdl', 'groupement', 'membre', 'fichier_extrait']
+# Petits lots : les premières factures sont livrées tôt, pour un surcoût de facturix négligeable
+TAILLE_LOT_FLUX = 20
+
+def _vide(valeur) -> bool:
+    return valeur is None or valeur != valeur or str(valeur).strip() in ('', 'nan')
+
+@dataclass
+class Unite:
+    """
+    Factures traitées ensemble : un groupement, ou une facture hors groupement.
+
+    :param attendus: Ids des factures attendues, connus par les consignes.
+    :param attend_groupement: Vrai si la facture de groupement est attendue ; son id
+                              n'est pas dans les consignes, elle est reconnue à son groupement.
+    """
+    cle: str
+    consignes: DataFrame
+    attendus: set[str]
+    attend_groupement: bool
+    groupement: str | None = None
+    recus: set[str] = field(default_factory=set)
+    groupement_recu: bool = False
+    extraits: list[dict[str, str]] = field(default_factory=list)
+    traitee: bool = False
+
+    def complete(self) -> bool:
+        return self.attendus <= self.recus and (self.groupement_recu or not self.attend_groupement)
+
+class Flux:
+    """
+    Traitement en flux d'un atelier.
+
+    :param taille_lot: Nombre de factures par appel à la génération Factur-X.
+    """
+    def __init__(self, ctx: Contexte, consignes: DataFrame, facturx: DataFrame, taille_lot: int=TAILLE_LOT_FLUX):
+        self.ctx = ctx
+        self.taille_lot = taille_lot
+        self.facturx = facturx
+        self.unites: dict[str, Unite] = {}
+        self.unite_par_id: dict[str, Unite] = {}
+        self.unite_par_groupement: dict[str, Unite] = {}
+        self.extrait: list[dict[str, str]] = []
+        self.consolidees: list[DataFrame] = []
+        self.enrichis: list[DataFrame] = []
+        self.facturx_consolidees: list[DataFrame] = []
+        # Lots en attente de génération Factur-X
+        self.en_attente: list[tuple[DataFrame, DataFrame]] = []
+        self.nb_en_attente = 0
+        self.debut = time.perf_counter()
+        self.premiere_livraison: float | None = None
+        self.empaqueteur = None
+        # Pool supervisé de la fusion, distinct de celui de l'extraction dont les résultats
+        # déclenchent la fusion ; seulement si un budget par document est configuré
+        self.superviseur = None
+        self.quarantaine = ctx.quarantaine()
+        self._preparer(consignes)
+
+    def _preparer(self, consignes: DataFrame):
+        consignes = consignes.copy()
+        consignes['id'] = consignes['id'].astype(str).apply(consolidation.normaliser_id)
+        consignes.loc[consignes['id'] == 'nan', 'id'] = None
+        types = consolidation.detection_type(consignes.fillna({'id': ''}))['type']
+        for index, row in consignes.iterrows():
+            groupement = None if _vide(row.get('groupement')) else row['groupement']
+            cle = f'groupement:{groupement}' if groupement is not None else f'id:{row["id"]}'
+            unite = self.unites.get(cle)
+            if unite is None:
+                unite = self.unites[cle] = Unite(cle, consignes.iloc[0:0], set(), False, groupement)
+                if groupement is not None:
+                    self.unite_par_groupement[groupement] = unite
+            if types[index] == 'groupement' or _vide(row['id']):
+                unite.attend_groupement = True
+            else:
+                unite.attendus.add(row['id'])
+                self.unite_par_id[row['id']] = unite
+        for unite in self.unites.values():
+            if unite.groupement is not None:
+                unite.consignes = consignes[consignes['groupement'] == unite.groupement]
+            else:
+                unite.consignes = consignes[consignes['id'].isin(unite.attendus)]
+        logger.info(f"Flux : {len(self.unites)} groupements et factures isolées attendus.")
+
+    # ======================= Réception des factures extraites ===============
+    def recevoir(self, factures: list[dict[str, str]]):
+        """Enregistre les factures extraites d'un PDF et traite les unités devenues complètes."""
+        a_traiter = []
+        for data in factures:
+            self.extrait.append(data)
+            unites = []
+            if data['id'] in self.unite_par_id:
+                unites.append(self.unite_par_id[data['id']])
+            groupement = data.get('groupement')
+            if groupement in self.unite_par_groupement:
+                unite = self.unite_par_groupement[groupement]
+                if _vide(data.get('pdl')):
+                    unite.groupement_recu = True
+                unites.append(unite)
+            for unite in _uniques(unites):
+                unite.recus.add(data['id'])
+                unite.extraits.append(data)
+                if not unite.traitee and unite.complete():
+                    a_traiter.append(unite)
+        for unite in _uniques(a_traiter):
+            self._traiter(unite)
+
+    def _traiter(self, unite: Unite):
+        """Traite une unité ; un échec la met en quarantaine sans interrompre le flux."""
+        unite.traitee = True
+        try:
+            self._consolider(unite)
+        except Exception as e:
+            element = f"groupement {unite.groupement}" if unite.groupement is not None else f"facture {unite.cle[3:]}"
+            self.quarantaine.mettre(element, f"{type(e).__name__} : {e}")
+        if self.nb_en_attente >= self.taille_lot:
+            self._generer()
+
+    def _consolider(self, unite: Unite):
+        extrait = pd.DataFrame(unite.extraits)
+        for colonne in COLONNES_EXTRAIT:
+            if colonne not in extrait.columns:
+                extrait[colonne] = None
+        consolidees = consolidation.consolidation_consignes(extrait, unite.consignes.copy(), manquants=None)
+        enrichis = fusion.fusion_groupes(consolidees, self.ctx.enrichi_dir, superviseur=self.superviseur,
+                                         quarantaine=self.quarantaine)
+        enrichis['pdf'] = enrichis['pdf'].map(lambda p: str(p) if isinstance(p, Path) else p)
+
+        ids = set(consolidees['id'].dropna())
+        selection = self.facturx['id'].isin(ids)
+        if unite.groupement is not None and 'groupement' in self.facturx.columns:
+            selection |= self.facturx['groupement'] == unite.groupement
+        facturx = consolidation.consolidation_facturx(consolidees, self.facturx[selection].copy())
+
+        self.consolidees.append(consolidees)
+        self.enrichis.append(enrichis)
+        self.facturx_consolidees.append(facturx)
+        if not facturx.empty:
+            self.en_attente.append((enrichis, facturx))
+            self.nb_en_attente += len(facturx)
+
+    def _generer(self):
+        """Génère les factures Factur-X des unités en attente."""
+        if not self.en_attente:
+            return
+        enrichis = pd.concat([e for e, _ in self.en_attente], ignore_index=True)
+        facturx = pd.concat([f for _, f in self.en_attente], ignore_index=True)
+        self.en_attente, self.nb_en_attente = [], 0
+        sur_lot = None
+        if self.empaqueteur is not None:
+            sur_lot = lambda lot: self.empaqueteur.ajouter_lot(lot, self.ctx.facturx_dir)
+        formatage.vers_facturx(enrichis, facturx, self.ctx.facturx_dir, taille_lot=len(facturx), sur_lot=sur_lot)
+        if self.premiere_livraison is None:
+            self.premiere_livraison = time.perf_counter() - self.debut
+            logger.info(f"Premières factures Factur-X produites après {self.premiere_livraison:.1f} s.")
+
+    # ======================= Fin du traitement ==============================
+    def terminer(self):
+        """
+        Traite les unités incomplètes (factures manquantes, signalées par la consolidation),
+        génère les dernières factures Factur-X et écrit les tables de l'atelier.
+        """
+        incompletes = [u for u in self.unites.values() if not u.traitee]
+        if incompletes:
+            logger.warning(f"{len(incompletes)} groupements ou factures incomplets en fin d'extraction, traités en l'état.")
+        for unite in incompletes:
+            self._traiter(unite)
+        self._generer()
+
+        extrait = pd.DataFrame(self.extrait)
+        extrait.to_csv(self.ctx.extrait_dir / 'extrait.csv')
+        _concat(self.consolidees).to_csv(self.ctx.racine / 'consignes_consolidees.csv')
+        _concat(self.facturx_consolidees).to_csv(self.ctx.racine / 'facturx_consolidees.csv')
+        _concat(self.enrichis).to_csv(self.ctx.racine / 'enrichis.csv')
+
+def _uniques(unites: list[Unite]) -> list[Unite]:
+    vues, resultat = set(), []
+    for unite in unites:
+        if id(unite) not in vues:
+            vues.add(id(unite))
+            resultat.append(unite)
+    return resultat
+
+def _concat(tables: list[DataFrame]) -> DataFrame:
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+def executer_flux(ctx: Contexte, taille_lot: int=TAILLE_LOT_FLUX) -> Flux:
+    """
+    Exécute toutes les étapes en flux (voir le module). Nécessite un zip ou un dossier de zips d'entrée.
+
+    :return: Le flux terminé, avec notamment le délai d'obtention des premières factures.
+    """
+    if ctx.entree is None:
+        raise ValueError("L'exécution en flux nécessite un zip d'entrée (option -i).")
+    from rich.panel import Panel
+
+    ctx.creer_repertoires()
+    for etape in ETAPES:
+        etape.invalider(ctx)
+    ctx.console.print(Panel.fit("Étapes 1 à 4 en flux : extraction, consolidation, fusion et Factur-X", style="bold magenta"))
+
+    files_to_extract = ['consignes.csv', 'facturx.csv']
+    zip_paths = extraction.lister_zips(ctx.entree)
+    if not zip_paths:
+        raise ValueError(f"Aucun zip à traiter dans {ctx.entree}")
+    multi = len(zip_paths) > 1
+    with profileur.etape('flux'):
+        # Les consignes sont lues avant le découpage pour connaître les factures attendues
+        extraction.extraire_tables(zip_paths, ctx.extrait_dir, files_to_extract)
+        importer_consignes(ctx)
+        consignes = pd.read_csv(ctx.extrait_dir / 'consignes.csv', dtype=str)
+        facturx = pd.read_csv(ctx.extrait_dir / 'facturx.csv', dtype=str)
+        flux = Flux(ctx, consignes, facturx, taille_lot)
+
+        temp_dirs = {lot: extraction.extract_nested_pdfs(zip_path) for lot, zip_path in extraction.nommer_lots(zip_paths).items()}
+        try:
+            pdf_files = [(lot if multi else None, pdf)
+                         for lot, temp_dir in temp_dirs.items() for pdf in sorted(temp_dir.glob('**/*.pdf'))]
+            # Un groupement fusionné dans le processus principal n'aurait pas de budget
+            with ouvrir_livraison(ctx) as empaqueteur, \
+                    supervision.creer_superviseur(1) if supervision.budget_actif() else nullcontext() as superviseur:
+                flux.empaqueteur = empaqueteur
+                flux.superviseur = superviseur
+                extraction.extraire_pdfs(pdf_files, ctx.extrait_pdf_dir, ctx.workers, sur_resultat=flux.recevoir,
+                                         pool=ctx.pool, quarantaine=flux.quarantaine, textes=ctx.cache_textes())
+                flux.terminer()
+        finally:
+            for temp_dir in temp_dirs.values():
+                shutil.rmtree(temp_dir)
+
+    marquer_volatils(ctx)
+    for etape in ETAPES_PRODUCTION:
+        etape.terminer(ctx)
+    vider_compteurs()
+    return flux
@@ -0,0 +1,455 @@
+"""
+Graphe des étapes du traitement : chaque étape déclare ses entrées et ses sorties
+dans le répertoire atelier, ce qui permet de reprendre un traitement à partir d'une
+étape donnée et de sauter les étapes dont les artefacts sont à jour.
+"""
+import hashlib
+import shutil
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterator
+
+from atelier_facture.utils import logger, vider_compteurs
+from atelier_facture.utils.profilage import profileur
+
+# pandas, rich et les modules d'étapes ne sont importés qu'à l'exécution d'une étape
+if TYPE_CHECKING:
+    from pandas import DataFrame
+    from rich.console import Console
+    from atelier_facture.etapes.livraison import Empaqueteur
+    from atelier_facture.utils.supervision import Quarantaine, Superviseur
+    from atelier_facture.utils.textes import CacheTextes
+
+def _console() -> 'Console':
+    from rich.console import Console
+    return Console()
+
+@dataclass
+class Contexte:
+    """
+    Répertoire atelier et paramètres partagés par toutes les étapes.
+
+    :param pool: Pool supervisé conservé entre les traitements (voir `api.Atelier`),
+                 un pool de `workers` processus est créé pour chaque étape qui en a besoin sinon.
+    """
+    racine: Path
+    entree: Path | None = None
+    consignes: Path | None = None
+    workers: int | None = None
+    livraison: str | None = None
+    livraison_taille_max: int | None = None
+    espace: Path | None = None
+    garder: list[str] = field(default_factory=list)
+    shard: tuple[int, int] | None = None
+    shard_attente: float = 3600.0
+    verifier_empreintes: bool = False
+    pool: 'Superviseur | None' = None
+    console: 'Console' = field(default_factory=_console)
+
+    def _intermediaire(self, nom: str) -> Path:
+        """
+        Dossier des PDFs intermédiaires `nom` : dans l'espace de travail volatil s'il est
+        défini (mode sans intermédiaires), sauf si `nom` est à garder pour le débogage.
+        """
+        if self.espace is None or nom in self.garder:
+            return self.racine / nom
+        return self.espace / nom
+
+    def racines_shards(self) -> list[Path]:
+        """Répertoires de tous les shards du découpage courant (option --shard), vide sinon."""
+        if self.shard is None:
+            return []
+        from atelier_facture.repartition import racines_shards
+        return racines_shards(self.racine.parents[1], self.shard[1])
+
+    def volatils(self) -> list[Path]:
+        """Dossiers d'intermédiaires supprimés en fin de traitement."""
+        return [d for d in [self.extrait_pdf_dir, self.enrichi_dir] if self.espace is not None and d.is_relative_to(self.espace)]
+
+    @property
+    def extrait_dir(self) -> Path:
+        return self.racine / 'extrait'
+
+    @property
+    def extrait_pdf_dir(self) -> Path:
+        """Dossier des PDFs extraits ; les tables restent dans `extrait_dir`."""
+        return self._intermediaire('extrait')
+
+    @property
+    def textes_dir(self) -> Path:
+        """Cache des textes des pages des PDFs sources, conservé avec les tables (voir `utils.textes`)."""
+        return self.extrait_dir / 'textes'
+
+    def cache_textes(self) -> 'CacheTextes':
+        from atelier_facture.utils.textes import CacheTextes
+        return CacheTextes(self.textes_dir)
+
+    @property
+    def enrichi_dir(self) -> Path:
+        return self._intermediaire('enrichi')
+
+    @property
+    def facturx_dir(self) -> Path:
+        return self.racine / 'facturx'
+
+    @property
+    def livraison_dir(self) -> Path:
+        """Dossier des zips de livraison (option --livraison)."""
+        return self.racine / 'livraison'
+
+    @property
+    def quarantaine_dir(self) -> Path:
+        """Dossier des documents en échec (voir `utils.supervision.Quarantaine`)."""
+        return self.racine / 'quarantaine'
+
+    def quarantaine(self) -> 'Quarantaine':
+        from atelier_facture.utils.supervision import Quarantaine
+        return Quarantaine(self.quarantaine_dir)
+
+    @property
+    def etat_dir(self) -> Path:
+        """Dossier des marqueurs de fin d'étape."""
+        return self.racine / '.etapes'
+
+    def creer_repertoires(self):
+        for dir_path in [self.extrait_dir, self.extrait_pdf_dir, self.enrichi_dir, self.facturx_dir, self.etat_dir]:
+            dir_path.mkdir(parents=True, exist_ok=True)
+
+@dataclass(frozen=True)
+class Etape:
+    """
+    Une étape du traitement.
+
+    :param nom: Nom court de l'étape, utilisé par les options de la ligne de commande.
+    :param titre: Titre affiché au lancement de l'étape.
+    :param entrees: Fonction donnant les chemins lus par l'étape.
+    :param sorties: Fonction donnant les chemins produits par l'étape.
+    :param executer: Fonction réalisant l'étape.
+    :param intermediaires: Fonction donnant les chemins supprimés par `--force`.
+    :param signature: Fonction donnant l'identité des entrées externes fournies (par nom),
+                      enregistrée dans le marqueur de fin d'étape.
+    """
+    nom: str
+    titre: str
+    entrees: Callable[[Contexte], list[Path]]
+    sorties: Callable[[Contexte], list[Path]]
+    executer: Callable[[Contexte], None]
+    intermediaires: Callable[[Contexte], list[Path]] = lambda ctx: []
+    signature: Callable[[Contexte], dict[str, str]] = lambda ctx: {}
+
+    def marqueur(self, ctx: Contexte) -> Path:
+        return ctx.etat_dir / f'{self.nom}.ok'
+
+    def est_a_jour(self, ctx: Contexte) -> bool:
+        """
+        Une étape est à jour si elle s'est terminée, que toutes ses sorties existent,
+        qu'aucune de ses entrées n'a été modifiée depuis et que les entrées externes
+        fournies sont celles enregistrées à sa fin : un autre zip d'entrée, même plus
+        ancien que le marqueur, la rend obsolète.
+        """
+        marqueur = self.marqueur(ctx)
+        if not marqueur.exists():
+            return False
+        if not all(s.exists() for s in self.sorties(ctx)):
+            return False
+        enregistree = _lire_signature(marqueur)
+        if any(enregistree.get(cle) != valeur for cle, valeur in self.signature(ctx).items()):
+            return False
+        fin = marqueur.stat().st_mtime
+        return all(e.stat().st_mtime <= fin for e in self.entrees(ctx) if e.exists())
+
+    def terminer(self, ctx: Contexte):
+        """Écrit le marqueur de fin d'étape, avec la signature de ses entrées externes."""
+        signature = {**_lire_signature(self.marqueur(ctx)), **self.signature(ctx)}
+        self.marqueur(ctx).write_text(''.join(f'{cle}\t{valeur}\n' for cle, valeur in signature.items()),
+                                      encoding='utf-8')
+
+    def invalider(self, ctx: Contexte):
+        """Supprime le marqueur de fin d'étape et les fichiers intermédiaires produits."""
+        self.marqueur(ctx).unlink(missing_ok=True)
+        for chemin in self.intermediaires(ctx):
+            if chemin.is_dir():
+                shutil.rmtree(chemin)
+                chemin.mkdir(parents=True, exist_ok=True)
+            else:
+                chemin.unlink(missing_ok=True)
+
+def _lire_signature(marqueur: Path) -> dict[str, str]:
+    """Signature enregistrée dans un marqueur de fin d'étape, vide pour un marqueur sans signature."""
+    if not marqueur.exists():
+        return {}
+    lignes = marqueur.read_text(encoding='utf-8').splitlines()
+    return dict(ligne.split('\t', 1) for ligne in lignes if '\t' in ligne)
+
+def lire_csv(chemin: Path, index: bool=False) -> 'DataFrame':
+    """
+    Charge un CSV de l'atelier, toutes les colonnes en chaînes.
+
+    :param index: Vrai si le CSV a été écrit avec son index (`DataFrame.to_csv` par défaut).
+    """
+    import pandas as pd
+    return pd.read_csv(chemin, sep=',', encoding='utf-8', dtype=str, index_col=0 if index else None)
+
+# ======================= Définition des étapes ==============================
+TAILLE_LOT_LIVRAISON = 100
+
+def _entrees_extraction(ctx: Contexte) -> list[Path]:
+    return [p for p in [ctx.entree, ctx.consignes] if p is not None]
+
+def _signature_extraction(ctx: Contexte) -> dict[str, str]:
+    """
+    Identité du zip (ou dossier de zips) d'entrée et des consignes fournis : chemin résolu,
+    taille et date de chaque fichier. Une entrée non fournie n'est pas comparée.
+    """
+    signature = {}
+    for cle, chemin in [('entree', ctx.entree), ('consignes', ctx.consignes)]:
+        if chemin is None or not chemin.exists():
+            continue
+        fichiers = sorted(chemin.glob('**/*.zip')) if chemin.is_dir() else [chemin]
+        identite = '\n'.join(f'{f.resolve()}:{f.stat().st_size}:{f.stat().st_mtime_ns}' for f in fichiers)
+        signature[cle] = hashlib.sha256(identite.encode('utf-8')).hexdigest()
+    return signature
+
+def importer_consignes(ctx: Contexte):
+    """Remplace les consignes du zip par celles fournies à part (option --consignes, CSV ou Excel)."""
+    if ctx.consignes is None:
+        return
+    from atelier_facture.utils.tableur import lire_table
+    lire_table(ctx.consignes).to_csv(ctx.extrait_dir / 'consignes.csv', index=False)
+    logger.info(f"Consignes importées depuis {ctx.consignes}")
+
+def _sorties_extraction(ctx: Contexte) -> list[Path]:
+    return [ctx.extrait_dir / 'extrait.csv', ctx.extrait_dir / 'consignes.csv', ctx.extrait_dir / 'facturx.csv']
+
+def _volatil(ctx: Contexte, dossier: Path) -> list[Path]:
+    """
+    Un dossier d'intermédiaires volatil est une sortie de l'étape qui le remplit : s'il a
+    disparu avec l'espace de travail d'un traitement précédent, l'étape doit être refaite.
+    """
+    return [dossier / '.present'] if dossier in ctx.volatils() else []
+
+def marquer_volatils(ctx: Contexte):
+    """Marque les dossiers d'intermédiaires volatils comme remplis, pour une exécution hors étapes (voir `flux`)."""
+    for dossier in ctx.volatils():
+        for present in _volatil(ctx, dossier):
+            present.touch()
+
+def _sorties_extraction_pdfs(ctx: Contexte) -> list[Path]:
+    return _sorties_extraction(ctx) + _volatil(ctx, ctx.extrait_pdf_dir)
+
+def _extraction(ctx: Contexte):
+    if ctx.entree is None:
+        # Dans le cas ou aucun zip n'est fourni, on réutilise les fichiers csv issus d'une précédente extraction
+        if all(s.exists() for s in _sorties_extraction_pdfs(ctx)):
+            logger.info("Aucun zip fourni, réutilisation de l'extraction précédente.")
+            importer_consignes(ctx)
+            return
+        if ctx.volatils():
+            raise ValueError("Les PDFs extraits ne sont pas conservés sans intermédiaires : l'option -i est nécessaire.")
+        raise ValueError(f"Aucune extraction précédente dans {ctx.extrait_dir} : l'option -i est nécessaire.")
+    from atelier_facture.etapes import extraction
+    extrait, _ = extraction.process_zip(ctx.entree, ctx.extrait_dir, workers=ctx.workers, pdf_dir=ctx.extrait_pdf_dir,
+                                        shard=ctx.shard, pool=ctx.pool, quarantaine=ctx.quarantaine(),
+                                        textes=ctx.cache_textes())
+    extrait.to_csv(ctx.extrait_dir / 'extrait.csv')
+    importer_consignes(ctx)
+    for present in _volatil(ctx, ctx.extrait_pdf_dir):
+        present.touch()
+
+def _sorties_consolidation(ctx: Contexte) -> list[Path]:
+    return [ctx.racine / 'consignes_consolidees.csv', ctx.racine / 'facturx_consolidees.csv']
+
+def _entrees_consolidation(ctx: Contexte) -> list[Path]:
+    # En mode shard, les factures extraites par les autres shards sont aussi lues ;
+    # celles qui n'existent pas encore sont attendues par l'étape elle-même
+    autres = [r / 'extrait' / 'extrait.csv' for r in ctx.racines_shards() if r != ctx.racine]
+    return _sorties_extraction(ctx) + [e for e in autres if e.exists()]
+
+def _lire_extrait(ctx: Contexte) -> 'DataFrame':
+    if ctx.shard is None:
+        return lire_csv(ctx.extrait_dir / 'extrait.csv', index=True)
+    # Une facture de groupement peut avoir été découpée par un autre shard que ses membres
+    import pandas as pd
+    from atelier_facture.repartition import attendre_extractions
+    racines = ctx.racines_shards()
+    attendre_extractions(racines, ctx.shard_attente)
+    return pd.concat([lire_csv(r / 'extrait' / 'extrait.csv', index=True) for r in racines], ignore_index=True)
+
+def _consolidation(ctx: Contexte):
+    from atelier_facture.etapes import consolidation
+    from atelier_facture.repartition import filtrer_consignes
+    extrait = _lire_extrait(ctx)
+    consignes = filtrer_consignes(lire_csv(ctx.extrait_dir / 'consignes.csv'), ctx.shard)
+    facturx = lire_csv(ctx.extrait_dir / 'facturx.csv')
+
+    consignes = consolidation.consolidation_consignes(extrait, consignes, manquants=ctx.racine / 'missing.csv')
+    consignes.to_csv(ctx.racine / 'consignes_consolidees.csv')
+
+    facturx = consolidation.consolidation_facturx(consignes, facturx)
+    if ctx.shard is not None:
+        facturx = facturx[facturx['id'].isin(consignes['id'])]
+    facturx.to_csv(ctx.racine / 'facturx_consolidees.csv')
+
+def _sorties_fusion(ctx: Contexte) -> list[Path]:
+    return [ctx.racine / 'enrichis.csv']
+
+def _sorties_fusion_pdfs(ctx: Contexte) -> list[Path]:
+    return _sorties_fusion(ctx) + _volatil(ctx, ctx.enrichi_dir)
+
+def fusionner_groupes(ctx: Contexte, consignes: 'DataFrame') -> 'DataFrame':
+    """
+    Fusion des groupements, supervisée (dans le pool du contexte, ou un pool temporaire)
+    seulement si un budget par document est configuré.
+    """
+    from atelier_facture.etapes import fusion
+    from atelier_facture.utils import supervision
+    if not supervision.budget_actif():
+        return fusion.fusion_groupes(consignes, ctx.enrichi_dir, quarantaine=ctx.quarantaine())
+    with nullcontext(ctx.pool) if ctx.pool is not None else supervision.creer_superviseur(ctx.workers) as superviseur:
+        return fusion.fusion_groupes(consignes, ctx.enrichi_dir, superviseur=superviseur, quarantaine=ctx.quarantaine())
+
+def _fusion(ctx: Contexte):
+    consignes = lire_csv(ctx.racine / 'consignes_consolidees.csv', index=True)
+    enrichis = fusionner_groupes(ctx, consignes)
+    enrichis.to_csv(ctx.racine / 'enrichis.csv')
+    for present in _volatil(ctx, ctx.enrichi_dir):
+        present.touch()
+    from atelier_facture.utils import pedagogie
+    pedagogie.etat_avancement(ctx.console, enrichis, ctx.extrait_dir, ctx.enrichi_dir, ctx.facturx_dir,
+                              details=ctx.racine / 'non_extraits.csv')
+
+def _formatage(ctx: Contexte):
+    from atelier_facture.etapes import formatage
+    enrichis = lire_csv(ctx.racine / 'enrichis.csv', index=True)
+    facturx = lire_csv(ctx.racine / 'facturx_consolidees.csv', index=True)
+    with ouvrir_livraison(ctx) as empaqueteur:
+        if empaqueteur is None:
+            formatage.vers_facturx(enrichis, facturx, ctx.facturx_dir)
+            return
+        # Les factures sont empaquetées au fil de leur production, par lots
+        formatage.vers_facturx(enrichis, facturx, ctx.facturx_dir, taille_lot=TAILLE_LOT_LIVRAISON,
+                               sur_lot=lambda lot: empaqueteur.ajouter_lot(lot, ctx.facturx_dir))
+
+@contextmanager
+def ouvrir_livraison(ctx: Contexte) -> Iterator['Empaqueteur | None']:
+    """Empaqueteur des zips de livraison si l'option --livraison est active, None sinon."""
+    if ctx.livraison is None:
+        yield None
+        return
+    from atelier_facture.etapes.livraison import Empaqueteur
+    with Empaqueteur(ctx.livraison_dir, ctx.livraison, ctx.livraison_taille_max) as empaqueteur:
+        yield empaqueteur
+
+def _sorties_formatage(ctx: Contexte) -> list[Path]:
+    sorties = [ctx.facturx_dir]
+    if ctx.livraison is not None:
+        sorties.append(ctx.livraison_dir / 'manifeste.csv')
+    return sorties
+
+def _verification(ctx: Contexte):
+    from atelier_facture.etapes import verification
+    # PDFs intermédiaires d'un traitement sans intermédiaires précédent : disparus avec son espace de travail
+    conserves = all(p.exists() for d in ctx.volatils() for p in _volatil(ctx, d))
+    rapport = verification.verifier(
+        _lire_extrait(ctx),
+        lire_csv(ctx.racine / 'enrichis.csv', index=True),
+        lire_csv(ctx.racine / 'facturx_consolidees.csv', index=True),
+        ctx.facturx_dir,
+        extrait_dir=ctx.extrait_pdf_dir if conserves else None,
+        enrichi_dir=ctx.enrichi_dir if conserves else None,
+        empreintes=ctx.verifier_empreintes,
+        workers=ctx.workers,
+    )
+    verification.ecrire_rapport(rapport, ctx.racine / 'verification.json')
+
+ETAPES: list[Etape] = [
+    Etape('extraction', "Étape 1: Extraction des données",
+          entrees=_entrees_extraction,
+          sorties=_sorties_extraction_pdfs,
+          executer=_extraction,
+          signature=_signature_extraction),
+    Etape('consolidation', "Étape 2: Consolidation",
+          entrees=_entrees_consolidation,
+          sorties=_sorties_consolidation,
+          executer=_consolidation,
+          intermediaires=_sorties_consolidation),
+    Etape('fusion', "Étape 3: Création des pdfs enrichis",
+          entrees=lambda ctx: [ctx.racine / 'consignes_consolidees.csv'] + _volatil(ctx, ctx.extrait_pdf_dir),
+          sorties=_sorties_fusion_pdfs,
+          executer=_fusion,
+          intermediaires=lambda ctx: _sorties_fusion(ctx) + [ctx.enrichi_dir]),
+    Etape('formatage', "Étape 4: Création des factures Factur-X",
+          entrees=lambda ctx: _sorties_fusion_pdfs(ctx) + _volatil(ctx, ctx.extrait_pdf_dir) + [ctx.racine / 'facturx_consolidees.csv'],
+          sorties=_sorties_formatage,
+          executer=_formatage,
+          intermediaires=lambda ctx: [ctx.facturx_dir, ctx.livraison_dir]),
+    # Refaite dès que la génération Factur-X l'a été : son marqueur est une entrée
+    Etape('verification', "Étape 5: Vérification des sorties",
+          entrees=lambda ctx: [ctx.extrait_dir / 'extrait.csv', ctx.racine / 'enrichis.csv',
+                               ctx.racine / 'facturx_consolidees.csv', ctx.etat_dir / 'formatage.ok'],
+          sorties=lambda ctx: [ctx.racine / 'verification.json'],
+          executer=_verification,
+          intermediaires=lambda ctx: [ctx.racine / 'verification.json']),
+]
+# Étapes qui produisent les factures, sans la vérification finale
+ETAPES_PRODUCTION: list[Etape] = [e for e in ETAPES if e.nom != 'verification']
+
+NOMS_ETAPES: list[str] = [e.nom for e in ETAPES]
+
+def selectionner_etapes(from_stage: str|None=None, until: str|None=None, only: list[str]|None=None) -> list[Etape]:
+    """
+    Sélectionne les étapes à exécuter, dans l'ordre du graphe.
+
+    :param from_stage: Première étape à exécuter.
+    :param until: Dernière étape à exécuter (incluse).
+    :param only: Liste exhaustive des étapes à exécuter, exclusive des deux options précédentes.
+    :raises ValueError: Si un nom d'étape est inconnu ou si la sélection est vide.
+    """
+    for nom in [from_stage, until, *(only or [])]:
+        if nom is not None and nom not in NOMS_ETAPES:
+            raise ValueError(f"Étape inconnue : {nom}. Étapes disponibles : {', '.join(NOMS_ETAPES)}")
+    if only:
+        if from_stage or until:
+            raise ValueError("--only ne peut pas être combiné avec --from-stage ou --until.")
+        return [e for e in ETAPES if e.nom in only]
+
+    debut = NOMS_ETAPES.index(from_stage) if from_stage else 0
+    fin = NOMS_ETAPES.index(until) if until else len(ETAPES) - 1
+    if debut > fin:
+        raise ValueError(f"L'étape {from_stage} est postérieure à l'étape {until}.")
+    return ETAPES[debut:fin + 1]
+
+def executer_etapes(ctx: Contexte, etapes: list[Etape], force: bool=False) -> list[str]:
+    """
+    Exécute les étapes sélectionnées en sautant celles qui sont à jour.
+
+    :param force: Invalide les étapes sélectionnées avant exécution.
+    :return: Noms des étapes effectivement exécutées.
+    """
+    from rich.panel import Panel
+
+    ctx.creer_repertoires()
+    if force:
+        for etape in etapes:
+            etape.invalider(ctx)
+
+    executees = []
+    for etape in etapes:
+        if etape.est_a_jour(ctx):
+            ctx.console.print(Panel.fit(f"{etape.titre} (à jour, ignorée)", style="dim"))
+            continue
+
+        manquantes = [e for e in etape.entrees(ctx) if not e.exists()]
+        if manquantes:
+            raise FileNotFoundError(
+                f"Entrées manquantes pour l'étape {etape.nom} : {', '.join(str(m) for m in manquantes)}"
+            )
+        ctx.console.print(Panel.fit(etape.titre, style="bold magenta"))
+        with profileur.etape(etape.nom):
+            etape.executer(ctx)
+        etape.terminer(ctx)
+        executees.append(etape.nom)
+        vider_compteurs()
+        logger.info(f"Étape {etape.nom} terminée.")
+    return executees
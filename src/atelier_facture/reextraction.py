@@ -0,0 +1,171 @@
+"""
+Réextraction : après une modification des motifs de recherche (voir
+`extraction.extract_and_format_data`), rejoue la recherche des motifs et le plan de
+découpage sur le cache des textes des pages écrit à l'extraction (voir `utils.textes`),
+sans relire les PDFs sources.
+
+Une facture dont le nom, les pages et les données écrites dans le PDF (numéro de facture,
+groupement) sont inchangés garde son PDF extrait. Seules les autres sont redécoupées,
+depuis les PDFs sources du zip d'entrée, qui n'est nécessaire que dans ce cas. Les PDFs
+extraits qui ne correspondent plus à aucune facture sont supprimés, et les étapes
+suivantes refaites.
+
+    atelier_facture ~/atelier -i lot_12.zip --reextraction
+"""
+import shutil
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from atelier_facture.orchestrateur import ETAPES, Contexte, lire_csv
+from atelier_facture.utils import file_naming, logger
+
+@dataclass
+class Reextraction:
+    """Bilan d'une réextraction."""
+    conservees: int = 0
+    reecrites: list[str] = field(default_factory=list)
+    supprimees: list[str] = field(default_factory=list)
+    echecs: list[str] = field(default_factory=list)
+
+    def resume(self) -> str:
+        resume = (f"{self.conservees} factures conservées, {len(self.reecrites)} redécoupées, "
+                  f"{len(self.supprimees)} PDFs extraits supprimés")
+        if self.echecs:
+            resume += f", {len(self.echecs)} PDFs sources en échec"
+        return resume
+
+def _texte(valeur) -> str:
+    return '' if valeur is None or valeur != valeur else str(valeur)
+
+def _inchangee(ancienne: dict | None, source: str, debut: int, fin: int, data: dict, chemin: Path) -> bool:
+    """Vrai si le PDF extrait de l'ancienne facture de même nom convient tel quel."""
+    if ancienne is None or not chemin.exists():
+        return False
+    return (_texte(ancienne.get('source')) == source
+            and _texte(ancienne.get('page')) == str(debut)
+            and _texte(ancienne.get('pages')) == str(fin - debut)
+            and _texte(ancienne.get('id')) == _texte(data.get('id'))
+            and _texte(ancienne.get('groupement')) == _texte(data.get('groupement')))
+
+def _localiser_sources(ctx: Contexte, a_localiser: dict[tuple[str, str], str]) -> tuple[dict[tuple[str, str], Path], list[Path]]:
+    """
+    PDFs sources du zip d'entrée, cherchés par lot et nom puis vérifiés par empreinte.
+
+    :param a_localiser: Empreinte de chaque PDF source à localiser, par (lot, nom).
+    :return: Le chemin de chaque PDF source trouvé, et les dossiers temporaires à supprimer.
+    """
+    from atelier_facture.etapes import extraction
+    from atelier_facture.utils.textes import empreinte_source
+
+    lots = extraction.nommer_lots(extraction.lister_zips(ctx.entree))
+    multi = len(lots) > 1
+    temp_dirs = [extraction.extract_nested_pdfs(zip_path) for zip_path in lots.values()]
+    trouves: dict[tuple[str, str], Path] = {}
+    for lot, temp_dir in zip(lots, temp_dirs):
+        lot = lot if multi else ''
+        for pdf in temp_dir.glob('**/*.pdf'):
+            cle = (lot, pdf.name)
+            if cle in a_localiser and cle not in trouves and empreinte_source(pdf) == a_localiser[cle]:
+                trouves[cle] = pdf
+    return trouves, temp_dirs
+
+def reextraire(ctx: Contexte) -> Reextraction:
+    """
+    Refait l'extraction d'un atelier à partir du cache des textes des pages et réécrit
+    `extrait.csv` ; les étapes suivantes sont à refaire.
+
+    :raises ValueError: Si les PDFs extraits n'ont pas été conservés, ou si des factures
+                        sont à redécouper sans zip d'entrée.
+    :raises FileNotFoundError: Si l'atelier n'a pas été extrait, ou sans cache des textes.
+    """
+    from atelier_facture.etapes import extraction
+    from atelier_facture.utils import supervision
+
+    if ctx.volatils():
+        raise ValueError("Les PDFs extraits ne sont pas conservés sans intermédiaires : la réextraction est impossible.")
+    cache = ctx.cache_textes()
+    sources = cache.lire_index().fillna('')
+    anciennes = {Path(r['fichier_extrait']).name: r
+                 for r in lire_csv(ctx.extrait_dir / 'extrait.csv', index=True).to_dict('records')}
+
+    bilan = Reextraction()
+    factures: list[dict] = []
+    # Factures à redécouper par PDF source (lot, nom) : (début, fin, données, chemin, facture)
+    a_ecrire: dict[tuple[str, str], list[tuple[int, int, dict, Path, dict]]] = {}
+    empreintes: dict[tuple[str, str], str] = {}
+    # Noms attribués dans l'ordre de l'index, celui de l'extraction
+    noms = file_naming.IndexNoms()
+    for source, lot, origine in sources[['source', 'lot', 'fichier_origine']].itertuples(index=False):
+        for debut, fin, data, nom in extraction.planifier_decoupage(cache.lire(source), noms):
+            chemin = ctx.extrait_pdf_dir / f'{nom}.pdf'
+            ancienne = anciennes.get(chemin.name)
+            facture = {**data, 'fichier_extrait': str(chemin), 'fichier_origine': origine,
+                       'pages': fin - debut, 'page': debut, 'source': source, 'octets': None, 'sha256': None}
+            if _inchangee(ancienne, source, debut, fin, data, chemin):
+                facture['octets'], facture['sha256'] = ancienne.get('octets'), ancienne.get('sha256')
+                bilan.conservees += 1
+            else:
+                a_ecrire.setdefault((lot, origine), []).append((debut, fin, data, chemin, facture))
+                empreintes[(lot, origine)] = source
+            if lot:
+                facture['lot'] = lot
+            factures.append(facture)
+
+    if a_ecrire and ctx.entree is None:
+        nombre = sum(len(f) for f in a_ecrire.values())
+        raise ValueError(f"{nombre} factures à redécouper : le zip d'entrée (option -i) est nécessaire.")
+
+    # PDFs extraits qui ne correspondent plus à aucune facture
+    noms = {Path(f['fichier_extrait']).name for f in factures}
+    for nom in anciennes:
+        if nom not in noms:
+            (ctx.extrait_pdf_dir / nom).unlink(missing_ok=True)
+            bilan.supprimees.append(nom)
+
+    if a_ecrire:
+        trouves, temp_dirs = _localiser_sources(ctx, empreintes)
+        try:
+            for cle in a_ecrire:
+                if cle not in trouves:
+                    bilan.echecs.append(f"{cle[0]}/{cle[1]}" if cle[0] else cle[1])
+                    logger.error(f"{cle[1]} absent du zip d'entrée ou modifié depuis l'extraction.")
+            cles = [cle for cle in a_ecrire if cle in trouves]
+            taches = [(trouves[cle], [(debut, fin, data, chemin) for debut, fin, data, chemin, _ in a_ecrire[cle]])
+                      for cle in cles]
+            quarantaine = ctx.quarantaine()
+            # Un budget ne peut être appliqué qu'à un processus de travail
+            if ctx.pool is None and (ctx.workers == 1 or len(taches) <= 1) and not supervision.budget_actif():
+                resultats = []
+                for i, tache in enumerate(taches):
+                    try:
+                        resultats.append((i, True, extraction.reecrire_factures(*tache)))
+                    except Exception as e:
+                        resultats.append((i, False, f"{type(e).__name__} : {e}"))
+            else:
+                with nullcontext(ctx.pool) if ctx.pool is not None else supervision.creer_superviseur(ctx.workers) as pool:
+                    resultats = list(pool.executer(extraction.reecrire_factures, taches))
+            for i, ok, resultat in resultats:
+                lot, origine = cles[i]
+                if ok:
+                    for (*_, chemin, facture), releve in zip(a_ecrire.pop(cles[i]), resultat):
+                        facture['octets'], facture['sha256'] = releve
+                        bilan.reecrites.append(chemin.name)
+                else:
+                    bilan.echecs.append(f"{lot}/{origine}" if lot else origine)
+                    quarantaine.mettre(f"{lot}/{origine}" if lot else origine, resultat, chemin=trouves[cles[i]],
+                                       nom=f"{lot}-{origine}" if lot else None)
+        finally:
+            for temp_dir in temp_dirs:
+                shutil.rmtree(temp_dir)
+        # Factures non redécoupées : comme non extraites
+        non_ecrites = {id(facture) for restantes in a_ecrire.values() for *_, facture in restantes}
+        factures = [f for f in factures if id(f) not in non_ecrites]
+
+    extraction.signaler_doublons(factures)
+    pd.DataFrame(factures).to_csv(ctx.extrait_dir / 'extrait.csv')
+    next(e for e in ETAPES if e.nom == 'extraction').terminer(ctx)
+    logger.info(f"Réextraction : {bilan.resume()}")
+    return bilan
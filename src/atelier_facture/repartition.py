@@ -0,0 +1,267 @@
+"""
+Répartition d'un traitement sur plusieurs machines partageant un système de fichiers,
+sans service de coordination.
+
+Chaque machine lance la même commande avec son numéro de shard :
+
+    atelier_facture ~/atelier -i factures.zip --shard 1/4
+    atelier_facture ~/atelier -i factures.zip --shard 2/4
+    ...
+
+Le shard `i/n` travaille dans `~/atelier/shards/i_n/`. L'extraction découpe les PDFs
+sources dont le hachage du nom tombe dans le shard ; la consolidation attend que tous
+les shards aient terminé leur extraction, puis ne garde que les groupements du shard
+(ou les factures isolées, par id). Un groupement et ses factures sont donc toujours
+fusionnés et convertis par le même shard.
+
+Une fois tous les shards terminés, leurs sorties sont réunies dans l'atelier :
+
+    atelier_facture_fusion_shards ~/atelier
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from atelier_facture.utils import logger
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+DOSSIER_SHARDS = 'shards'
+# Tables dont les lignes sont réparties entre les shards, à concaténer
+TABLES_REPARTIES = ['extrait/extrait.csv', 'consignes_consolidees.csv', 'facturx_consolidees.csv', 'enrichis.csv',
+                    'missing.csv', 'non_extraits.csv']
+# Tables identiques dans tous les shards
+TABLES_COMMUNES = ['extrait/consignes.csv', 'extrait/facturx.csv']
+# Fichiers produits par chaque shard, déplacés dans l'atelier
+FICHIERS_PRODUITS = {'extrait': '*.pdf', 'enrichi': '*.pdf', 'facturx': '*.*'}
+
+def lire_shard(texte: str) -> tuple[int, int]:
+    """
+    Lit un shard au format `i/n`, avec 1 <= i <= n.
+
+    :raises ValueError: Si le format est invalide.
+    """
+    try:
+        i, n = (int(x) for x in texte.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard invalide : {texte}. Format attendu : i/n, par exemple 1/4.")
+    if not 1 <= i <= n:
+        raise ValueError(f"Shard invalide : {texte}. Il faut 1 <= i <= n.")
+    return i, n
+
+def dans_shard(cle: str, shard: tuple[int, int] | None) -> bool:
+    """
+    Vrai si `cle` est attribuée au shard. Le hachage est stable d'une machine et d'une
+    exécution à l'autre (contrairement à `hash()`).
+    """
+    if shard is None:
+        return True
+    i, n = shard
+    empreinte = int.from_bytes(hashlib.blake2b(cle.encode('utf-8'), digest_size=8).digest(), 'big')
+    return empreinte % n == i - 1
+
+def nom_shard(shard: tuple[int, int]) -> str:
+    return f'{shard[0]}_{shard[1]}'
+
+def racine_shard(atelier: Path, shard: tuple[int, int]) -> Path:
+    """Répertoire de travail du shard dans l'atelier partagé."""
+    return atelier / DOSSIER_SHARDS / nom_shard(shard)
+
+def racines_shards(atelier: Path, n: int) -> list[Path]:
+    return [racine_shard(atelier, (i, n)) for i in range(1, n + 1)]
+
+def filtrer_consignes(consignes: 'DataFrame', shard: tuple[int, int] | None) -> 'DataFrame':
+    """Consignes des groupements du shard ; une facture hors groupement est répartie par son id."""
+    if shard is None:
+        return consignes
+    cles = consignes['groupement'].where(consignes['groupement'].notna(), consignes['id'])
+    return consignes[cles.astype(str).map(lambda cle: dans_shard(cle, shard))]
+
+def attendre_extractions(racines: list[Path], delai_max: float, intervalle: float=5.0):
+    """
+    Attend que tous les shards aient terminé leur extraction (marqueur de fin d'étape).
+
+    :raises TimeoutError: Si un shard n'a pas terminé après `delai_max` secondes.
+    """
+    debut = time.monotonic()
+    while True:
+        manquants = [r.name for r in racines if not (r / '.etapes' / 'extraction.ok').exists()]
+        if not manquants:
+            return
+        if time.monotonic() - debut > delai_max:
+            raise TimeoutError(f"Extraction non terminée après {delai_max:.0f} s pour les shards : {', '.join(manquants)}")
+        logger.info(f"En attente de l'extraction des shards : {', '.join(manquants)}")
+        time.sleep(intervalle)
+
+# ======================= Fusion des shards ==================================
+# Un shard peut référencer les PDFs extraits par un autre (factures d'un même groupement)
+_CHEMIN_SHARD = re.compile(re.escape(f'{DOSSIER_SHARDS}{os.sep}') + r'(\d+_\d+)' + re.escape(os.sep))
+
+def _relocaliser(valeur, renommes: dict[tuple[str, str], str] | None=None):
+    """
+    Chemin d'un fichier d'un shard, une fois déplacé dans l'atelier.
+
+    :param renommes: Nouveau nom des fichiers suffixés au déplacement, par (shard, chemin dans le shard).
+    """
+    if not isinstance(valeur, str):
+        return valeur
+    trouve = _CHEMIN_SHARD.search(valeur)
+    if trouve is None:
+        return valeur
+    reste = valeur[trouve.end():]
+    nouveau = (renommes or {}).get((trouve.group(1), Path(reste).as_posix()))
+    if nouveau is not None:
+        reste = str(Path(reste).with_name(nouveau))
+    return valeur[:trouve.start()] + reste
+
+def _deplacer(source: Path, cible: Path) -> Path:
+    """Déplace `source` vers `cible`, suffixée si le nom est déjà pris."""
+    cible.parent.mkdir(parents=True, exist_ok=True)
+    numero = 1
+    while cible.exists():
+        cible = cible.with_name(f'{cible.stem.rsplit("_shard", 1)[0]}_shard{numero}{cible.suffix}')
+        numero += 1
+    os.replace(source, cible)
+    return cible
+
+def _fusionner_quarantaine(racine: Path, cible: Path):
+    """Déplace la quarantaine d'un shard dans celle de l'atelier, index compris."""
+    import pandas as pd
+    from atelier_facture.orchestrateur import lire_csv
+
+    index = lire_csv(racine / 'quarantaine.csv').fillna('')
+    for i, fichier in index['fichier'].items():
+        if not fichier or not (racine / fichier).exists():
+            continue
+        deplace = _deplacer(racine / fichier, cible / fichier)
+        if (racine / f'{fichier}.erreur.txt').exists():
+            _deplacer(racine / f'{fichier}.erreur.txt', cible / f'{deplace.name}.erreur.txt')
+        index.loc[i, 'fichier'] = deplace.name
+    # Échecs sans document (groupements)
+    for erreur in sorted(racine.glob('*.erreur.txt')):
+        _deplacer(erreur, cible / erreur.name)
+    if (cible / 'quarantaine.csv').exists():
+        index = pd.concat([lire_csv(cible / 'quarantaine.csv'), index], ignore_index=True)
+    index.to_csv(cible / 'quarantaine.csv', index=False)
+
+def _fusionner_textes(racines: list[Path], cible: Path):
+    """Réunit les caches des textes des pages des shards (voir `utils.textes`), pour la réextraction."""
+    import pandas as pd
+    from atelier_facture.utils.textes import NOM_INDEX, CacheTextes
+
+    index = []
+    for racine in racines:
+        if not (racine / NOM_INDEX).exists():
+            continue
+        for fichier in sorted(racine.glob('*/*.json.gz')):
+            # Même empreinte, même contenu : un texte déjà présent est gardé
+            if not (cible / fichier.relative_to(racine)).exists():
+                (cible / fichier.parent.name).mkdir(parents=True, exist_ok=True)
+                os.replace(fichier, cible / fichier.relative_to(racine))
+        index.append(CacheTextes(racine).lire_index())
+    if index:
+        CacheTextes(cible).ecrire_index(pd.concat(index, ignore_index=True).to_dict('records'))
+
+def fusionner_shards(atelier: Path) -> list[str]:
+    """
+    Réunit les sorties des shards dans l'atelier : les tables réparties sont concaténées,
+    les PDFs déplacés (et leurs chemins réécrits), les zips de livraison et leurs manifestes
+    regroupés, de même que les quarantaines et les caches des textes des pages. Les répertoires des shards sont supprimés et
+    les marqueurs des étapes de production écrits dans l'atelier ; la vérification reste à
+    faire sur l'atelier réuni. Les rapports de vérification des shards qui en ont fait
+    une (versions antérieures) sont conservés dans `verification_shards.json`.
+
+    :return: Les noms des shards fusionnés.
+    :raises ValueError: Si un shard est absent ou n'a pas terminé toutes ses étapes.
+    """
+    import pandas as pd
+    from atelier_facture.orchestrateur import ETAPES_PRODUCTION, lire_csv
+
+    dossier = atelier / DOSSIER_SHARDS
+    racines = sorted(d for d in dossier.iterdir() if d.is_dir()) if dossier.is_dir() else []
+    if not racines:
+        raise ValueError(f"Aucun shard dans {dossier}")
+    totaux = {int(r.name.split('_')[1]) for r in racines}
+    if len(totaux) != 1:
+        raise ValueError(f"Shards de découpages différents dans {dossier} : {', '.join(r.name for r in racines)}")
+    n = totaux.pop()
+    attendues = racines_shards(atelier, n)
+    inacheves = [r.name for r in attendues if not all((r / '.etapes' / f'{e.nom}.ok').exists() for e in ETAPES_PRODUCTION)]
+    if inacheves:
+        raise ValueError(f"Shards absents ou inachevés : {', '.join(inacheves)}")
+
+    for table in TABLES_COMMUNES:
+        (atelier / table).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(attendues[0] / table, atelier / table)
+    if (attendues[0] / 'extrait' / 'lots').is_dir():
+        shutil.copytree(attendues[0] / 'extrait' / 'lots', atelier / 'extrait' / 'lots', dirs_exist_ok=True)
+
+    manifestes = []
+    # Fichiers suffixés au déplacement (nom déjà pris par un autre shard), à reporter dans les tables
+    renommes: dict[tuple[str, str], str] = {}
+    for racine in attendues:
+        for nom, motif in FICHIERS_PRODUITS.items():
+            for fichier in sorted((racine / nom).glob(motif)):
+                cible = _deplacer(fichier, atelier / nom / fichier.name)
+                if cible.name != fichier.name:
+                    renommes[(racine.name, f'{nom}/{fichier.name}')] = cible.name
+        livraison = racine / 'livraison'
+        if (livraison / 'manifeste.csv').exists():
+            manifeste = lire_csv(livraison / 'manifeste.csv')
+            for zip_path in sorted(livraison.glob('*.zip')):
+                cible = _deplacer(zip_path, atelier / 'livraison' / zip_path.name)
+                manifeste.loc[manifeste['zip'] == zip_path.name, 'zip'] = cible.name
+            manifestes.append(manifeste)
+    if manifestes:
+        pd.concat(manifestes, ignore_index=True).to_csv(atelier / 'livraison' / 'manifeste.csv', index=False)
+
+    for table in TABLES_REPARTIES:
+        morceaux = []
+        for racine in attendues:
+            if (racine / table).exists():
+                morceau = lire_csv(racine / table, index=True)
+                morceaux.append(morceau.apply(lambda col: col.map(lambda v: _relocaliser(v, renommes))))
+        if morceaux:
+            pd.concat(morceaux, ignore_index=True).to_csv(atelier / table)
+
+    _fusionner_textes([racine / 'extrait' / 'textes' for racine in attendues], atelier / 'extrait' / 'textes')
+
+    rapports = {}
+    for racine in attendues:
+        if (racine / 'quarantaine' / 'quarantaine.csv').exists():
+            _fusionner_quarantaine(racine / 'quarantaine', atelier / 'quarantaine')
+        if (racine / 'verification.json').exists():
+            rapports[racine.name] = json.loads((racine / 'verification.json').read_text(encoding='utf-8'))
+    if rapports:
+        (atelier / 'verification_shards.json').write_text(json.dumps(rapports, ensure_ascii=False, indent=2),
+                                                          encoding='utf-8')
+
+    (atelier / '.etapes').mkdir(parents=True, exist_ok=True)
+    for etape in ETAPES_PRODUCTION:
+        # Marqueurs du premier shard : même entrée, donc même signature
+        shutil.copyfile(attendues[0] / '.etapes' / f'{etape.nom}.ok', atelier / '.etapes' / f'{etape.nom}.ok')
+    shutil.rmtree(dossier)
+    return [r.name for r in attendues]
+
+def main():
+    from atelier_facture.utils import setup_logger
+
+    parser = argparse.ArgumentParser(description="Réunit les sorties des shards (--shard i/n) dans le répertoire atelier")
+    parser.add_argument("atelier_path", type=str, help="Chemin du répertoire atelier partagé")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Plus de logs (e.g., -v or -vv)")
+    args = parser.parse_args()
+
+    setup_logger(max(args.verbose, 1))
+    atelier = Path(args.atelier_path).expanduser()
+    shards = fusionner_shards(atelier)
+    logger.info(f"{len(shards)} shards réunis dans {atelier}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Révision des consignes : comparaison de deux versions des consignes et retraitement
+des seuls groupements et factures concernés.
+
+Chaque ligne est normalisée (ids sur 14 chiffres, espaces, nombres lus comme flottants
+par un tableur) puis hachée, la clé de la ligne étant le triplet (id, pdl, groupement).
+La comparaison des empreintes donne les lignes ajoutées, supprimées et modifiées, quelle
+que soit la forme des deux tables (ordre des lignes, colonnes en plus ou en moins).
+
+    atelier_facture ~/atelier --revision lien_v2.xlsx
+"""
+import re
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+from pandas import DataFrame
+
+from atelier_facture.etapes.consolidation import normaliser_id
+from atelier_facture.orchestrateur import (ETAPES, ETAPES_PRODUCTION, TAILLE_LOT_LIVRAISON, Contexte, fusionner_groupes,
+                                           lire_csv, ouvrir_livraison)
+from atelier_facture.utils import logger
+from atelier_facture.utils.tableur import lire_table
+
+CLES = ['id', 'pdl', 'groupement']
+# Colonnes ajoutées par l'atelier, absentes des consignes envoyées par le client
+COLONNES_ATELIER = ['lot']
+_FLOTTANT_ENTIER = re.compile(r'^-?\d+\.0+$')
+
+def _normaliser_valeur(valeur) -> str:
+    if valeur is None or valeur != valeur:
+        return ''
+    texte = str(valeur).strip()
+    if texte.lower() == 'nan':
+        return ''
+    if _FLOTTANT_ENTIER.match(texte):
+        texte = texte.split('.')[0]
+    return texte
+
+def normaliser(consignes: DataFrame) -> DataFrame:
+    """Consignes comparables : chaînes sans espaces superflus, vides pour les valeurs manquantes, ids sur 14 chiffres."""
+    df = consignes.loc[:, ~consignes.columns.astype(str).str.startswith('Unnamed')].copy()
+    df.columns = [str(c).strip() for c in df.columns]
+    for colonne in CLES:
+        if colonne not in df.columns:
+            df[colonne] = ''
+    for colonne in df.columns:
+        df[colonne] = df[colonne].map(_normaliser_valeur)
+    for colonne in ['id', 'pdl']:
+        df[colonne] = df[colonne].map(lambda x: normaliser_id(x).zfill(14) if x.isdigit() else x)
+    return df
+
+def empreintes(consignes: DataFrame, colonnes: list[str]) -> pd.Series:
+    """
+    Empreinte de chaque ligne de consignes normalisées, indexée par sa clé. Une clé
+    répétée est distinguée par son rang d'apparition.
+    """
+    cles = consignes[CLES].copy()
+    cles['rang'] = cles.groupby(CLES).cumcount()
+    valeurs = pd.util.hash_pandas_object(consignes[colonnes], index=False) if colonnes else pd.Series(0, index=consignes.index)
+    return pd.Series(valeurs.to_numpy(), index=pd.MultiIndex.from_frame(cles))
+
+@dataclass
+class Revision:
+    """
+    Différences entre deux versions des consignes.
+
+    :param ajoutees: Lignes des nouvelles consignes absentes des anciennes.
+    :param supprimees: Lignes des anciennes consignes absentes des nouvelles.
+    :param modifiees: Nouvelles versions des lignes modifiées, avec la colonne 'colonnes_modifiees'.
+    :param groupements: Groupements concernés par au moins une différence.
+    :param factures: Ids des factures concernées (hors factures de groupement, dont l'id vient de l'extraction).
+    """
+    ajoutees: DataFrame
+    supprimees: DataFrame
+    modifiees: DataFrame
+    groupements: set[str] = field(default_factory=set)
+    factures: set[str] = field(default_factory=set)
+    colonnes_ajoutees: list[str] = field(default_factory=list)
+    colonnes_supprimees: list[str] = field(default_factory=list)
+
+    def est_vide(self) -> bool:
+        return self.ajoutees.empty and self.supprimees.empty and self.modifiees.empty
+
+    def resume(self) -> str:
+        return (f"{len(self.ajoutees)} lignes ajoutées, {len(self.supprimees)} supprimées, {len(self.modifiees)} modifiées : "
+                f"{len(self.groupements)} groupements et {len(self.factures)} factures concernés")
+
+    def rapport(self) -> DataFrame:
+        """Toutes les différences dans une table, avec la colonne 'statut'."""
+        return pd.concat([self.ajoutees.assign(statut='ajoutee'), self.supprimees.assign(statut='supprimee'),
+                          self.modifiees.assign(statut='modifiee')], ignore_index=True)
+
+def comparer_consignes(anciennes: DataFrame, nouvelles: DataFrame, ignorer: list[str] | None=None) -> Revision:
+    """
+    Compare deux versions des consignes par empreinte de ligne.
+
+    :param ignorer: Colonnes exclues de la comparaison, `COLONNES_ATELIER` par défaut.
+    """
+    ignorer = COLONNES_ATELIER if ignorer is None else ignorer
+    anciennes, nouvelles = normaliser(anciennes), normaliser(nouvelles)
+    communes = [c for c in nouvelles.columns if c in anciennes.columns and c not in CLES and c not in ignorer]
+    colonnes_ajoutees = [c for c in nouvelles.columns if c not in anciennes.columns and c not in ignorer]
+    colonnes_supprimees = [c for c in anciennes.columns if c not in nouvelles.columns and c not in ignorer]
+    if colonnes_ajoutees or colonnes_supprimees:
+        logger.warning(f"Colonnes des consignes modifiées : ajoutées {colonnes_ajoutees}, supprimées {colonnes_supprimees}. "
+                       "Seules les colonnes communes sont comparées.")
+
+    h_anciennes, h_nouvelles = empreintes(anciennes, communes), empreintes(nouvelles, communes)
+    ajoutees = nouvelles[~h_nouvelles.index.isin(h_anciennes.index)]
+    supprimees = anciennes[~h_anciennes.index.isin(h_nouvelles.index)]
+    # Lignes présentes des deux côtés, d'empreintes différentes
+    h_communes = h_nouvelles[h_nouvelles.index.isin(h_anciennes.index)]
+    differentes = h_communes.index[h_communes.to_numpy() != h_anciennes.reindex(h_communes.index).to_numpy()]
+    position_nouvelles = pd.Series(range(len(nouvelles)), index=h_nouvelles.index)
+    position_anciennes = pd.Series(range(len(anciennes)), index=h_anciennes.index)
+    modifiees = nouvelles.iloc[position_nouvelles[differentes].to_numpy()].copy()
+    avant = anciennes.iloc[position_anciennes[differentes].to_numpy()]
+    modifiees['colonnes_modifiees'] = [
+        ','.join(c for c in communes if a[c] != n[c])
+        for a, n in zip(avant[communes].to_dict('records'), modifiees[communes].to_dict('records'))
+    ]
+
+    lignes = pd.concat([ajoutees[CLES], supprimees[CLES], modifiees[CLES]])
+    return Revision(
+        ajoutees=ajoutees, supprimees=supprimees, modifiees=modifiees,
+        groupements=set(lignes['groupement']) - {''},
+        factures=set(lignes['id']) - {''},
+        colonnes_ajoutees=colonnes_ajoutees, colonnes_supprimees=colonnes_supprimees,
+    )
+
+# ======================= Retraitement du sous-ensemble concerné =============
+def _etape(nom: str):
+    return next(e for e in ETAPES if e.nom == nom)
+
+def _concernees(df: DataFrame, revision: Revision) -> pd.Series:
+    ids = df['id'].astype(str).map(lambda x: normaliser_id(x).zfill(14) if x.isdigit() else x)
+    return df['groupement'].isin(revision.groupements) | ids.isin(revision.factures)
+
+def _reporter_colonnes_atelier(anciennes: DataFrame, nouvelles: DataFrame) -> DataFrame:
+    """Reporte sur les nouvelles consignes les colonnes ajoutées par l'atelier (lot), par groupement ou par id."""
+    for colonne in COLONNES_ATELIER:
+        if colonne not in anciennes.columns or colonne in nouvelles.columns:
+            continue
+        par_groupement = anciennes.dropna(subset=['groupement']).drop_duplicates('groupement').set_index('groupement')[colonne]
+        par_id = anciennes.dropna(subset=['id']).drop_duplicates('id').set_index('id')[colonne]
+        nouvelles[colonne] = nouvelles['groupement'].map(par_groupement).combine_first(nouvelles['id'].map(par_id))
+    return nouvelles
+
+def _supprimer_obsoletes(anciens: DataFrame, nouveaux: DataFrame, ctx: Contexte):
+    """Supprime les PDFs enrichis et Factur-X des lignes qui n'en produisent plus."""
+    gardes = {Path(p).name for p in nouveaux['pdf'].dropna().astype(str)}
+    for pdf in anciens['pdf'].dropna().astype(str):
+        nom = Path(pdf).name
+        if nom in gardes:
+            continue
+        if Path(pdf).resolve().is_relative_to(ctx.enrichi_dir.resolve()):
+            Path(pdf).unlink(missing_ok=True)
+        for suffixe in ('.pdf', '.xml'):
+            (ctx.facturx_dir / nom).with_suffix(suffixe).unlink(missing_ok=True)
+
+def _relivrer(ctx: Contexte, enrichis: DataFrame, facturx: DataFrame):
+    """Reconstruit les zips de livraison à partir des factures Factur-X présentes."""
+    shutil.rmtree(ctx.livraison_dir, ignore_errors=True)
+    colonnes = ['id', 'pdf'] + [c for c in ['membre', 'groupement'] if c in enrichis.columns]
+    lignes = enrichis[enrichis['id'].isin(facturx['id'])][colonnes].drop_duplicates('id').rename(columns={'id': 'BT-1'})
+    with ouvrir_livraison(ctx) as empaqueteur:
+        empaqueteur.ajouter_lot(lignes, ctx.facturx_dir)
+
+def reviser(ctx: Contexte, chemin: Path) -> Revision:
+    """
+    Applique une nouvelle version des consignes à un atelier déjà traité : la consolidation
+    est refaite (tables seulement), la fusion et la génération Factur-X seulement pour les
+    groupements et factures concernés. Les différences sont écrites dans `revision.csv`.
+
+    :raises ValueError: Si l'atelier n'a pas été entièrement traité ou si ses PDFs extraits n'ont pas été conservés.
+    """
+    from atelier_facture.etapes import consolidation, formatage
+
+    if not all(etape.est_a_jour(ctx) for etape in ETAPES_PRODUCTION):
+        raise ValueError(f"La révision des consignes nécessite un atelier entièrement traité : {ctx.racine}")
+    if ctx.volatils():
+        raise ValueError("Les PDFs extraits ne sont pas conservés sans intermédiaires : la révision est impossible.")
+
+    anciennes = lire_csv(ctx.extrait_dir / 'consignes.csv')
+    nouvelles = _reporter_colonnes_atelier(anciennes, lire_table(chemin))
+    revision = comparer_consignes(anciennes, nouvelles)
+    logger.info(f"Révision des consignes : {revision.resume()}")
+    if revision.est_vide():
+        return revision
+    revision.rapport().to_csv(ctx.racine / 'revision.csv', index=False)
+
+    nouvelles.to_csv(ctx.extrait_dir / 'consignes.csv', index=False)
+    extrait = lire_csv(ctx.extrait_dir / 'extrait.csv', index=True)
+    consignes = consolidation.consolidation_consignes(extrait, nouvelles.copy(), manquants=ctx.racine / 'missing.csv')
+    consignes.to_csv(ctx.racine / 'consignes_consolidees.csv')
+    facturx = consolidation.consolidation_facturx(consignes, lire_csv(ctx.extrait_dir / 'facturx.csv'))
+    facturx.to_csv(ctx.racine / 'facturx_consolidees.csv')
+    _etape('consolidation').terminer(ctx)
+
+    anciens_enrichis = lire_csv(ctx.racine / 'enrichis.csv', index=True)
+    a_refaire = consignes[_concernees(consignes, revision)]
+    enrichis = fusionner_groupes(ctx, a_refaire)
+    enrichis['pdf'] = enrichis['pdf'].map(lambda p: str(p) if isinstance(p, Path) else p)
+    remplaces = anciens_enrichis[_concernees(anciens_enrichis, revision)]
+    _supprimer_obsoletes(remplaces, enrichis, ctx)
+    tous = pd.concat([anciens_enrichis[~_concernees(anciens_enrichis, revision)], enrichis], ignore_index=True)
+    tous.to_csv(ctx.racine / 'enrichis.csv')
+    _etape('fusion').terminer(ctx)
+    logger.info(f"{enrichis['groupement'].nunique()} groupements refusionnés.")
+
+    facturx_a_refaire = facturx[facturx['id'].isin(enrichis['id'])]
+    if not facturx_a_refaire.empty:
+        formatage.vers_facturx(enrichis, facturx_a_refaire, ctx.facturx_dir, taille_lot=TAILLE_LOT_LIVRAISON)
+    if ctx.livraison is not None:
+        _relivrer(ctx, tous, facturx)
+    _etape('formatage').terminer(ctx)
+    logger.info(f"{len(facturx_a_refaire)} factures Factur-X régénérées.")
+    return revision
@@ -0,0 +1,69 @@
+"""
+Vérifie que le démarrage de la ligne de commande reste rapide.
+
+Lance `python -X importtime` sur le point d'entrée `atelier_facture` et échoue
+(code de sortie 1) si le temps d'import cumulé dépasse le budget ou si une
+dépendance lourde est importée avant l'analyse des arguments.
+
+    python -m atelier_facture.scripts_divers.verif_demarrage --budget-ms 150
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+POINT_ENTREE = 'atelier_facture.atelier_facture'
+MODULES_LOURDS = ['pandas', 'pymupdf', 'fitz', 'matplotlib', 'facturix', 'rich', 'numpy', 'openpyxl']
+
+_LIGNE_IMPORTTIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+def mesurer_imports(module: str=POINT_ENTREE) -> dict[str, int]:
+    """
+    Importe `module` dans un interpréteur neuf avec `-X importtime`.
+
+    :return: Temps cumulé (en µs) de chaque module importé.
+    """
+    resultat = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True,
+    )
+    cumuls: dict[str, int] = {}
+    for ligne in resultat.stderr.splitlines():
+        correspondance = _LIGNE_IMPORTTIME.match(ligne)
+        if correspondance:
+            cumuls[correspondance.group(4)] = int(correspondance.group(2))
+    return cumuls
+
+def verifier_demarrage(budget_ms: float, essais: int=3) -> list[str]:
+    """
+    :return: La liste des problèmes constatés, vide si le démarrage respecte le budget.
+    """
+    # On garde le meilleur essai pour limiter le bruit (cache disque froid, machine chargée)
+    mesures = [mesurer_imports() for _ in range(essais)]
+    meilleur = min(mesures, key=lambda m: m.get(POINT_ENTREE, 0))
+    problemes = []
+
+    total_ms = meilleur.get(POINT_ENTREE, 0) / 1000
+    if total_ms > budget_ms:
+        problemes.append(f"Import de {POINT_ENTREE} : {total_ms:.1f} ms > budget de {budget_ms:.1f} ms")
+
+    lourds = sorted({m for m in meilleur if m.split('.')[0] in MODULES_LOURDS})
+    if lourds:
+        problemes.append(f"Dépendances lourdes importées au démarrage : {', '.join(lourds)}")
+    return problemes
+
+def main():
+    parser = argparse.ArgumentParser(description="Vérifie le temps de démarrage de la ligne de commande")
+    parser.add_argument("--budget-ms", type=float, default=150, help="Temps d'import maximal du point d'entrée (ms)")
+    parser.add_argument("--essais", type=int, default=3, help="Nombre de mesures, la meilleure est retenue")
+    args = parser.parse_args()
+
+    problemes = verifier_demarrage(args.budget_ms, args.essais)
+    for probleme in problemes:
+        print(probleme)
+    if problemes:
+        sys.exit(1)
+    print("Démarrage dans le budget.")
+
+if __name__ == "__main__":
+    main()
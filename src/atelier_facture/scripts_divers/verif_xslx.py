@@ -1,24 +1,30 @@
-import pandas as pd
 from pathlib import Path
+
+from atelier_facture.revision import comparer_consignes
+from atelier_facture.utils.tableur import lire_excel
+
 def compare_excel_sheets(file1: str, file2: str, sheet_name=0):
     # Lire les deux fichiers Excel
-    df1 = pd.read_excel(file1, sheet_name=sheet_name)
-    df2 = pd.read_excel(file2, sheet_name=sheet_name)
+    df1 = lire_excel(file1, sheet_name)
+    df2 = lire_excel(file2, sheet_name)
 
-    # Comparer les DataFrames
-    comparison = df1.compare(df2, keep_equal=False)
+    # Comparer les lignes par empreinte, clé (id, pdl, groupement) : l'ordre et la forme des feuilles importent peu
+    revision = comparer_consignes(df1, df2)
 
     # Afficher les lignes qui ont changé
-    if not comparison.empty:
-        print("Lignes qui ont changé:")
-        print(comparison)
+    if not revision.est_vide():
+        print(revision.resume())
+        print(revision.rapport())
+        print("Groupements concernés :", sorted(revision.groupements))
     else:
         print("Aucune différence trouvée.")
-        
-old = Path('~/data/enargia/batch_1/input/lien.xlsx').expanduser()
-old = Path('~/data/enargia/batch_2/input/lien.xlsx').expanduser()
-old = Path('~/data/enargia/batch_3/input/lien.xlsx').expanduser()
-old = Path('~/data/enargia/batch_4/input/lien.xlsx').expanduser()
-val = Path('~/data/enargia/details 86.xlsx').expanduser()
+    return revision
+
+if __name__ == "__main__":
+    old = Path('~/data/enargia/batch_1/input/lien.xlsx').expanduser()
+    old = Path('~/data/enargia/batch_2/input/lien.xlsx').expanduser()
+    old = Path('~/data/enargia/batch_3/input/lien.xlsx').expanduser()
+    old = Path('~/data/enargia/batch_4/input/lien.xlsx').expanduser()
+    val = Path('~/data/enargia/details 86.xlsx').expanduser()
 
-compare_excel_sheets(old, val)
\ No newline at end of file
+    compare_excel_sheets(old, val)
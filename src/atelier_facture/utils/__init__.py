@@ -1,6 +1,14 @@
-from .logger_config import setup_logger, logger
+import importlib
 
-from . import pdf_utils
-from . import file_naming
-from . import pedagogie
-from .mpl import export_table_as_pdf
\ No newline at end of file
+from .logger_config import setup_logger, logger, vider_compteurs
+
+# Chargement à la demande des utilitaires, voir atelier_facture/__init__.py
+_SOUS_MODULES = {'pdf_utils', 'file_naming', 'pedagogie', 'mpl', 'espace_travail', 'ecriture', 'metadonnees', 'tableur', 'depot', 'supervision', 'textes'}
+_ATTRIBUTS = {'export_table_as_pdf': 'mpl'}
+
+def __getattr__(nom: str):
+    if nom in _SOUS_MODULES:
+        return importlib.import_module(f'.{nom}', __name__)
+    if nom in _ATTRIBUTS:
+        return getattr(importlib.import_module(f'.{_ATTRIBUTS[nom]}', __name__), nom)
+    raise AttributeError(f"module {__name__!r} has no attribute {nom!r}")
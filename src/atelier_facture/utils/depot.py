@@ -0,0 +1,218 @@
+"""
+Dépôt d'objets adressés par leur contenu pour les PDFs extraits et enrichis : chaque
+PDF est stocké une fois, sous son empreinte SHA-256, et exposé sous son nom habituel
+(voir `file_naming`) par un lien. D'un lot à l'autre et d'une exécution à l'autre, les
+mêmes factures ne sont plus réécrites : seul un lien est créé.
+
+Le lien est, par ordre de préférence, une copie légère (reflink, sur btrfs ou XFS :
+fichier indépendant qui partage les blocs), un lien physique (même inode : les objets
+sont en lecture seule pour qu'une modification sur place ne corrompe pas le dépôt),
+ou à défaut une copie (dépôt sur un autre système de fichiers).
+
+Pour que deux écritures d'un même document donnent les mêmes octets, les PDFs sont
+enregistrés sans nouvel identifiant de fichier (`/ID` du trailer, aléatoire sinon).
+
+Le dépôt est désactivé par défaut et activé par `configurer` (option `--depot`).
+"""
+import argparse
+import csv
+import errno
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from atelier_facture.utils import logger
+
+LIENS = ('reflink', 'physique', 'copie')
+# ioctl FICLONE de Linux (linux/fs.h)
+_FICLONE = 0x40049409
+
+def _reflink(source: Path, cible: Path):
+    import fcntl
+    with open(source, 'rb') as src, open(cible, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            cible.unlink(missing_ok=True)
+            raise
+
+def _physique(source: Path, cible: Path):
+    os.link(source, cible)
+
+def _copie(source: Path, cible: Path):
+    shutil.copyfile(source, cible)
+
+_METHODES = {'reflink': _reflink, 'physique': _physique, 'copie': _copie}
+
+def sha256_fichier(f) -> str:
+    """Empreinte SHA-256 d'un fichier ouvert en binaire, lu par blocs (`hashlib.file_digest` n'existe qu'à partir de Python 3.11)."""
+    empreinte = hashlib.sha256()
+    for bloc in iter(lambda: f.read(1 << 20), b''):
+        empreinte.update(bloc)
+    return empreinte.hexdigest()
+
+class Depot:
+    """
+    Dépôt d'objets dans `racine`, un fichier `<2 premiers caractères>/<empreinte>.pdf` par contenu.
+
+    :param lien: Méthode de lien imposée ('reflink', 'physique' ou 'copie'), ou None pour
+                 essayer chacune dans cet ordre et garder la première qui fonctionne.
+    """
+    def __init__(self, racine: Path, lien: str | None=None):
+        if lien is not None and lien not in LIENS:
+            raise ValueError(f"Méthode de lien inconnue : {lien} (attendu : {', '.join(LIENS)})")
+        self.racine = Path(racine)
+        self.racine.mkdir(parents=True, exist_ok=True)
+        self.methodes = [lien] if lien is not None else list(LIENS)
+        self._verrou = threading.Lock()
+
+    def objet(self, empreinte: str) -> Path:
+        return self.racine / empreinte[:2] / f'{empreinte}.pdf'
+
+    def stocker(self, donnees: bytes) -> Path:
+        """Stocke `donnees` si elles ne sont pas déjà dans le dépôt et renvoie le chemin de l'objet."""
+        objet = self.objet(hashlib.sha256(donnees).hexdigest())
+        if objet.exists():
+            return objet
+        objet.parent.mkdir(exist_ok=True)
+        # Plusieurs processus peuvent stocker le même objet : écriture puis renommage atomique
+        temporaire = objet.with_name(f'.{objet.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            temporaire.write_bytes(donnees)
+            os.chmod(temporaire, 0o444)
+            os.replace(temporaire, objet)
+        finally:
+            temporaire.unlink(missing_ok=True)
+        return objet
+
+    def stocker_fichier(self, fichier: Path) -> Path:
+        """
+        Comme `stocker`, pour un fichier déjà écrit (trop gros pour être gardé en mémoire) :
+        il est déplacé dans le dépôt, ou supprimé si son contenu y est déjà.
+        """
+        fichier = Path(fichier)
+        with open(fichier, 'rb') as f:
+            objet = self.objet(sha256_fichier(f))
+        if objet.exists():
+            fichier.unlink()
+            return objet
+        objet.parent.mkdir(exist_ok=True)
+        os.chmod(fichier, 0o444)
+        try:
+            os.replace(fichier, objet)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Dépôt sur un autre système de fichiers : copie puis renommage atomique
+            temporaire = objet.with_name(f'.{objet.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            try:
+                shutil.copyfile(fichier, temporaire)
+                os.chmod(temporaire, 0o444)
+                os.replace(temporaire, objet)
+            finally:
+                temporaire.unlink(missing_ok=True)
+            fichier.unlink()
+        return objet
+
+    def lier(self, objet: Path, chemin: Path):
+        """Expose `objet` sous `chemin`, en remplaçant atomiquement un fichier existant."""
+        chemin = Path(chemin)
+        temporaire = chemin.with_name(f'.{chemin.name}.{os.getpid()}.{threading.get_ident()}.lien')
+        temporaire.unlink(missing_ok=True)
+        for methode in list(self.methodes):
+            try:
+                _METHODES[methode](objet, temporaire)
+                break
+            except OSError as e:
+                if len(self.methodes) == 1:
+                    raise
+                # Non supporté par ce système de fichiers (ou dépôt sur un autre) : méthode suivante
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EPERM, errno.EMLINK):
+                    raise
+                logger.debug(f"Liens '{methode}' impossibles vers {self.racine} ({e.strerror}), méthode suivante.")
+                with self._verrou:
+                    if methode in self.methodes and len(self.methodes) > 1:
+                        self.methodes.remove(methode)
+        try:
+            os.replace(temporaire, chemin)
+        finally:
+            temporaire.unlink(missing_ok=True)
+
+    def deposer(self, chemin: Path, donnees: bytes):
+        """Stocke `donnees` et les expose sous `chemin`."""
+        self.lier(self.stocker(donnees), chemin)
+
+    def objets(self) -> list[Path]:
+        return list(self.racine.glob('??/*.pdf'))
+
+    def nettoyer(self, references: set[str]) -> tuple[int, int]:
+        """
+        Supprime les objets qui ne sont plus utilisés : ni référencés par les ateliers
+        (voir `references`), ni liés à un fichier par un lien physique. Le nombre de liens
+        ne suffit pas : un fichier exposé par reflink ou copie est indépendant de son objet.
+
+        :param references: Empreintes des PDFs des ateliers qui utilisent le dépôt.
+        :return: Le nombre d'objets supprimés et les octets libérés.
+        """
+        supprimes, octets = 0, 0
+        for objet in self.objets():
+            etat = objet.stat()
+            if objet.stem not in references and etat.st_nlink == 1:
+                objet.unlink()
+                supprimes += 1
+                octets += etat.st_size
+        return supprimes, octets
+
+def references(ateliers: list[Path]) -> set[str]:
+    """
+    Empreintes des PDFs extraits et enrichis relevées dans les tables des ateliers
+    (colonne `sha256` de `extrait.csv` et `enrichis.csv`), cherchées dans tout le dossier
+    de chaque atelier : un dossier qui contient plusieurs ateliers convient aussi.
+    """
+    empreintes: set[str] = set()
+    for atelier in ateliers:
+        for table in [*Path(atelier).glob('**/extrait.csv'), *Path(atelier).glob('**/enrichis.csv')]:
+            with open(table, newline='', encoding='utf-8') as f:
+                empreintes.update(ligne['sha256'] for ligne in csv.DictReader(f) if ligne.get('sha256'))
+    return empreintes
+
+_depot: Depot | None = None
+_configuration: dict = {'racine': None, 'lien': None}
+
+def configurer(racine: Path | str | None, lien: str | None=None):
+    """
+    Active le dépôt dans `racine` pour `pdf_utils.sauvegarder` dans le processus courant,
+    ou le désactive si `racine` est None.
+    """
+    global _depot
+    _configuration.update(racine=str(racine) if racine is not None else None, lien=lien)
+    _depot = Depot(Path(racine), lien) if racine is not None else None
+
+def configuration() -> dict:
+    """Configuration courante, à transmettre aux processus de travail."""
+    return dict(_configuration)
+
+def depot_actif() -> Depot | None:
+    """Le dépôt du processus courant, s'il est actif."""
+    return _depot
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspection et nettoyage d'un dépôt de PDFs adressés par leur contenu")
+    parser.add_argument("depot", type=str, help="Dossier du dépôt")
+    parser.add_argument("--nettoyer", nargs='+', default=None, metavar="ATELIER",
+                        help="Supprime les objets référencés par aucun des ateliers donnés (ou dossiers d'ateliers) ni liés par un lien physique")
+    args = parser.parse_args()
+
+    depot = Depot(Path(args.depot).expanduser())
+    objets = depot.objets()
+    print(f"{len(objets)} objets, {sum(o.stat().st_size for o in objets) / 1e6:.1f} Mo")
+    if args.nettoyer:
+        utilises = references([Path(a).expanduser() for a in args.nettoyer])
+        supprimes, octets = depot.nettoyer(utilises)
+        print(f"{supprimes} objets supprimés, {octets / 1e6:.1f} Mo libérés")
+
+if __name__ == "__main__":
+    main()
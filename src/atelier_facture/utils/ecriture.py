@@ -0,0 +1,114 @@
+"""
+Écriture des fichiers en arrière-plan : le document est sérialisé en mémoire par
+l'appelant, puis écrit sur disque par un petit pool de threads pendant que le
+traitement du document suivant continue.
+
+La sérialisation en mémoire de PyMuPDF est plus lente qu'un enregistrement direct :
+le mode n'est utile que sur un stockage lent (réseau), il est donc désactivé par
+défaut et activé par `configurer` (option `--ecriture-asynchrone`).
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+class EcrivainAsynchrone:
+    """
+    Pool d'écriture borné. Chaque fichier est écrit dans un fichier temporaire puis
+    renommé atomiquement : un lecteur ne voit jamais de fichier partiel.
+
+    :param threads: Nombre de threads d'écriture.
+    :param max_octets: Volume maximal de données en attente d'écriture. Au-delà,
+                       `ecrire` bloque jusqu'à ce que des écritures se terminent.
+    """
+    def __init__(self, threads: int=2, max_octets: int=64 * 1024 * 1024):
+        self.max_octets = max_octets
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='ecriture')
+        self._condition = threading.Condition()
+        self._octets = 0
+        self._en_cours: dict[Path, Future] = {}
+
+    def ecrire(self, chemin: Path, donnees: bytes):
+        """Confie `donnees` au pool pour écriture dans `chemin`."""
+        chemin = Path(chemin)
+        # Deux écritures du même fichier doivent se terminer dans l'ordre
+        self.attendre(chemin)
+        taille = len(donnees)
+        with self._condition:
+            # Un document plus gros que la limite passe seul
+            self._condition.wait_for(lambda: self._octets == 0 or self._octets + taille <= self.max_octets)
+            self._octets += taille
+        self._en_cours[chemin] = self._pool.submit(self._ecrire, chemin, donnees)
+
+    def _ecrire(self, chemin: Path, donnees: bytes):
+        temporaire = chemin.with_name(f'.{chemin.name}.{threading.get_ident()}.tmp')
+        try:
+            temporaire.write_bytes(donnees)
+            os.replace(temporaire, chemin)
+        finally:
+            temporaire.unlink(missing_ok=True)
+            with self._condition:
+                self._octets -= len(donnees)
+                self._condition.notify_all()
+
+    def attendre(self, chemin: Path):
+        """
+        Attend la fin de l'écriture de `chemin` si elle est en cours, à appeler avant de le relire.
+
+        :raises OSError: Si l'écriture a échoué.
+        """
+        future = self._en_cours.pop(Path(chemin), None)
+        if future is not None:
+            future.result()
+
+    def fermer(self):
+        """Attend toutes les écritures et lève la première erreur rencontrée."""
+        try:
+            for chemin in list(self._en_cours):
+                self.attendre(chemin)
+        finally:
+            self._pool.shutdown(wait=True)
+
+_ecrivain: EcrivainAsynchrone | None = None
+_configuration: dict = {'actif': False, 'threads': 2, 'max_octets': 64 * 1024 * 1024}
+
+def configurer(actif: bool, threads: int=2, max_octets: int=64 * 1024 * 1024):
+    """
+    Active ou non l'écriture en arrière-plan dans les blocs `ecriture_asynchrone`
+    du processus courant.
+    """
+    _configuration.update(actif=actif, threads=threads, max_octets=max_octets)
+
+def configuration() -> dict:
+    """Configuration courante, à transmettre aux processus de travail."""
+    return dict(_configuration)
+
+def ecrivain_actif() -> EcrivainAsynchrone | None:
+    """L'écrivain du processus courant, si l'écriture asynchrone est active."""
+    return _ecrivain
+
+@contextmanager
+def ecriture_asynchrone() -> Iterator[EcrivainAsynchrone | None]:
+    """
+    Active l'écriture en arrière-plan pour `pdf_utils.sauvegarder` dans le processus courant,
+    si elle est configurée. Toutes les écritures sont terminées à la sortie du bloc.
+    """
+    global _ecrivain
+    if _ecrivain is not None or not _configuration['actif']:
+        # Désactivé, ou déjà actif (blocs imbriqués) : l'écrivain englobant se charge de tout
+        yield _ecrivain
+        return
+    _ecrivain = EcrivainAsynchrone(_configuration['threads'], _configuration['max_octets'])
+    try:
+        yield _ecrivain
+        _ecrivain.fermer()
+    finally:
+        ecrivain, _ecrivain = _ecrivain, None
+        ecrivain._pool.shutdown(wait=True)
+
+def attendre(chemin: Path | str):
+    """Attend la fin de l'écriture en arrière-plan de `chemin`, s'il y en a une."""
+    if _ecrivain is not None:
+        _ecrivain.attendre(Path(chemin))
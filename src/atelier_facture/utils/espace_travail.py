@@ -0,0 +1,58 @@
+"""
+Espace de travail des fichiers intermédiaires (PDFs extraits et enrichis) quand ils
+ne doivent pas être conservés : un dossier sur tmpfs (en mémoire) si la place le
+permet, sinon un dossier temporaire sur disque, supprimé en fin de traitement.
+"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from atelier_facture.utils import logger
+
+TMPFS = Path('/dev/shm')
+# Les PDFs extraits puis enrichis occupent environ trois fois la taille des zips d'entrée
+FACTEUR_INTERMEDIAIRES = 3
+
+def taille_entree(entree: Path | None) -> int:
+    """Taille en octets du zip d'entrée, ou de tous les zips d'un dossier."""
+    if entree is None or not entree.exists():
+        return 0
+    if entree.is_dir():
+        return sum(z.stat().st_size for z in entree.glob('**/*.zip'))
+    return entree.stat().st_size
+
+def choisir_emplacement(taille_estimee: int, seuil: int, repli: Path) -> Path:
+    """
+    Choisit le dossier parent de l'espace de travail.
+
+    :param taille_estimee: Taille estimée des fichiers intermédiaires (octets).
+    :param seuil: Taille au-delà de laquelle les intermédiaires débordent sur disque (octets).
+    :param repli: Dossier sur disque utilisé si le tmpfs est absent, trop petit ou si le seuil est dépassé.
+    """
+    if TMPFS.is_dir() and os.access(TMPFS, os.W_OK) and taille_estimee <= seuil:
+        libre = shutil.disk_usage(TMPFS).free
+        if taille_estimee < libre:
+            return TMPFS
+        logger.info(f"Place insuffisante sur {TMPFS} ({libre / 1e6:.0f} Mo libres), intermédiaires sur disque.")
+    elif taille_estimee > seuil:
+        logger.info(f"Intermédiaires estimés à {taille_estimee / 1e6:.0f} Mo, au-delà du seuil : débordement sur disque.")
+    repli.mkdir(parents=True, exist_ok=True)
+    return repli
+
+@contextmanager
+def espace_travail(entree: Path | None, seuil: int, repli: Path) -> Iterator[Path]:
+    """
+    Crée l'espace de travail des intermédiaires et le supprime à la sortie.
+
+    :param entree: Zip ou dossier de zips d'entrée, pour estimer la place nécessaire.
+    """
+    parent = choisir_emplacement(taille_entree(entree) * FACTEUR_INTERMEDIAIRES, seuil, repli)
+    dossier = Path(tempfile.mkdtemp(prefix='atelier_facture_', dir=parent))
+    logger.info(f"Fichiers intermédiaires dans {dossier}")
+    try:
+        yield dossier
+    finally:
+        shutil.rmtree(dossier, ignore_errors=True)
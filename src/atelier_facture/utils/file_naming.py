@@ -1,6 +1,15 @@
 import re
 from pathlib import Path
 
+from pandas import DataFrame, Series
+
+from atelier_facture.utils import logger
+
+TYPES_FORMAT = {'groupement': 'G', 'pdl': 'U', 'table': 'T'}
+_ID = re.compile(r'^\d{14}$')
+# Suffixe des doublons désambiguïsés par `IndexNoms` : '<nom>~2', '<nom>~3'...
+SEPARATEUR_DOUBLON = '~'
+
 def compose_filename(file_dict: dict[str, str], format_type: str, separator: str='-') -> str:
     """
     Compose un nom de fichier en utilisant les informations fournies dans `file_dict` et le type de format.
@@ -16,7 +25,7 @@ def compose_filename(file_dict: dict[str, str], format_type: str, separator: str
     :return: Une chaîne représentant le nom de fichier composé.
     :raises ValueError: Si `format_type` n'est pas 'group' ou 'pdl', ou si des clés requises sont manquantes dans `file_dict`.
     """
-    type_dict = {'groupement': 'G', 'pdl': 'U', 'table': 'T'}
+    type_dict = TYPES_FORMAT
     if format_type not in type_dict.keys():
         raise ValueError("Invalid format_type. Use 'groupement','pdl' or 'table'.")
     
@@ -45,11 +54,11 @@ def _validate_file_dict(file_dict: dict[str, str], format_type: str) -> None:
     if not required_keys.issubset(file_dict.keys()):
         raise ValueError(f"Missing required keys. Required: {required_keys}")
     
-    if not re.match(r'^\d{14}$', file_dict['id']):
+    if not _ID.match(file_dict['id']):
         raise ValueError(f"id must be a 14-digit number. Found instead :{file_dict['id']}")
     
     if format_type == 'pdl':
-        if 'pdl' not in file_dict or not re.match(r'^\d{14}$', file_dict['pdl']):
+        if 'pdl' not in file_dict or not _ID.match(file_dict['pdl']):
             raise ValueError("PDL must be present and be a 14-digit number for 'pdl' format")
     elif format_type == 'groupement' or format_type == 'table':
         if 'groupement' not in file_dict:
@@ -57,6 +66,78 @@ def _validate_file_dict(file_dict: dict[str, str], format_type: str) -> None:
     else:
         raise ValueError("Invalid format_type. Use 'groupement' or 'pdl'.")
 
+def _invalides(masque: Series, df: DataFrame, message: str):
+    if masque.any():
+        exemples = ', '.join(str(x) for x in df.loc[masque, 'id'].head(5))
+        raise ValueError(f"{message} ({masque.sum()} lignes, par exemple : {exemples})")
+
+def compose_filenames(df: DataFrame, format_type: str | Series, separator: str='-') -> Series:
+    """
+    Version vectorielle de `compose_filename` : compose les noms de fichier de toutes les lignes
+    de `df` en un appel, avec les mêmes règles de validation.
+
+    :param df: Colonnes 'date', 'membre', 'id', et 'pdl' ou 'groupement' selon le format.
+    :param format_type: Format commun à toutes les lignes, ou série de formats alignée sur `df`.
+    :return: Les noms de fichier (sans extension), alignés sur `df`.
+    :raises ValueError: Si un format est inconnu, si une colonne requise manque ou si une valeur est invalide.
+    """
+    types = format_type if isinstance(format_type, Series) else Series(format_type, index=df.index)
+    if df.empty:
+        return Series([], index=df.index, dtype=object)
+    if not types.isin(TYPES_FORMAT.keys()).all():
+        raise ValueError("Invalid format_type. Use 'groupement','pdl' or 'table'.")
+    manquantes = {'date', 'membre', 'id'} - set(df.columns)
+    if manquantes:
+        raise ValueError(f"Missing required keys. Required: {manquantes}")
+
+    _invalides(df['date'].isna() | df['membre'].isna() | df['id'].isna(), df, f"Missing required keys. Required: {{'date', 'membre', 'id'}}")
+    ids = df['id'].astype(str)
+    _invalides(~ids.str.fullmatch(r'\d{14}'), df, "id must be a 14-digit number")
+    est_pdl = types == 'pdl'
+    if est_pdl.any():
+        if 'pdl' not in df.columns:
+            raise ValueError("PDL must be present and be a 14-digit number for 'pdl' format")
+        _invalides(est_pdl & ~df['pdl'].astype(str).str.fullmatch(r'\d{14}'), df,
+                   "PDL must be present and be a 14-digit number for 'pdl' format")
+    if not est_pdl.all():
+        if 'groupement' not in df.columns:
+            raise ValueError("groupement must be present for 'group' or 'table' format")
+        _invalides(~est_pdl & df['groupement'].isna(), df, "groupement must be present for 'group' or 'table' format")
+        quatrieme = df['groupement'].where(~est_pdl, df.get('pdl'))
+    else:
+        quatrieme = df['pdl']
+    return (types.map(TYPES_FORMAT) + separator + df['date'].astype(str) + separator + df['membre'].astype(str)
+            + separator + quatrieme.astype(str) + separator + ids)
+
+class IndexNoms:
+    """
+    Noms de fichiers attribués pendant un traitement, pour repérer avant toute écriture deux
+    lignes qui produiraient le même fichier (la seconde écraserait la première).
+
+    :param mode: 'suffixer' : les doublons reçoivent un suffixe '~2', '~3'... et sont signalés ;
+                 'erreur' : un doublon lève une ValueError.
+    """
+    def __init__(self, mode: str='suffixer'):
+        if mode not in ('suffixer', 'erreur'):
+            raise ValueError(f"Mode inconnu : {mode}. Utiliser 'suffixer' ou 'erreur'.")
+        self.mode = mode
+        self.compteurs: dict[str, int] = {}
+        self.doublons: list[str] = []
+
+    def attribuer(self, noms: Series) -> Series:
+        """Réserve les noms, désambiguïsés s'ils sont déjà pris (dans la série ou par un appel précédent)."""
+        rangs = noms.groupby(noms).cumcount() + noms.map(self.compteurs).fillna(0).astype(int)
+        collisions = rangs > 0
+        if collisions.any():
+            if self.mode == 'erreur':
+                raise ValueError(f"Noms de fichier en double : {', '.join(sorted(set(noms[collisions])))}")
+            for nom in noms[collisions]:
+                logger.warning(f"Nom de fichier en double, suffixé pour ne pas écraser le premier : {nom}")
+            self.doublons += noms[collisions].tolist()
+        for nom, total in (rangs + 1).groupby(noms).max().items():
+            self.compteurs[nom] = total
+        return noms.where(~collisions, noms + SEPARATEUR_DOUBLON + (rangs + 1).astype(str))
+
 def interpret_filename(filename: str, separator: str='-') -> dict[str, str]:
     """
     Valide le `file_dict` pour s'assurer qu'il contient les clés nécessaires et respecte le format requis selon `format_type`.
@@ -72,6 +153,12 @@ def interpret_filename(filename: str, separator: str='-') -> dict[str, str]:
     """
     # Remove the file extension if present
     filename_without_ext = Path(filename).stem
+    # Doublon désambiguïsé par IndexNoms
+    base, _, doublon = filename_without_ext.rpartition(SEPARATEUR_DOUBLON)
+    if base and doublon.isdigit():
+        filename_without_ext = base
+    else:
+        doublon = ''
     
     parts = filename_without_ext.split(separator)
     if len(parts) < 5:
@@ -101,6 +188,8 @@ def interpret_filename(filename: str, separator: str='-') -> dict[str, str]:
         'type': format_type,
         format_type: group_or_pdl
     }
+    if doublon:
+        file_dict['doublon'] = doublon
     
     return file_dict
 
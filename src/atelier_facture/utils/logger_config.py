@@ -1,9 +1,82 @@
+import atexit
+import copy
 import logging
-from rich.logging import RichHandler
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
 
 logger = logging.getLogger(__name__)
-logger.propagate = False 
-def setup_logger(verbosity=0, log_file=None):
+logger.propagate = False
+
+FORMAT_PRODUCTION = "%(asctime)s niveau=%(levelname)s pid=%(process)d module=%(module)s %(message)s"
+# Configuration courante, à transmettre aux processus de travail (voir `configuration_logs`)
+_configuration: dict = {'verbosity': 0, 'log_file': None, 'production': False}
+_listener: QueueListener | None = None
+
+class CompteurPeriodique(logging.Filter):
+    """
+    Agrège les messages marqués `extra={'compteur': <nom>}` (un message par fichier traité)
+    en compteurs, émis sous forme d'une ligne de synthèse toutes les `intervalle` secondes
+    et à chaque appel de `vider`.
+    """
+    def __init__(self, intervalle: float=10.0):
+        super().__init__()
+        self.intervalle = intervalle
+        self.compteurs: dict[str, int] = {}
+        self.emis: dict[str, int] = {}
+        self.dernier = time.monotonic()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        nom = getattr(record, 'compteur', None)
+        if nom is None:
+            return True
+        self.compteurs[nom] = self.compteurs.get(nom, 0) + 1
+        if time.monotonic() - self.dernier >= self.intervalle:
+            self.vider()
+        return False
+
+    def vider(self):
+        """Émet la synthèse des compteurs modifiés depuis la précédente."""
+        self.dernier = time.monotonic()
+        for nom, total in self.compteurs.items():
+            nouveaux = total - self.emis.get(nom, 0)
+            if nouveaux:
+                self.emis[nom] = total
+                logger.info(f"compteur={nom} total={total} nouveaux={nouveaux}")
+
+_compteur: CompteurPeriodique | None = None
+
+def vider_compteurs():
+    """Émet immédiatement la synthèse des compteurs (fin d'étape, fin de processus de travail)."""
+    if _compteur is not None:
+        _compteur.vider()
+
+def configuration_logs() -> dict:
+    """Configuration courante des logs, pour configurer à l'identique les processus de travail."""
+    return dict(_configuration)
+
+def _arreter_listener():
+    global _listener
+    vider_compteurs()
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+def setup_logger(verbosity=0, log_file=None, production=False):
+    """
+    Configure le logger de l'atelier.
+
+    :param verbosity: 0 : avertissements, 1 : informations, 2 : débogage.
+    :param log_file: Fichier de log optionnel.
+    :param production: Mode volumineux : format texte structuré sans rendu Rich, écriture par
+                       un thread dédié (file d'attente non bloquante) et messages par fichier
+                       agrégés en compteurs périodiques.
+    """
+    global _compteur
+    _configuration.update(verbosity=verbosity, log_file=log_file, production=production)
+
     level = logging.WARNING
     if verbosity == 1:
         level = logging.INFO
@@ -11,10 +84,18 @@ def setup_logger(verbosity=0, log_file=None):
         level = logging.DEBUG
 
     logger.setLevel(level)
-    
+
+    _arreter_listener()
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
         handler.close()
+    _compteur = None
+
+    if production:
+        _configurer_production(log_file)
+        return
+
+    from rich.logging import RichHandler
 
     handler = RichHandler(rich_tracebacks=True)
     formatter = logging.Formatter("%(message)s", datefmt="[%X]")
@@ -27,4 +108,39 @@ def setup_logger(verbosity=0, log_file=None):
             "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
         )
         file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
\ No newline at end of file
+        logger.addHandler(file_handler)
+
+class QueueHandlerDiffere(QueueHandler):
+    """
+    `QueueHandler` dont `prepare` ne fait que figer le message (`msg % args`) :
+    l'horodatage, la mise en forme et le rendu des traces d'exception sont laissés
+    aux handlers, dans le thread du listener.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Les arguments peuvent être modifiés après l'appel : on fige le message ici
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def _configurer_production(log_file):
+    global _listener, _compteur
+    formatter = logging.Formatter(FORMAT_PRODUCTION, datefmt="%Y-%m-%dT%H:%M:%S")
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Seul le message est composé dans le thread appelant (voir `QueueHandlerDiffere`) ;
+    # le formatage et les écritures se font dans le thread du listener
+    file_attente: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = QueueHandlerDiffere(file_attente)
+    _compteur = CompteurPeriodique()
+    queue_handler.addFilter(_compteur)
+    logger.addHandler(queue_handler)
+
+    _listener = QueueListener(file_attente, *handlers, respect_handler_level=True)
+    _listener.start()
+
+atexit.register(_arreter_listener)
@@ -0,0 +1,137 @@
+"""
+Récolte des métadonnées d'un ensemble de PDFs, en parallèle, avec un index à côté des
+fichiers (`.metadonnees.csv`) : un PDF dont la date de modification et la taille n'ont
+pas changé n'est pas rouvert aux exécutions suivantes.
+"""
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pymupdf
+from pandas import DataFrame
+
+from atelier_facture.utils import logger
+from atelier_facture.utils.file_naming import interpret_filename
+from atelier_facture.utils.pdf_utils import get_extended_metadata
+
+NOM_INDEX = '.metadonnees.csv'
+COLONNES_INDEX = ['fichier', 'mtime_ns', 'octets', 'pages', 'metadonnees']
+# En dessous, le démarrage d'un pool coûte plus que la lecture des fichiers
+SEUIL_PARALLELE = 32
+_ID_TITRE = re.compile(r'(\d{14})')
+
+def _lire(chemin: str) -> dict:
+    """Métadonnées d'un PDF, à exécuter dans un processus du pool."""
+    etat = os.stat(chemin)
+    with pymupdf.open(chemin) as doc:
+        return {'fichier': Path(chemin).name, 'mtime_ns': etat.st_mtime_ns, 'octets': etat.st_size,
+                'pages': doc.page_count, 'metadonnees': json.dumps(get_extended_metadata(doc), ensure_ascii=False)}
+
+class IndexMetadonnees:
+    """Index des métadonnées des PDFs d'un dossier, clé (nom, date de modification, taille)."""
+    def __init__(self, dossier: Path):
+        self.chemin = dossier / NOM_INDEX
+        self.entrees: dict[str, dict] = {}
+        if self.chemin.exists():
+            index = pd.read_csv(self.chemin, dtype={'fichier': str, 'metadonnees': str})
+            self.entrees = {e['fichier']: e for e in index.to_dict('records')}
+        self.modifie = False
+
+    def lire(self, chemin: Path) -> dict | None:
+        """Entrée de l'index si le fichier n'a pas changé depuis, None sinon."""
+        entree = self.entrees.get(chemin.name)
+        if entree is None:
+            return None
+        etat = chemin.stat()
+        if entree['mtime_ns'] != etat.st_mtime_ns or entree['octets'] != etat.st_size:
+            return None
+        return entree
+
+    def ajouter(self, entree: dict):
+        self.entrees[entree['fichier']] = entree
+        self.modifie = True
+
+    def ecrire(self):
+        if not self.modifie:
+            return
+        temporaire = self.chemin.with_name(f'{self.chemin.name}.{os.getpid()}.tmp')
+        DataFrame(list(self.entrees.values()), columns=COLONNES_INDEX).to_csv(temporaire, index=False)
+        os.replace(temporaire, self.chemin)
+        self.modifie = False
+
+def recolter_metadonnees(pdfs: list[Path], workers: int | None=None, index: bool=True) -> DataFrame:
+    """
+    Métadonnées d'une liste de PDFs : une ligne par PDF, avec les colonnes 'pdf', 'pages',
+    'octets' et une colonne par clé du dictionnaire /Info.
+
+    :param workers: Nombre de processus, `os.cpu_count()` par défaut. Avec 1, la lecture est faite sur place.
+    :param index: Lit et met à jour l'index `.metadonnees.csv` du dossier de chaque PDF.
+    """
+    pdfs = [Path(p) for p in pdfs]
+    index_par_dossier = {d: IndexMetadonnees(d) for d in {p.parent for p in pdfs}} if index else {}
+    entrees: dict[Path, dict] = {}
+    a_lire = []
+    for pdf in pdfs:
+        entree = index_par_dossier[pdf.parent].lire(pdf) if index else None
+        if entree is None:
+            a_lire.append(pdf)
+        else:
+            entrees[pdf] = entree
+    logger.info(f"Métadonnées : {len(entrees)} PDFs lus dans l'index, {len(a_lire)} à ouvrir.")
+
+    if workers == 1 or len(a_lire) < SEUIL_PARALLELE:
+        lus = [_lire(str(pdf)) for pdf in a_lire]
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            lus = list(pool.map(_lire, [str(pdf) for pdf in a_lire], chunksize=max(1, len(a_lire) // (workers * 4))))
+    for pdf, entree in zip(a_lire, lus):
+        entrees[pdf] = entree
+        if index:
+            index_par_dossier[pdf.parent].ajouter(entree)
+    for idx in index_par_dossier.values():
+        idx.ecrire()
+
+    lignes = []
+    for pdf in pdfs:
+        entree = entrees[pdf]
+        lignes.append({'pdf': str(pdf), 'pages': int(entree['pages']), 'octets': int(entree['octets']),
+                       **json.loads(entree['metadonnees'])})
+    return DataFrame(lignes)
+
+def _id_facture(ligne: dict) -> str | None:
+    """Id de la facture d'un PDF : titre 'Facture <id>' posé à l'extraction, ou à défaut le nom du fichier."""
+    titre = ligne.get('Title')
+    if isinstance(titre, str) and (trouve := _ID_TITRE.search(titre)):
+        return trouve.group(1)
+    try:
+        return interpret_filename(ligne['pdf'])['id']
+    except ValueError:
+        return None
+
+def _normaliser_bt1(valeur) -> str:
+    texte = str(valeur).strip()
+    if texte.endswith('.0') and texte[:-2].isdigit():
+        texte = texte[:-2]
+    return texte.zfill(14) if texte.isdigit() else texte
+
+def extract_metadata_and_update_df(pdfs: list[Path], df: DataFrame, workers: int | None=None) -> DataFrame:
+    """
+    Associe à chaque facture de `df` (colonne 'BT-1') son PDF, reconnu à ses métadonnées,
+    dans la colonne 'pdf'. Les factures sans PDF sont signalées.
+    """
+    metadonnees = recolter_metadonnees(pdfs, workers)
+    par_id = {}
+    for ligne in metadonnees.to_dict('records'):
+        id_facture = _id_facture(ligne)
+        if id_facture is not None:
+            par_id[id_facture] = ligne['pdf']
+    df = df.copy()
+    df['BT-1'] = df['BT-1'].map(_normaliser_bt1)
+    df['pdf'] = df['BT-1'].map(par_id)
+    for id_facture in df.loc[df['pdf'].isna(), 'BT-1']:
+        logger.warning(f"Aucun PDF trouvé pour la facture {id_facture}")
+    return df
@@ -4,16 +4,9 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
 import logging
-from rich.logging import RichHandler
 
-# Configuration du logger pour utiliser Rich
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler()]
-)
-logger = logging.getLogger()
+from atelier_facture.utils import logger
+from atelier_facture.utils.profilage import profileur, chronometrer
 
 # Supprimer les messages de débogage de font_manager
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
@@ -44,12 +37,14 @@ def prepare_dataframe(df: DataFrame, exclude=['id', 'pdl'], to_drop=['PRM', 'gro
 
     return df
 
+@chronometrer('export_table_as_pdf', argument=1)
 def export_table_as_pdf(df: DataFrame, pdf_filename):
     # Fixe la police utilisee
     plt.rcParams['font.family'] = 'DejaVu Sans'
     rows_per_page = 40
     # Détermine le nombre de pages nécessaires
     num_pages = len(df) // rows_per_page + int(len(df) % rows_per_page != 0)
+    profileur.compter_pages(num_pages)
 
     # Modifier le dataframe Pandas
     df = prepare_dataframe(df)
@@ -3,11 +3,45 @@ from pathlib import Path
 import os
 import shutil
 import tempfile
+from functools import lru_cache
+
 import pymupdf
 
 from atelier_facture.utils import logger
+from atelier_facture.utils.depot import depot_actif, sha256_fichier
+from atelier_facture.utils.ecriture import attendre, ecrivain_actif
+from atelier_facture.utils.profilage import profileur, chronometrer
 # ====================== Utilitaires =======================
 
+def sauvegarder(doc: pymupdf.Document, output_path: Path, **options):
+    """
+    Enregistre un document. Si le dépôt est actif (voir `utils.depot`), le document est
+    stocké une fois par contenu et lié sous `output_path` ; si l'écriture asynchrone est
+    active (voir `utils.ecriture`), il est sérialisé en mémoire et écrit en arrière-plan.
+
+    :param options: Options de `Document.save`.
+    """
+    depot = depot_actif()
+    if depot is not None:
+        # Sans nouvel /ID, un même document donne les mêmes octets, donc le même objet
+        depot.deposer(Path(output_path), doc.tobytes(no_new_id=True, **options))
+        return
+    ecrivain = ecrivain_actif()
+    if ecrivain is not None:
+        ecrivain.ecrire(Path(output_path), doc.tobytes(**options))
+    else:
+        doc.save(str(output_path), **options)
+
+def empreinte_fichier(chemin: Path) -> tuple[int, str]:
+    """
+    Taille (octets) et empreinte SHA-256 d'un fichier écrit, relevées pour la vérification
+    finale (voir `etapes.verification`). Attend la fin de son écriture en arrière-plan.
+    """
+    attendre(chemin)
+    with open(chemin, 'rb') as f:
+        empreinte = sha256_fichier(f)
+        return f.tell(), empreinte
+
 def human_readable_size(size_in_bytes: int) -> str:
     """Convert a size in bytes to a human-readable string."""
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -16,16 +50,35 @@ def human_readable_size(size_in_bytes: int) -> str:
         size_in_bytes /= 1024.0
     return f"{size_in_bytes:.2f} PB"
 
+OPTIONS_COMPRESSION = dict(
+    garbage=4,  # clean up unreferenced objects
+    deflate=True,  # compress streams
+    deflate_images=True,
+    clean=True,  # clean up redundant objects
+    pretty=True,  # make PDF human-readable
+    linear=True,  # optimize for web viewing
+)
+
+@chronometrer('compress_pdf_inplace')
 def compress_pdf_inplace(input_path: Path):
     """
     Compress a PDF file in place using PyMuPDF.
 
     :param input_path: Path to the input PDF file, which will be modified in place.
     """
+    attendre(input_path)
+    if ecrivain_actif() is not None or depot_actif() is not None:
+        # Sérialisé en mémoire puis écrit en arrière-plan ou déposé, atomiquement
+        with pymupdf.open(str(input_path)) as doc:
+            profileur.compter_pages(doc.page_count)
+            sauvegarder(doc, input_path, **OPTIONS_COMPRESSION)
+        return
+
     original_size = input_path.stat().st_size
     try:
         # Ouvrir le document avec PyMuPDF
         doc = pymupdf.open(str(input_path))
+        profileur.compter_pages(doc.page_count)
 
         # Créer un fichier temporaire pour sauvegarder le PDF compressé
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
@@ -33,13 +86,7 @@ def compress_pdf_inplace(input_path: Path):
         temp_file.close()  # Fermer le fichier temporaire pour l'utiliser avec PyMuPDF
 
         # Sauvegarder le document compressé dans le fichier temporaire
-        doc.save(temp_output_path,
-                 garbage=4,  # clean up unreferenced objects
-                 deflate=True,  # compress streams
-                 deflate_images=True,
-                 clean=True,  # clean up redundant objects
-                 pretty=True,  # make PDF human-readable
-                 linear=True)  # optimize for web viewing
+        doc.save(temp_output_path, **OPTIONS_COMPRESSION)
         doc.close()
 
         # Remplacer le fichier d'origine par le fichier compressé
@@ -49,7 +96,7 @@ def compress_pdf_inplace(input_path: Path):
         compressed_size = input_path.stat().st_size
         compression_ratio = (1 - (compressed_size / original_size)) * 100
 
-        logger.debug(f"Compressed {input_path.name} ({compression_ratio:.2f}%).")
+        logger.debug("Compressed %s (%.2f%%).", input_path.name, compression_ratio, extra={'compteur': 'pdfs_compresses'})
 
     except Exception as e:
         logger.error(f"Error compressing {input_path.name}: {str(e)}")
@@ -129,9 +176,37 @@ def store_extended_metadata(doc, metadata: dict[str, str]):
         # add some private information
         doc.xref_set_key(xref, key, pymupdf.get_pdf_str(value))
 
+# ==================== Mise en page du texte ajouté ========================
+@lru_cache(maxsize=4096)
+def _decouper_lignes(texte_regroupement: str, fontname: str, fontsize: int, max_largeur: int) -> tuple[str, ...]:
+    def largeur_texte(texte: str) -> float:
+        return pymupdf.get_text_length(texte, fontname=fontname, fontsize=fontsize)
+
+    if largeur_texte(texte_regroupement) <= max_largeur:
+        return (texte_regroupement,)
+    # Les polices de base n'ont pas de crénage : en ASCII, la largeur d'une ligne est la somme
+    # de celles de ses mots et espaces, et chaque mot n'est mesuré qu'une fois. Les caractères
+    # accentués ne s'additionnent pas (encodage de get_text_length) : la ligne est remesurée.
+    additif = texte_regroupement.isascii()
+    espace = largeur_texte(" ")
+    lignes = []
+    ligne, largeur = "", 0.0
+    for mot in texte_regroupement.split():
+        largeur_mot = largeur_texte(mot)
+        candidate = largeur + espace + largeur_mot if additif else largeur_texte(ligne + " " + mot)
+        if candidate <= max_largeur:
+            ligne += " " + mot
+            largeur = candidate
+        else:
+            lignes.append(ligne.strip())
+            ligne, largeur = mot, largeur_mot
+    lignes.append(ligne.strip())
+    return tuple(lignes)
+
 def obtenir_lignes_regroupement(texte_regroupement: str, fontname: str, fontsize: int, max_largeur: int=500) -> list[str]:
     """
     Divise le texte de regroupement en plusieurs lignes si nécessaire pour s'adapter à la largeur maximale spécifiée.
+    Le découpage est mis en cache : un même groupement revient pour chacune de ses factures.
 
     Paramètres:
     texte_regroupement (str): Le texte de regroupement à ajouter.
@@ -142,25 +217,22 @@ def obtenir_lignes_regroupement(texte_regroupement: str, fontname: str, fontsize
     Retourne:
     list[str]: Une liste de lignes de texte adaptées à la largeur maximale spécifiée.
     """
-    
-    lignes = []
-    # Vérifier si le texte de regroupement est trop long pour une seule ligne
-    if pymupdf.get_text_length(texte_regroupement, fontname=fontname, fontsize=fontsize) > max_largeur:
-        # Diviser le texte en plusieurs lignes
-        mots = texte_regroupement.split()
-        ligne = ""
-        for mot in mots:
-            if pymupdf.get_text_length(ligne + " " + mot, fontname=fontname, fontsize=fontsize) <= max_largeur:
-                ligne += " " + mot
-            else:
-                lignes.append(ligne.strip())
-                ligne = mot
-        lignes.append(ligne.strip())
-    else:
-        lignes.append(texte_regroupement)
-    return lignes
+    return list(_decouper_lignes(texte_regroupement, fontname, fontsize, max_largeur))
+
+def inserer_lignes(page: pymupdf.Page, lignes: list[tuple[pymupdf.Point, str]], fontname: str, fontsize: int):
+    """
+    Écrit des lignes de texte sur une page en un seul flux de contenu. PyMuPDF n'installe
+    la police qu'une fois par document : les pages suivantes référencent la même.
+    """
+    if not lignes:
+        return
+    forme = page.new_shape()
+    for point, texte in lignes:
+        forme.insert_text(point, texte, fontsize=fontsize, fontname=fontname, color=(0, 0, 0))
+    forme.commit()
 
-def partial_pdf_copy(doc: pymupdf.Document, start_page: int, end_page: int, output_path: Path, metadata: dict|None=None) -> None:
+def partial_pdf_copy(doc: pymupdf.Document, start_page: int, end_page: int, output_path: Path, metadata: dict|None=None,
+                     transformations: list|None=None) -> None:
     """
     Crée un nouveau fichier PDF à partir des pages spécifiées d'un document source,
     et ajoute les métadonnées spécifiées.
@@ -170,6 +242,8 @@ def partial_pdf_copy(doc: pymupdf.Document, start_page: int, end_page: int, outp
     :param end_page: Index de la page de fin (exclus).
     :param output_path: Chemin de sauvegarde du nouveau fichier PDF.
     :param metadata: Dictionnaire contenant les métadonnées à ajouter.
+    :param transformations: Transformations appliquées avant l'enregistrement, comme avec
+                            `apply_pdf_transformations` : le fichier n'est écrit qu'une fois.
     """
     with pymupdf.open() as new_doc:
         # Insérer les pages du document source dans le nouveau document
@@ -178,28 +252,92 @@ def partial_pdf_copy(doc: pymupdf.Document, start_page: int, end_page: int, outp
 
         if metadata is not None:
             new_doc.set_metadata(metadata)
+        for transform_func, *args in transformations or []:
+            transform_func(new_doc, *args)
         # Sauvegarder le nouveau fichier PDF
-        new_doc.save(output_path)
+        sauvegarder(new_doc, output_path)
 
-def concat_pdfs(paths: list[Path], output_path: Path, metadata: dict|None=None) -> None:
+@chronometrer('concat_pdfs', argument=1)
+def concat_pdfs(paths: list[Path], output_path: Path, metadata: dict|None=None, compresser: bool=False) -> list[int]:
     """
     Concatène une liste de fichiers PDF en un seul fichier.
 
     Arguments :
     :paths list[Path]: liste de chemins vers les fichiers PDF à concaténer (type : list[Path])
     :output_path Path:chemin vers le fichier de sortie (type : Path)
+    :compresser bool: enregistre le fichier compressé (voir `compress_pdf_inplace`), en une seule écriture
+    :return: Le nombre de pages de chaque PDF concaténé.
     """
+    pages = []
     # Créer un nouveau document PDF vide
     with pymupdf.Document() as pdf_final:
         for chemin_pdf in paths:
+            attendre(chemin_pdf)
             with pymupdf.Document(str(chemin_pdf)) as pdf_a_ajouter:
                 # Ajouter chaque page du document actuel au PDF final
                 for page_index in range(len(pdf_a_ajouter)):
                     pdf_final.insert_pdf(pdf_a_ajouter, from_page=page_index, to_page=page_index)
+                pages.append(pdf_a_ajouter.page_count)
+        profileur.compter_pages(pdf_final.page_count)
         if metadata is not None:
             pdf_final.set_metadata(metadata)
         # Enregistrer le PDF final
-        pdf_final.save(str(output_path))
+        sauvegarder(pdf_final, output_path, **(OPTIONS_COMPRESSION if compresser else {}))
+    return pages
+
+# PDFs sources par morceau de `concat_pdfs_par_morceaux`
+TAILLE_MORCEAU = 200
+
+def concat_pdfs_par_morceaux(paths: list[Path], output_path: Path, metadata: dict|None=None,
+                             taille_morceau: int=TAILLE_MORCEAU) -> list[int]:
+    """
+    Concatène et compresse une liste de PDFs en mémoire bornée, pour les très grands
+    groupements : `concat_pdfs` garde tout le document en mémoire.
+
+    Les PDFs sont réunis par morceaux de `taille_morceau`, chaque morceau est compressé
+    (les ressources communes à ses PDFs, polices notamment, ne sont gardées qu'une fois)
+    puis ajouté au fichier de sortie par une sauvegarde incrémentale, le document étant
+    refermé entre deux morceaux. Une dernière réécriture élimine les versions successives
+    de l'arbre des pages laissées par les sauvegardes incrémentales. Les ressources ne sont
+    pas dédoublonnées d'un morceau à l'autre et le fichier n'est pas linéarisé : l'un et
+    l'autre demandent une comparaison ou une réécriture du document entier, dont le coût
+    croît plus vite que sa taille.
+
+    :return: Le nombre de pages de chaque PDF concaténé.
+    """
+    output_path = Path(output_path)
+    options = {k: v for k, v in OPTIONS_COMPRESSION.items() if k != 'linear'}
+    depot = depot_actif()
+    pages = []
+    with tempfile.TemporaryDirectory(dir=output_path.parent, prefix=f'.{output_path.stem}.') as travail:
+        sortie = Path(travail) / output_path.name
+        for debut in range(0, len(paths), taille_morceau):
+            morceau = Path(travail) / 'morceau.pdf'
+            with pymupdf.Document() as doc:
+                for chemin_pdf in paths[debut:debut + taille_morceau]:
+                    attendre(chemin_pdf)
+                    with pymupdf.Document(str(chemin_pdf)) as pdf_a_ajouter:
+                        doc.insert_pdf(pdf_a_ajouter)
+                        pages.append(pdf_a_ajouter.page_count)
+                if debut == 0:
+                    if metadata is not None:
+                        doc.set_metadata(metadata)
+                    doc.save(str(sortie), no_new_id=depot is not None, **options)
+                    continue
+                doc.save(str(morceau), **options)
+            with pymupdf.open(str(sortie)) as doc, pymupdf.open(str(morceau)) as pdf_morceau:
+                doc.insert_pdf(pdf_morceau)
+                doc.save(str(sortie), incremental=True, encryption=pymupdf.PDF_ENCRYPT_KEEP,
+                         no_new_id=depot is not None)
+        finale = Path(travail) / 'final.pdf'
+        with pymupdf.open(str(sortie)) as doc:
+            doc.save(str(finale), garbage=1, deflate=True, no_new_id=depot is not None)
+        profileur.compter_pages(sum(pages))
+        if depot is not None:
+            depot.lier(depot.stocker_fichier(finale), output_path)
+        else:
+            os.replace(finale, output_path)
+    return pages
 
 # ============== Opérations modification uniques ========================
 def ajouter_ligne_regroupement(fichier_pdf : Path, output_dir: Path, group_name : str, cible:str='Votre espace client :', fontname : str="hebo", fontsize : int=11):
@@ -292,10 +430,9 @@ def ajouter_ligne_regroupement_doc(doc, group: str|None=None, cible:str = 'Votre
         zones_texte = page.search_for(cible)
         interligne = 12
         # Ajouter la ligne spécifique en dessous du texte trouvé
-        for rect in zones_texte:
-            for i, l in enumerate(lignes):
-                page.insert_text((rect.x0, rect.y0 + interligne*(3 + i)), l, fontsize=fontsize, fontname=fontname, color=(0, 0, 0))
-                    
+        inserer_lignes(page, [(pymupdf.Point(rect.x0, rect.y0 + interligne*(3 + i)), l)
+                              for rect in zones_texte for i, l in enumerate(lignes)], fontname, fontsize)
+
 def remplacer_texte_doc(doc, ancien_texte, nouveau_texte, fontname="hebo", fontsize=11):
     for page_num in range(doc.page_count):
         page = doc.load_page(page_num)
@@ -305,8 +442,7 @@ def remplacer_texte_doc(doc, ancien_texte, nouveau_texte, fontname="hebo", fonts
             for rect in zones_texte:
                 page.add_redact_annot(rect)
             page.apply_redactions()
-            for rect in zones_texte:
-                page.insert_text((rect.x0, rect.y0 + 9.5), nouveau_texte, fontsize=fontsize, fontname=fontname, color=(0, 0, 0))
+            inserer_lignes(page, [(pymupdf.Point(rect.x0, rect.y0 + 9.5), nouveau_texte) for rect in zones_texte], fontname, fontsize)
   
 def caviarder_texte_doc(doc, cible, x=None, y=None):
     for page_num in range(doc.page_count):
@@ -322,19 +458,27 @@ def caviarder_texte_doc(doc, cible, x=None, y=None):
             page.apply_redactions()
 
 # ============== Chainage des Opérations ===================
-def apply_pdf_transformations(input_pdf_path, output_pdf_path, transformations):
+def apply_pdf_transformations(input_pdf_path, output_pdf_path, transformations) -> int:
     """
     Apply a series of transformations to a PDF file.
+
+    :return: The page count of the transformed PDF.
     """
     # Open the PDF
+    attendre(input_pdf_path)
     doc = pymupdf.open(input_pdf_path)
+    pages = doc.page_count
 
     # Apply each transformation
     for transform_func, *args in transformations:
         transform_func(doc, *args)
 
+    if ecrivain_actif() is not None or depot_actif() is not None:
+        # Serialised in memory: the input file can be replaced safely
+        sauvegarder(doc, output_pdf_path)
+        doc.close()
     # If input and output paths are the same, use a temporary file
-    if input_pdf_path == output_pdf_path:
+    elif input_pdf_path == output_pdf_path:
         # Create a temporary file in the same directory as the input file
         with tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(input_pdf_path), suffix='.pdf') as tmp_file:
             temp_output_path = tmp_file.name
@@ -349,6 +493,7 @@ def apply_pdf_transformations(input_pdf_path, output_pdf_path, transformations):
         # Save directly to the output path if it's different from the input
         doc.save(output_pdf_path)
         doc.close()
+    return pages
 
 
 if __name__ == "__main__":
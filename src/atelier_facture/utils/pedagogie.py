@@ -37,33 +37,71 @@ def afficher_arborescence_travail(console:Console, p:Path, ip:Path, ep:Path, fp:
     console.print("• Cette structure représente l'organisation générale")
     console.print()
 
-def dataframe_to_table(df: DataFrame, title:str) -> Table:
-    table = Table(title=title)
+# Lignes affichées au plus par tableau : au-delà, le détail complet est écrit dans un fichier
+LIGNES_AFFICHEES = 20
+# Colonnes des factures affichées dans les tableaux, quand elles existent
+COLONNES_AFFICHEES = ['id', 'type', 'groupement', 'membre', 'pdl', 'date']
+
+def ecrire_details(df: DataFrame, chemin: Path | None) -> Path | None:
+    """
+    Écrit `df` en CSV dans `chemin`, ou supprime un détail précédent s'il est vide.
+
+    :return: Le chemin écrit, None s'il n'y a rien à détailler.
+    """
+    if chemin is None:
+        return None
+    if df.empty:
+        chemin.unlink(missing_ok=True)
+        return None
+    df.to_csv(chemin)
+    return chemin
+
+def dataframe_to_table(df: DataFrame, title:str, max_lignes: int | None=LIGNES_AFFICHEES,
+                       details: Path | None=None) -> Table:
+    """
+    Tableau Rich des `max_lignes` premières lignes de `df` (toutes si None), le nombre de
+    lignes non affichées et le fichier de détail en légende.
+    """
+    caption = None
+    if max_lignes is not None and len(df) > max_lignes:
+        caption = f"… {len(df) - max_lignes} lignes de plus"
+        if details is not None:
+            caption += f", détail complet dans {details}"
+        df = df.head(max_lignes)
+    table = Table(title=title, caption=caption)
     
     # Ajouter les colonnes que vous voulez afficher
     for column in df.columns:
-        table.add_column(column)
+        table.add_column(str(column))
     
     # Ajouter les lignes
-    for _, row in df.iterrows():
+    for row in df.itertuples(index=False, name=None):
         table.add_row(*[str(value) for value in row])
     return table
 
-def etat_avancement(console: Console, df: DataFrame, ip:Path, ep:Path, fp:Path):
-    # Extraction
-    
+def compter_extraits(df: DataFrame) -> DataFrame:
+    """Par type de facture, nombre total, extraits et manquants, en une agrégation."""
+    comptes = df.groupby('type')['fichier_extrait'].agg(total='size', extraits='count')
+    comptes['manquants'] = comptes['total'] - comptes['extraits']
+    return comptes
+
+def etat_avancement(console: Console, df: DataFrame, ip:Path, ep:Path, fp:Path, details: Path | None=None):
+    """
+    Avancement de l'extraction par type de facture.
+
+    :param details: Fichier CSV où écrire toutes les factures sans PDF extrait.
+    """
     console.print(f"Extraction des fichiers") 
     types = ['mono', 'pdl', 'groupement']
+    comptes = compter_extraits(df)
+    manquants = df[df['type'].isin(types) & df['fichier_extrait'].isna()]
+    details = ecrire_details(manquants, details)
     
     for type in types:
-        todo = df[df['type'] == type]
-        total_count = len(todo)
-
-        if total_count == 0:
+        if type not in comptes.index:
             console.print(f"Type {type}: Aucun élément trouvé")
             continue
-        extracted_count = todo['fichier_extrait'].notna().sum()
-        missing_count = total_count - extracted_count
+        total_count, extracted_count, missing_count = comptes.loc[type, ['total', 'extraits', 'manquants']]
         
         console.print(f"Type {type}:")
         console.print(f"  Total: {total_count}")
@@ -72,14 +110,16 @@ def etat_avancement(console: Console, df: DataFrame, ip:Path, ep:Path, fp:Path):
         
         if missing_count > 0:
             console.print(f"  Manquants: {missing_count}")
-            missing_df = todo[todo['fichier_extrait'].isna()]
-
-            
-            console.print(dataframe_to_table(missing_df, f"[red]Éléments manquants pour le type [bold]{type}[/bold][/red]"))
+            missing_df = manquants.loc[manquants['type'] == type, [c for c in COLONNES_AFFICHEES if c in manquants.columns]]
+            console.print(dataframe_to_table(missing_df, f"[red]Éléments manquants pour le type [bold]{type}[/bold][/red]",
+                                             details=details))
         
         console.print()  # Ligne vide pour la lisibilité
 
-def rapport_extraction(attendu: DataFrame, extrait:DataFrame, console: Console|None=None):
+def rapport_extraction(attendu: DataFrame, extrait:DataFrame, console: Console|None=None, details: Path | None=None):
+    """
+    :param details: Fichier CSV où écrire toutes les lignes extraites dont l'id est en double.
+    """
     if console is None:
         console = Console()
 
@@ -90,16 +130,51 @@ def rapport_extraction(attendu: DataFrame, extrait:DataFrame, console: Console|N
     console.print(f"Nombre total de fichiers extraits : {total_fichiers}")
     console.print(f"Nombre de factures unitaires : {factures_unitaires}/{factures_unitaires_attendues} ({factures_unitaires/factures_unitaires_attendues*100:.2f}%)")
     console.print(f"Nombre de factures groupées : {factures_groupees}")
-    console.print(attendu)
+    if 'type' in attendu.columns:
+        console.print(dataframe_to_table(attendu['type'].value_counts().rename('attendues').reset_index(),
+                                         "Factures attendues par type"))
+    else:
+        console.print(f"Nombre de factures attendues : {len(attendu)}")
     # Affichage des valeurs uniques des dates
     console.print("\nDates uniques :")
-    dates_uniques = extrait['date'].unique()
-    for date in sorted(dates_uniques):
-        console.print(f"- {date}")
+    dates = extrait['date'].value_counts().sort_index()
+    for date, nombre in dates.head(LIGNES_AFFICHEES).items():
+        console.print(f"- {date} ({nombre})")
+    if len(dates) > LIGNES_AFFICHEES:
+        console.print(f"… {len(dates) - LIGNES_AFFICHEES} dates de plus")
 
-    # TODO: Chercher les duplicatas afficher que les id uniques
     console.print("\nID uniques avec duplicatas :")
-    duplicatas = extrait[extrait.duplicated(subset=['id'], keep=False)]
+    occurrences = extrait['id'].value_counts()
+    occurrences = occurrences[occurrences > 1].rename('occurrences').reset_index()
+    details = ecrire_details(extrait[extrait['id'].isin(occurrences['id'])], details)
+    if occurrences.empty:
+        console.print("Aucun")
+    else:
+        console.print(dataframe_to_table(occurrences, f"{len(occurrences)} ids en double", details=details))
+
+def afficher_profil(console: Console, profileur, top_n: int=10):
+    """
+    Affiche les mesures par étape et les fichiers les plus lents d'un `Profileur`.
+    """
+    from atelier_facture.utils.pdf_utils import human_readable_size
+
+    etapes = Table(title="Profil par étape")
+    for colonne in ["Étape", "Durée (s)", "CPU (s)", "Pic RSS", "Pages", "Lu", "Écrit"]:
+        etapes.add_column(colonne)
+    for m in profileur.etapes:
+        etapes.add_row(
+            m.nom, f"{m.duree:.2f}", f"{m.cpu:.2f}", human_readable_size(m.pic_rss), str(m.pages),
+            human_readable_size(m.octets_lus) if m.octets_lus is not None else "-",
+            human_readable_size(m.octets_ecrits) if m.octets_ecrits is not None else "-",
+        )
+    console.print(etapes)
+
+    lents = Table(title=f"{top_n} fichiers les plus lents")
+    for colonne in ["Opération", "Fichier", "Durée (s)", "Pages"]:
+        lents.add_column(colonne)
+    for m in profileur.plus_lents(top_n):
+        lents.add_row(m.operation, Path(m.fichier).name, f"{m.duree:.2f}", str(m.pages))
+    console.print(lents)
 
 def with_progress_bar(description: str = "Processing..."):
     def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
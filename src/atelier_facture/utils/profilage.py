@@ -0,0 +1,182 @@
+"""
+Mesure du temps passé par étape et par fichier (option `--profile`).
+
+Le profileur est un singleton inactif par défaut : tant que `profileur.activer()`
+n'a pas été appelé, les mesures se réduisent à un test booléen.
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable
+
+def _octets_io() -> tuple[int, int] | None:
+    """
+    Octets lus et écrits sur le stockage par le processus depuis son démarrage (Linux
+    uniquement). Les lectures servies par le cache de pages, dont celles des modules
+    importés, ne sont pas comptées.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            valeurs = dict(ligne.split(': ') for ligne in f.read().splitlines())
+        return int(valeurs['read_bytes']), int(valeurs['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _pic_rss() -> int:
+    """
+    Pic de mémoire résidente (octets) du processus et de ses enfants terminés.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    facteur = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss est en Ko sous Linux
+    soi = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    enfants = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(soi, enfants) * facteur
+
+@dataclass
+class MesureEtape:
+    nom: str
+    duree: float = 0.0
+    cpu: float = 0.0
+    pic_rss: int = 0
+    pages: int = 0
+    octets_lus: int | None = None
+    octets_ecrits: int | None = None
+
+@dataclass
+class MesureFichier:
+    operation: str
+    fichier: str
+    duree: float
+    etape: str | None = None
+    pages: int = 0
+
+@dataclass
+class Profileur:
+    actif: bool = False
+    etapes: list[MesureEtape] = field(default_factory=list)
+    fichiers: list[MesureFichier] = field(default_factory=list)
+    _etape_courante: MesureEtape | None = None
+
+    def activer(self):
+        self.actif = True
+
+    def reinitialiser(self):
+        """Oublie les mesures déjà enregistrées."""
+        self.etapes.clear()
+        self.fichiers.clear()
+        self._etape_courante = None
+
+    @contextmanager
+    def etape(self, nom: str):
+        """
+        Mesure le temps réel, le temps CPU, le pic de mémoire et les entrées/sorties d'une étape.
+        Le temps CPU et les entrées/sorties des processus de travail sont ajoutés par `integrer`.
+        """
+        if not self.actif:
+            yield
+            return
+        mesure = MesureEtape(nom)
+        self._etape_courante = mesure
+        io_debut = _octets_io()
+        cpu_debut = time.process_time()
+        debut = time.perf_counter()
+        try:
+            yield
+        finally:
+            mesure.duree = time.perf_counter() - debut
+            mesure.cpu += time.process_time() - cpu_debut
+            mesure.pic_rss = _pic_rss()
+            io_fin = _octets_io()
+            if io_debut is not None and io_fin is not None:
+                mesure.octets_lus = (mesure.octets_lus or 0) + io_fin[0] - io_debut[0]
+                mesure.octets_ecrits = (mesure.octets_ecrits or 0) + io_fin[1] - io_debut[1]
+            self.etapes.append(mesure)
+            self._etape_courante = None
+
+    @contextmanager
+    def fichier(self, operation: str, fichier: Any):
+        """
+        Mesure le temps d'une opération sur un fichier.
+        """
+        if not self.actif:
+            yield
+            return
+        pages_debut = self._etape_courante.pages if self._etape_courante else 0
+        debut = time.perf_counter()
+        try:
+            yield
+        finally:
+            pages = self._etape_courante.pages - pages_debut if self._etape_courante else 0
+            self.fichiers.append(MesureFichier(
+                operation=operation,
+                fichier=str(fichier),
+                duree=time.perf_counter() - debut,
+                etape=self._etape_courante.nom if self._etape_courante else None,
+                pages=pages,
+            ))
+
+    def etape_en_cours(self) -> str | None:
+        """Nom de l'étape mesurée en cours, None si le profileur est inactif."""
+        return self._etape_courante.nom if self.actif and self._etape_courante is not None else None
+
+    def compter_pages(self, n: int):
+        """Ajoute `n` pages traitées à l'étape en cours."""
+        if self.actif and self._etape_courante is not None:
+            self._etape_courante.pages += n
+
+    def integrer(self, etape: MesureEtape, fichiers: list[MesureFichier]):
+        """
+        Ajoute à l'étape en cours les mesures d'une tâche exécutée dans un processus de
+        travail (voir `utils.supervision`) : temps CPU, pages, entrées/sorties et durées par fichier.
+        """
+        if not self.actif or self._etape_courante is None:
+            return
+        courante = self._etape_courante
+        courante.cpu += etape.cpu
+        courante.pages += etape.pages
+        if etape.octets_lus is not None:
+            courante.octets_lus = (courante.octets_lus or 0) + etape.octets_lus
+            courante.octets_ecrits = (courante.octets_ecrits or 0) + etape.octets_ecrits
+        for mesure in fichiers:
+            mesure.etape = courante.nom
+        self.fichiers.extend(fichiers)
+
+    def plus_lents(self, n: int=10) -> list[MesureFichier]:
+        return sorted(self.fichiers, key=lambda m: m.duree, reverse=True)[:n]
+
+    def rapport(self, top_n: int=10) -> dict:
+        return {
+            'etapes': [asdict(m) for m in self.etapes],
+            'fichiers': [asdict(m) for m in self.fichiers],
+            'plus_lents': [asdict(m) for m in self.plus_lents(top_n)],
+        }
+
+    def ecrire_rapport(self, chemin: Path, top_n: int=10):
+        chemin.parent.mkdir(parents=True, exist_ok=True)
+        with open(chemin, 'w', encoding='utf-8') as f:
+            json.dump(self.rapport(top_n), f, indent=2, ensure_ascii=False)
+
+profileur = Profileur()
+
+def chronometrer(operation: str, argument: int=0) -> Callable:
+    """
+    Décorateur enregistrant la durée de chaque appel, associée au fichier passé
+    en position `argument`.
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profileur.actif:
+                return func(*args, **kwargs)
+            fichier = args[argument] if len(args) > argument else None
+            with profileur.fichier(operation, fichier):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
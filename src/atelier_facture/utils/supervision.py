@@ -0,0 +1,294 @@
+"""
+Pool de processus supervisé pour le traitement document par document : chaque tâche a
+un budget de temps et de mémoire, et un processus qui le dépasse est tué puis remplacé
+sans interrompre les autres. Une tâche qui lève une exception ou fait planter son
+processus (PDF malformé faisant échouer MuPDF) est signalée de la même façon, comme un
+échec, et l'appelant met le document en quarantaine (voir `Quarantaine`).
+
+Avec `ProcessPoolExecutor`, une tâche ne peut pas être interrompue et un processus tué
+rend tout le pool inutilisable : chaque processus a donc ici sa propre connexion, ce
+qui permet de savoir quelle tâche il exécute.
+
+Les budgets sont désactivés par défaut et fixés par `configurer` (options
+`--delai-document` et `--memoire-document`). La mémoire est celle résidente du
+processus, relevée dans /proc : le budget mémoire n'est appliqué que sous Linux.
+"""
+import csv
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from multiprocessing.connection import Connection, wait
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from atelier_facture.utils import logger
+from atelier_facture.utils.profilage import profileur
+
+# Intervalle de contrôle des budgets (s)
+INTERVALLE = 0.2
+
+_configuration: dict = {'delai': None, 'memoire': None}
+
+def configurer(delai: float | None=None, memoire: int | None=None):
+    """
+    Fixe les budgets des pools créés ensuite dans le processus courant.
+
+    :param delai: Durée maximale d'une tâche (s), pondérée par son poids (voir `Superviseur.executer`).
+    :param memoire: Mémoire résidente maximale d'un processus de travail (octets).
+    """
+    _configuration.update(delai=delai, memoire=memoire)
+
+def configuration() -> dict:
+    return dict(_configuration)
+
+def budget_actif() -> bool:
+    return _configuration['delai'] is not None or _configuration['memoire'] is not None
+
+def _memoire_residente(pid: int) -> int | None:
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+# ======================= Côté processus de travail ==========================
+def _travailleur(connexion: Connection, initializer: Callable | None, initargs: tuple):
+    # Ctrl-C est géré par le superviseur, qui arrête les processus
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            tache = connexion.recv()
+        except EOFError:
+            return
+        if tache is None:
+            return
+        index, fonction, args, etape = tache
+        # Profileur du parent actif : la tâche est mesurée comme une étape, renvoyée avec son résultat
+        profileur.actif = etape is not None
+        profileur.reinitialiser()
+        try:
+            with profileur.etape(etape):
+                resultat = fonction(*args)
+            connexion.send((index, True, resultat, _mesures()))
+        except Exception as e:
+            connexion.send((index, False, f"{type(e).__name__} : {e}", _mesures()))
+
+def _mesures() -> tuple | None:
+    """Mesures de la dernière tâche du processus de travail, à intégrer au profileur du parent."""
+    return (profileur.etapes[-1], profileur.fichiers[:]) if profileur.etapes else None
+
+def initialiser_processus(config_logs: dict, config_ecriture: dict, config_depot: dict):
+    """Initialisation des processus de travail : mêmes logs, même mode d'écriture et même dépôt que le parent."""
+    from atelier_facture.utils import depot, ecriture, setup_logger
+    if config_logs['production']:
+        # Le thread d'écriture des logs du parent n'existe pas dans le processus fils
+        setup_logger(**config_logs)
+    elif not logger.handlers:  # processus démarré par "spawn", sans la configuration du parent
+        setup_logger(config_logs['verbosity'])
+    ecriture.configurer(**config_ecriture)
+    depot.configurer(**config_depot)
+
+# ======================= Côté superviseur ===================================
+@dataclass
+class _Processus:
+    processus: multiprocessing.Process
+    connexion: Connection
+    tache: int | None = None
+    debut: float = 0.0
+    limite: float | None = None
+
+class Superviseur:
+    """
+    Pool de `workers` processus supervisés, conservés d'un appel à `executer` à l'autre.
+
+    :param delai: Durée maximale d'une tâche de poids 1 (s), None pour ne pas la limiter.
+    :param memoire: Mémoire résidente maximale d'un processus (octets), None pour ne pas la limiter.
+    """
+    def __init__(self, workers: int | None=None, initializer: Callable | None=None, initargs: tuple=(),
+                 delai: float | None=None, memoire: int | None=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.initializer = initializer
+        self.initargs = initargs
+        self.delai = delai
+        self.memoire = memoire
+        self._processus: list[_Processus] = []
+
+    def _demarrer(self) -> _Processus:
+        parent, enfant = multiprocessing.Pipe()
+        processus = multiprocessing.Process(target=_travailleur, args=(enfant, self.initializer, self.initargs),
+                                            daemon=True)
+        processus.start()
+        enfant.close()
+        return _Processus(processus, parent)
+
+    def _remplacer(self, p: _Processus):
+        if p.processus.is_alive():
+            p.processus.kill()
+        p.processus.join()
+        p.connexion.close()
+        self._processus[self._processus.index(p)] = self._demarrer()
+
+    def _depassement(self, p: _Processus, maintenant: float) -> str | None:
+        if p.limite is not None and maintenant - p.debut > p.limite:
+            return f"délai de {p.limite:g} s dépassé"
+        if self.memoire is not None:
+            rss = _memoire_residente(p.processus.pid)
+            if rss is not None and rss > self.memoire:
+                return f"mémoire de {self.memoire // 2**20} Mo dépassée ({rss // 2**20} Mo)"
+        return None
+
+    def executer(self, fonction: Callable, taches: list[tuple],
+                 poids: list[float] | None=None) -> Iterator[tuple[int, bool, Any]]:
+        """
+        Exécute `fonction(*args)` pour chaque `args` de `taches`.
+
+        Les tâches sont distribuées par un thread : les processus restent occupés pendant
+        que l'appelant traite les résultats (consolidation du mode flux, par exemple).
+
+        :param fonction: Fonction de niveau module (transmise aux processus par pickle).
+        :param poids: Multiplicateur du délai de chaque tâche, 1 par défaut.
+        :return: Itérateur sur les tâches terminées, dans l'ordre de fin : `(index, True, résultat)`
+                 ou `(index, False, raison de l'échec)`.
+        """
+        resultats: queue.SimpleQueue = queue.SimpleQueue()
+        arret = threading.Event()
+        distributeur = threading.Thread(target=self._distribuer, daemon=True,
+                                        args=(fonction, taches, poids, profileur.etape_en_cours(), resultats, arret))
+        distributeur.start()
+        try:
+            for _ in taches:
+                resultat = resultats.get()
+                if isinstance(resultat, BaseException):
+                    raise resultat
+                index, ok, valeur, mesures = resultat
+                if mesures is not None:
+                    profileur.integrer(*mesures)
+                yield index, ok, valeur
+        finally:
+            # Abandon en cours de route : le distributeur arrête les processus encore occupés
+            arret.set()
+            distributeur.join()
+
+    def _distribuer(self, fonction: Callable, taches: list[tuple], poids: list[float] | None,
+                    etape: str | None, resultats: queue.SimpleQueue, arret: threading.Event):
+        """Boucle du thread de distribution : chaque tâche donne exactement un résultat dans `resultats`."""
+        a_faire = deque(range(len(taches)))
+        try:
+            while len(self._processus) < min(self.workers, len(taches)):
+                self._processus.append(self._demarrer())
+            while (a_faire or any(p.tache is not None for p in self._processus)) and not arret.is_set():
+                for p in self._processus:
+                    if p.tache is None and a_faire:
+                        index = a_faire.popleft()
+                        p.tache, p.debut = index, time.monotonic()
+                        p.limite = self.delai * (poids[index] if poids else 1) if self.delai is not None else None
+                        p.connexion.send((index, fonction, taches[index], etape))
+                occupes = [p for p in self._processus if p.tache is not None]
+                # Délai d'attente borné même sans budget, pour voir un abandon de l'appelant
+                prets = wait([p.connexion for p in occupes] + [p.processus.sentinel for p in occupes],
+                             timeout=INTERVALLE)
+                maintenant = time.monotonic()
+                for p in occupes:
+                    if p.connexion in prets:
+                        try:
+                            index, ok, valeur, mesures = p.connexion.recv()
+                            p.tache = None
+                            resultats.put((index, ok, valeur, mesures))
+                            continue
+                        except EOFError:
+                            pass
+                    if p.connexion in prets or p.processus.sentinel in prets:
+                        p.processus.join()
+                        raison = f"processus arrêté (code {p.processus.exitcode})"
+                    else:
+                        raison = self._depassement(p, maintenant)
+                        if raison is None:
+                            continue
+                    index, p.tache = p.tache, None
+                    self._remplacer(p)
+                    resultats.put((index, False, raison, None))
+        except BaseException as e:
+            resultats.put(e)
+        finally:
+            for p in self._processus:
+                if p.tache is not None:
+                    p.tache = None
+                    self._remplacer(p)
+
+    def fermer(self):
+        for p in self._processus:
+            try:
+                p.connexion.send(None)
+            except OSError:
+                pass
+        for p in self._processus:
+            p.processus.join(timeout=5)
+            if p.processus.is_alive():
+                p.processus.kill()
+                p.processus.join()
+            p.connexion.close()
+        self._processus = []
+
+    def __enter__(self) -> 'Superviseur':
+        return self
+
+    def __exit__(self, *exc):
+        self.fermer()
+
+def creer_superviseur(workers: int | None=None) -> Superviseur:
+    """
+    Superviseur aux budgets configurés (voir `configurer`), dont les processus reprennent
+    les logs, le mode d'écriture et le dépôt du processus courant à sa création.
+    """
+    from atelier_facture.utils import depot, ecriture
+    from atelier_facture.utils.logger_config import configuration_logs
+    return Superviseur(workers, initialiser_processus,
+                       (configuration_logs(), ecriture.configuration(), depot.configuration()),
+                       **_configuration)
+
+# ======================= Quarantaine ========================================
+def _nom_fichier(valeur: str) -> str:
+    """Nom de fichier sûr pour un élément en quarantaine (groupement, lot/PDF)."""
+    return re.sub(r'[^\w.~-]+', '_', valeur).strip('_') or 'sans_nom'
+
+class Quarantaine:
+    """
+    Dossier des documents en échec : chaque document y est déplacé avec un fichier
+    `<nom>.erreur.txt` donnant la raison, et listé dans `quarantaine.csv`.
+    """
+    def __init__(self, dossier: Path):
+        self.dossier = Path(dossier)
+        self.nombre = 0
+
+    def mettre(self, element: str, raison: str, chemin: Path | None=None, nom: str | None=None):
+        """
+        :param element: Ce qui a échoué (PDF source, groupement), pour les logs et l'index.
+        :param chemin: Document à déplacer en quarantaine, s'il y en a un.
+        :param nom: Nom du document en quarantaine, celui de `chemin` par défaut ; les
+                    caractères interdits dans un nom de fichier ('/' notamment) sont remplacés.
+        """
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        nom = _nom_fichier(nom or (Path(chemin).name if chemin is not None else element))
+        if chemin is not None and Path(chemin).exists():
+            shutil.move(chemin, self.dossier / nom)
+        (self.dossier / f'{nom}.erreur.txt').write_text(f"{element}\n{raison}\n", encoding='utf-8')
+        index = self.dossier / 'quarantaine.csv'
+        nouveau = not index.exists()
+        with open(index, 'a', newline='', encoding='utf-8') as f:
+            ecrivain = csv.writer(f)
+            if nouveau:
+                ecrivain.writerow(['date', 'element', 'fichier', 'raison'])
+            ecrivain.writerow([datetime.now().isoformat(timespec='seconds'), element,
+                               nom if chemin is not None else '', raison])
+        self.nombre += 1
+        logger.error(f"{element} mis en quarantaine : {raison}")
@@ -0,0 +1,229 @@
+"""
+Lecture des tables envoyées par les clients (consignes, facturx) au format CSV ou Excel.
+
+Les fichiers Excel sont lus par python-calamine s'il est installé, sinon directement
+depuis le XML de la feuille (lecture en flux, sans construire les objets cellule d'openpyxl,
+deux à trois fois plus rapide que `pd.read_excel`) ; openpyxl en lecture seule reste le
+recours pour les classeurs de structure inattendue. Les valeurs sont lues comme le texte
+stocké dans le fichier, et les ids ramenés à des chaînes de 14 chiffres : un tableur les
+stocke comme des nombres, que pandas lirait en flottants. La table lue est mise en cache
+à côté du fichier source (`.<nom>.<feuille>.csv`) et relue tant que la source n'a pas
+été modifiée.
+
+Dépendances optionnelles : `pip install atelier_facture[excel]`.
+"""
+import os
+import re
+import zipfile
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from xml.etree.ElementTree import iterparse, parse
+
+import pandas as pd
+from pandas import DataFrame
+
+from atelier_facture.utils import logger
+
+EXTENSIONS_EXCEL = ('.xlsx', '.xlsm')
+COLONNES_ID = ['id', 'pdl', 'BT-1']
+
+def _texte(valeur) -> str | None:
+    """Valeur d'une cellule en chaîne, comme `pd.read_excel(dtype=str)` ; les nombres entiers sans décimale."""
+    if valeur is None or valeur == '':
+        return None
+    if isinstance(valeur, float) and valeur.is_integer():
+        return str(int(valeur))
+    return str(valeur)
+
+def _id(valeur) -> str | None:
+    if valeur is None or valeur != valeur:
+        return valeur
+    texte = str(valeur).strip()
+    if texte.endswith('.0') and texte[:-2].isdigit():
+        texte = texte[:-2]
+    return texte.zfill(14) if texte.isdigit() else texte
+
+def normaliser_ids(df: DataFrame) -> DataFrame:
+    """Ramène les colonnes d'ids présentes sur 14 chiffres."""
+    for colonne in COLONNES_ID:
+        if colonne in df.columns:
+            df[colonne] = df[colonne].map(_id)
+    return df
+
+def _lignes_calamine(chemin: Path, feuille: int | str):
+    from python_calamine import CalamineWorkbook
+    classeur = CalamineWorkbook.from_path(str(chemin))
+    nom = classeur.sheet_names[feuille] if isinstance(feuille, int) else feuille
+    return classeur.get_sheet_by_name(nom).iter_rows()
+
+def _lignes_openpyxl(chemin: Path, feuille: int | str):
+    from openpyxl import load_workbook
+    classeur = load_workbook(chemin, read_only=True, data_only=True, keep_links=False)
+    try:
+        onglet = classeur.worksheets[feuille] if isinstance(feuille, int) else classeur[feuille]
+        yield from onglet.iter_rows(values_only=True)
+    finally:
+        classeur.close()
+
+# ======================= Lecture directe du XML =============================
+_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_NS_PKG = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+# Formats de date prédéfinis d'Excel
+_FORMATS_DATE = set(range(14, 23)) | {45, 46, 47}
+_ORIGINE_EXCEL = datetime(1899, 12, 30)
+
+def _chemin_feuille(archive: zipfile.ZipFile, feuille: int | str) -> str:
+    onglets = parse(archive.open('xl/workbook.xml')).getroot().find(f'{_NS}sheets')
+    if onglets is None:
+        raise ValueError("Classeur sans feuilles")
+    onglets = list(onglets)
+    onglet = onglets[feuille] if isinstance(feuille, int) else next(o for o in onglets if o.get('name') == feuille)
+    cibles = {r.get('Id'): r.get('Target') for r in parse(archive.open('xl/_rels/workbook.xml.rels')).getroot().iter(f'{_NS_PKG}Relationship')}
+    cible = cibles[onglet.get(f'{_NS_REL}id')].lstrip('/')
+    return cible if cible.startswith('xl/') else f'xl/{cible}'
+
+def _chaines_partagees(archive: zipfile.ZipFile) -> list[str]:
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    chaines = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, element in iterparse(f):
+            if element.tag == f'{_NS}si':
+                chaines.append(''.join(t.text or '' for t in element.iter(f'{_NS}t')))
+                element.clear()
+    return chaines
+
+def _styles_date(archive: zipfile.ZipFile) -> set[int]:
+    """Indices des styles de cellule qui affichent une date."""
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+    racine = parse(archive.open('xl/styles.xml')).getroot()
+    formats_date = set(_FORMATS_DATE)
+    for fmt in racine.iter(f'{_NS}numFmt'):
+        # Hors texte littéral et couleurs, un format de date ou d'heure contient d, m, y, h ou s
+        code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '', fmt.get('formatCode', '')).lower()
+        if re.search(r'[dmyhs]', code):
+            formats_date.add(int(fmt.get('numFmtId')))
+    xfs = racine.find(f'{_NS}cellXfs')
+    return {i for i, xf in enumerate(xfs if xfs is not None else []) if int(xf.get('numFmtId', 0)) in formats_date}
+
+_CHIFFRES = '0123456789'
+
+@lru_cache(maxsize=None)
+def _colonne(lettres: str) -> int:
+    """Indice de la colonne 'A', 'B', ..., 'AA'..."""
+    numero = 0
+    for lettre in lettres:
+        numero = numero * 26 + ord(lettre.upper()) - 64
+    return numero - 1
+
+def _lignes_xml(chemin: Path, feuille: int | str):
+    archive = zipfile.ZipFile(chemin)
+    try:
+        feuille_xml = _chemin_feuille(archive, feuille)
+        chaines, dates = _chaines_partagees(archive), _styles_date(archive)
+    except (KeyError, StopIteration, IndexError) as e:
+        archive.close()
+        raise ValueError(f"Structure de classeur inattendue : {e}")
+    balise_ligne, balise_cellule, balise_valeur, balise_texte = f'{_NS}row', f'{_NS}c', f'{_NS}v', f'{_NS}t'
+    try:
+        with archive.open(feuille_xml) as f:
+            for _, element in iterparse(f):
+                if element.tag != balise_ligne:
+                    continue
+                ligne: list = []
+                for cellule in element:
+                    if cellule.tag != balise_cellule:
+                        continue
+                    type_cellule = cellule.get('t')
+                    if type_cellule == 'inlineStr':
+                        valeur = ''.join(t.text or '' for t in cellule.iter(balise_texte))
+                    else:
+                        v = cellule.find(balise_valeur)
+                        valeur = v.text if v is not None else None
+                        if valeur is None or type_cellule == 'e':
+                            valeur = None
+                        elif type_cellule == 's':
+                            valeur = chaines[int(valeur)]
+                        elif type_cellule == 'b':
+                            valeur = 'True' if valeur == '1' else 'False'
+                        elif type_cellule in (None, 'n'):
+                            if dates and int(cellule.get('s', 0)) in dates:
+                                # Excel stocke les dates en jours, à la milliseconde près
+                                valeur = str(_ORIGINE_EXCEL + timedelta(milliseconds=round(float(valeur) * 86400000)))
+                            elif not valeur.isdigit():
+                                # Flottant écrit sur 17 chiffres : texte le plus court, comme pandas
+                                valeur = _texte(float(valeur))
+                    reference = cellule.get('r')
+                    position = _colonne(reference.rstrip(_CHIFFRES)) if reference else len(ligne)
+                    ligne.extend([None] * (position - len(ligne)))
+                    ligne.append(valeur)
+                yield ligne
+                element.clear()
+    finally:
+        archive.close()
+
+def _lignes(chemin: Path, feuille: int | str):
+    try:
+        return _lignes_calamine(chemin, feuille)
+    except ImportError:
+        pass
+    try:
+        lignes = _lignes_xml(chemin, feuille)
+        premiere = next(lignes, None)
+        return iter([premiere, *lignes]) if premiere is not None else iter([])
+    except ValueError as e:
+        logger.debug(f"Lecture directe de {chemin.name} impossible ({e}), lecture par openpyxl.")
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        raise ImportError("Ce classeur nécessite python-calamine ou openpyxl : pip install atelier_facture[excel]")
+    return _lignes_openpyxl(chemin, feuille)
+
+def _cache(chemin: Path, feuille: int | str) -> Path:
+    return chemin.with_name(f'.{chemin.name}.{feuille}.csv')
+
+def lire_excel(chemin: Path, feuille: int | str=0, cache: bool=True) -> DataFrame:
+    """
+    Lit une feuille Excel, toutes les colonnes en chaînes et les ids sur 14 chiffres.
+
+    :param feuille: Indice ou nom de la feuille.
+    :param cache: Lit et écrit la table en cache à côté du fichier source.
+    """
+    chemin = Path(chemin)
+    fichier_cache = _cache(chemin, feuille)
+    if cache and fichier_cache.exists() and fichier_cache.stat().st_mtime_ns >= chemin.stat().st_mtime_ns:
+        logger.debug(f"{chemin.name} lu depuis le cache {fichier_cache.name}")
+        return pd.read_csv(fichier_cache, dtype=str)
+
+    lignes = _lignes(chemin, feuille)
+    entetes = next(iter(lignes), None)
+    if entetes is None:
+        return DataFrame()
+    colonnes = [str(e).strip() if e not in (None, '') else f'Unnamed: {i}' for i, e in enumerate(entetes)]
+    largeur = len(colonnes)
+    # Les lignes lues dans le XML sont creuses : complétées ou tronquées à la largeur de l'entête
+    donnees = [([_texte(v) for v in ligne] + [None] * (largeur - len(ligne)))[:largeur] for ligne in lignes]
+    # Les lignes vides en fin de feuille (mise en forme) sont ignorées
+    while donnees and all(v is None for v in donnees[-1]):
+        donnees.pop()
+    df = normaliser_ids(DataFrame(donnees, columns=colonnes, dtype=object))
+
+    if cache:
+        temporaire = fichier_cache.with_name(f'{fichier_cache.name}.{os.getpid()}.tmp')
+        try:
+            df.to_csv(temporaire, index=False)
+            os.replace(temporaire, fichier_cache)
+        except OSError as e:  # dossier source en lecture seule
+            temporaire.unlink(missing_ok=True)
+            logger.debug(f"Cache de {chemin.name} non écrit : {e}")
+    return df
+
+def lire_table(chemin: Path, feuille: int | str=0) -> DataFrame:
+    """Table CSV ou Excel, toutes les colonnes en chaînes et les ids sur 14 chiffres."""
+    chemin = Path(chemin)
+    if chemin.suffix.lower() in EXTENSIONS_EXCEL:
+        return lire_excel(chemin, feuille)
+    return normaliser_ids(pd.read_csv(chemin, dtype=str))
@@ -0,0 +1,77 @@
+"""
+Cache des textes des pages des PDFs sources, écrit à l'extraction dans
+`<atelier>/extrait/textes/` : un fichier `<2 premiers caractères>/<empreinte>.json.gz` par
+PDF source, adressé par l'empreinte SHA-256 de son contenu, qui contient le texte de
+chaque page (liste indexée par numéro de page). L'index `sources.csv` liste les PDFs
+sources découpés (empreinte, lot, nom), dans l'ordre de l'extraction.
+
+Après une modification des motifs de `extraction.extract_and_format_data`, la
+réextraction (voir `reextraction`) rejoue la recherche des motifs et le plan de
+découpage sur ce cache, sans relire les PDFs.
+"""
+import gzip
+import json
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+from pandas import DataFrame
+
+from atelier_facture.utils.depot import sha256_fichier
+
+NOM_INDEX = 'sources.csv'
+COLONNES_INDEX = ['source', 'lot', 'fichier_origine']
+# Le texte se compresse bien dès le niveau 1, bien plus rapide que le niveau 9 par défaut
+NIVEAU_COMPRESSION = 1
+
+def empreinte_source(chemin: Path) -> str:
+    """Empreinte SHA-256 d'un PDF source, clé de ses textes dans le cache."""
+    with open(chemin, 'rb') as f:
+        return sha256_fichier(f)
+
+class CacheTextes:
+    """Textes des pages des PDFs sources dans `dossier`, un fichier compressé par contenu."""
+    def __init__(self, dossier: Path):
+        self.dossier = Path(dossier)
+
+    def chemin(self, source: str) -> Path:
+        return self.dossier / source[:2] / f'{source}.json.gz'
+
+    def contient(self, source: str) -> bool:
+        return self.chemin(source).exists()
+
+    def ecrire(self, source: str, textes: list[str]):
+        """Écrit les textes des pages de `source`, s'ils ne sont pas déjà dans le cache."""
+        chemin = self.chemin(source)
+        if chemin.exists():
+            return
+        chemin.parent.mkdir(parents=True, exist_ok=True)
+        # Plusieurs processus peuvent écrire le même PDF source : écriture puis renommage atomique
+        temporaire = chemin.with_name(f'.{chemin.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            temporaire.write_bytes(gzip.compress(json.dumps(textes, ensure_ascii=False).encode('utf-8'),
+                                                 compresslevel=NIVEAU_COMPRESSION, mtime=0))
+            os.replace(temporaire, chemin)
+        finally:
+            temporaire.unlink(missing_ok=True)
+
+    def lire(self, source: str) -> list[str]:
+        """
+        :raises FileNotFoundError: Si les textes de `source` ne sont pas dans le cache.
+        """
+        return json.loads(gzip.decompress(self.chemin(source).read_bytes()).decode('utf-8'))
+
+    def ecrire_index(self, sources: list[dict]):
+        """Écrit l'index des PDFs sources découpés (colonnes `COLONNES_INDEX`)."""
+        self.dossier.mkdir(parents=True, exist_ok=True)
+        DataFrame(sources, columns=COLONNES_INDEX).to_csv(self.dossier / NOM_INDEX, index=False)
+
+    def lire_index(self) -> DataFrame:
+        """
+        :raises FileNotFoundError: Si l'extraction n'a pas écrit d'index (atelier extrait sans cache).
+        """
+        chemin = self.dossier / NOM_INDEX
+        if not chemin.exists():
+            raise FileNotFoundError(f"Pas de cache des textes dans {self.dossier} : l'extraction doit être refaite.")
+        return pd.read_csv(chemin, dtype=str)
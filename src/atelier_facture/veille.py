@@ -0,0 +1,247 @@
+"""
+Mode veille : surveille un dossier de réception et traite chaque nouveau zip dans
+son propre répertoire atelier, avec un pool de processus dont les imports lourds
+sont faits une fois pour toutes au démarrage.
+
+    atelier_facture_veille ~/reception ~/ateliers -w 4
+
+Organisation du dossier de réception :
+- `*.zip` : zips en attente ;
+- `.en_cours/<pid>/` : zips réclamés (déplacés atomiquement) par une instance de veille ;
+- `traites/` et `erreurs/` : zips traités, avec un fichier `.erreur.txt` en cas d'échec ;
+- `etat.json` : file d'attente, travaux en cours et durées des derniers travaux.
+"""
+import argparse
+import json
+import os
+import signal
+import time
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+
+from atelier_facture.utils import logger, setup_logger
+
+EN_COURS = '.en_cours'
+TRAITES = 'traites'
+ERREURS = 'erreurs'
+FICHIER_ETAT = 'etat.json'
+
+@dataclass
+class Travail:
+    zip: str
+    atelier: str
+    debut: float
+    fin: float | None = None
+    duree: float | None = None
+    erreur: str | None = None
+
+# ======================= Côté processus de travail ==========================
+def _prechauffer(verbosite: int, depot: Path | None=None):
+    """
+    Initialisation des processus du pool : configure les logs et le dépôt partagé, et
+    importe les dépendances lourdes pour que le premier zip ne paie pas leur chargement.
+    """
+    # Ctrl-C est géré par le superviseur, qui laisse les travaux en cours se terminer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logger(verbosite)
+    if depot is not None:
+        from atelier_facture.utils import depot as depot_objets
+        depot_objets.configurer(depot)
+    import pandas  # noqa: F401
+    import pymupdf  # noqa: F401
+    from atelier_facture.etapes import extraction, consolidation, fusion, formatage  # noqa: F401
+    from atelier_facture.utils import mpl  # noqa: F401
+
+def traiter_zip(zip_path: Path, atelier: Path) -> float:
+    """
+    Exécute toutes les étapes pour un zip dans un atelier dédié.
+
+    :return: La durée du traitement (s).
+    """
+    from rich.console import Console
+    from atelier_facture.orchestrateur import Contexte, selectionner_etapes, executer_etapes
+
+    debut = time.perf_counter()
+    ctx = Contexte(racine=atelier, entree=zip_path, console=Console(quiet=True))
+    executer_etapes(ctx, selectionner_etapes())
+    return time.perf_counter() - debut
+
+# ======================= Côté superviseur ===================================
+def _processus_actif(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def reclamer(zip_path: Path, dossier_en_cours: Path) -> Path | None:
+    """
+    Réclame un zip en le déplaçant dans `dossier_en_cours`. Le renommage est atomique sur un
+    même système de fichiers : si plusieurs instances surveillent le même dossier, une
+    seule réussit.
+
+    :return: Le nouveau chemin du zip, ou None s'il a été réclamé par une autre instance.
+    """
+    cible = dossier_en_cours / zip_path.name
+    try:
+        os.rename(zip_path, cible)
+    except FileNotFoundError:
+        return None
+    return cible
+
+def zips_prets(reception: Path, delai_stabilite: float) -> list[Path]:
+    """
+    Zips en attente, du plus ancien au plus récent. Un zip modifié depuis moins de
+    `delai_stabilite` secondes est considéré en cours de copie et ignoré.
+    """
+    maintenant = time.time()
+    zips = []
+    for chemin in reception.glob('*.zip'):
+        try:
+            mtime = chemin.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if maintenant - mtime >= delai_stabilite:
+            zips.append((mtime, chemin))
+    return [chemin for _, chemin in sorted(zips)]
+
+def repertoire_atelier(zip_path: Path, ateliers: Path) -> Path:
+    """Répertoire atelier dédié à un zip, horodaté si le nom est déjà pris."""
+    atelier = ateliers / zip_path.stem
+    if atelier.exists():
+        atelier = ateliers / f"{zip_path.stem}_{datetime.now():%Y%m%d_%H%M%S}"
+    return atelier
+
+class Veille:
+    """
+    Boucle de surveillance du dossier de réception.
+
+    :param reception: Dossier surveillé.
+    :param ateliers: Dossier où sont créés les répertoires atelier.
+    :param workers: Nombre de processus de travail.
+    :param intervalle: Délai entre deux inspections du dossier (s).
+    :param delai_stabilite: Âge minimal d'un zip avant d'être réclamé (s).
+    :param historique: Nombre de travaux terminés conservés dans le fichier d'état.
+    :param depot: Dépôt de PDFs adressés par leur contenu partagé par tous les ateliers (voir `utils.depot`).
+    """
+    def __init__(self, reception: Path, ateliers: Path, workers: int=2, intervalle: float=2.0,
+                 delai_stabilite: float=5.0, historique: int=100, verbosite: int=0, depot: Path | None=None):
+        self.reception = reception
+        self.ateliers = ateliers
+        self.workers = workers
+        self.intervalle = intervalle
+        self.delai_stabilite = delai_stabilite
+        self.historique = historique
+        self.verbosite = verbosite
+        self.depot = depot
+        self.en_cours: dict[Future, Travail] = {}
+        self.termines: list[Travail] = []
+        self.arret = False
+        self.dossier_en_cours = reception / EN_COURS / str(os.getpid())
+
+        for dossier in [self.dossier_en_cours, reception / TRAITES, reception / ERREURS, ateliers]:
+            dossier.mkdir(parents=True, exist_ok=True)
+
+    def arreter(self, *_):
+        logger.info("Arrêt demandé, fin des travaux en cours...")
+        self.arret = True
+
+    def reprendre_abandonnes(self):
+        """
+        Remet dans la file d'attente les zips réclamés par des instances qui ne tournent plus.
+        """
+        for dossier in (self.reception / EN_COURS).iterdir():
+            if not dossier.is_dir() or not dossier.name.isdigit() or _processus_actif(int(dossier.name)):
+                continue
+            for zip_path in dossier.glob('*.zip'):
+                logger.warning(f"Reprise de {zip_path.name}, abandonné par l'instance {dossier.name}")
+                os.replace(zip_path, self.reception / zip_path.name)
+            dossier.rmdir()
+
+    def ecrire_etat(self, file_attente: int):
+        etat = {
+            'mis_a_jour': datetime.now().isoformat(timespec='seconds'),
+            'file_attente': file_attente,
+            'en_cours': [asdict(t) for t in self.en_cours.values()],
+            'termines': [asdict(t) for t in self.termines[-self.historique:]],
+        }
+        # Écriture atomique pour que les lecteurs ne voient jamais un fichier partiel
+        temporaire = self.reception / f'.{FICHIER_ETAT}.{os.getpid()}.tmp'
+        temporaire.write_text(json.dumps(etat, indent=2, ensure_ascii=False), encoding='utf-8')
+        os.replace(temporaire, self.reception / FICHIER_ETAT)
+
+    def _recolter(self):
+        for future in [f for f in self.en_cours if f.done()]:
+            travail = self.en_cours.pop(future)
+            travail.fin = time.time()
+            zip_path = Path(travail.zip)
+            try:
+                travail.duree = future.result()
+                os.replace(zip_path, self.reception / TRAITES / zip_path.name)
+                logger.info(f"{zip_path.name} traité en {travail.duree:.1f} s dans {travail.atelier}")
+            except Exception as e:
+                travail.duree = travail.fin - travail.debut
+                travail.erreur = repr(e)
+                os.replace(zip_path, self.reception / ERREURS / zip_path.name)
+                (self.reception / ERREURS / f'{zip_path.name}.erreur.txt').write_text(
+                    ''.join(traceback.format_exception(e)), encoding='utf-8')
+                logger.error(f"Échec du traitement de {zip_path.name} : {e!r}")
+            self.termines.append(travail)
+        del self.termines[:-self.historique]
+
+    def executer(self):
+        signal.signal(signal.SIGTERM, self.arreter)
+        signal.signal(signal.SIGINT, self.arreter)
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_prechauffer,
+                                 initargs=(self.verbosite, self.depot)) as pool:
+            self.reprendre_abandonnes()
+            while not self.arret or self.en_cours:
+                self._recolter()
+                prets = [] if self.arret else zips_prets(self.reception, self.delai_stabilite)
+                # Les zips restent dans le dossier de réception tant qu'aucun processus n'est libre,
+                # pour qu'une autre instance puisse les prendre
+                for zip_path in prets[:max(0, self.workers - len(self.en_cours))]:
+                    reclame = reclamer(zip_path, self.dossier_en_cours)
+                    if reclame is None:
+                        continue
+                    atelier = repertoire_atelier(reclame, self.ateliers)
+                    future = pool.submit(traiter_zip, reclame, atelier)
+                    self.en_cours[future] = Travail(zip=str(reclame), atelier=str(atelier), debut=time.time())
+                    logger.info(f"{reclame.name} réclamé, traitement dans {atelier}")
+
+                self.ecrire_etat(file_attente=len(zips_prets(self.reception, 0)))
+                time.sleep(self.intervalle)
+        self.ecrire_etat(file_attente=len(zips_prets(self.reception, 0)))
+        self.dossier_en_cours.rmdir()
+
+def main():
+    parser = argparse.ArgumentParser(description="Surveille un dossier de réception et traite chaque nouveau zip")
+    parser.add_argument("reception", type=str, help="Dossier de réception des zips")
+    parser.add_argument("ateliers", type=str, help="Dossier où créer un répertoire atelier par zip")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="Nombre de processus de travail")
+    parser.add_argument("--intervalle", type=float, default=2.0, help="Délai entre deux inspections (s)")
+    parser.add_argument("--delai-stabilite", type=float, default=5.0, help="Âge minimal d'un zip avant traitement (s)")
+    parser.add_argument("--depot", type=str, default=None, metavar="DOSSIER",
+                        help="Dépôt de PDFs partagé par tous les ateliers : une facture déjà traitée n'est plus réécrite, seulement liée")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Plus de logs (e.g., -v or -vv)")
+    args = parser.parse_args()
+
+    setup_logger(max(args.verbose, 1))
+    Veille(
+        reception=Path(args.reception).expanduser(),
+        ateliers=Path(args.ateliers).expanduser(),
+        workers=args.workers,
+        intervalle=args.intervalle,
+        delai_stabilite=args.delai_stabilite,
+        verbosite=args.verbose,
+        depot=Path(args.depot).expanduser() if args.depot else None,
+    ).executer()
+
+if __name__ == "__main__":
+    main()